@@ -0,0 +1,63 @@
+from datetime import date, timedelta
+from typing import List, Optional
+
+import numpy as np
+
+
+STATUSES = ("normal", "warning", "error")
+
+
+def daily_status_series(rows: List[dict], previous: Optional[dict], start: date, days: int):
+    """Expand sparse farm_status_daily rows into one value per day.
+
+    A rollup row only exists for days on which some sensor changed status,
+    so days without a row carry the counts of the latest earlier row
+    forward (`previous` is the last row before `start`).
+    """
+    counts = np.zeros((days + 1, len(STATUSES)), dtype=np.int64)
+    present = np.zeros(days + 1, dtype=bool)
+
+    # Vị trí 0 giữ giá trị của ngày trước cửa sổ để forward-fill
+    if previous:
+        counts[0] = [previous.get(s) or 0 for s in STATUSES]
+        present[0] = True
+
+    if rows:
+        idx = np.array([(date.fromisoformat(str(r["day"])[:10]) - start).days + 1 for r in rows])
+        values = np.array([[r.get(s) or 0 for s in STATUSES] for r in rows], dtype=np.int64)
+        keep = (idx >= 1) & (idx <= days)
+        counts[idx[keep]] = values[keep]
+        present[idx[keep]] = True
+
+    # Với mỗi ngày, lấy chỉ số của ngày gần nhất có dữ liệu
+    last = np.where(present, np.arange(days + 1), 0)
+    np.maximum.accumulate(last, out=last)
+    filled = counts[last][1:]
+    filled[~present[last][1:]] = 0
+    return filled
+
+
+def analytics_payload(rows: List[dict], previous: Optional[dict], today: date, days: int):
+    start = today - timedelta(days=days - 1)
+    series = daily_status_series(rows, previous, start, days)
+    normal, warning, error = series[:, 0], series[:, 1], series[:, 2]
+    total = series.sum(axis=1)
+
+    analytics = []
+    for i in range(days):
+        day = start + timedelta(days=i)
+        analytics.append({
+            "date": day.strftime("%b %d"),
+            "fullDate": day.isoformat(),
+            "error": int(error[i] + warning[i]),  # Combine errors and warnings
+            "normal": int(normal[i]),
+            "total": int(total[i])
+        })
+
+    summary = {
+        "total_sensors": int(total[-1]),
+        "normal_sensors": int(normal[-1]),
+        "error_sensors": int(error[-1]),
+        "warning_sensors": int(warning[-1])
+    }
+    return analytics, summary
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+import jwt
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class CachedToken:
+    __slots__ = ("claims", "exp", "checked_at", "revoked")
+
+    def __init__(self, claims: dict, exp: float, checked_at: float):
+        self.claims = claims
+        self.exp = exp
+        self.checked_at = checked_at
+        self.revoked = False
+
+
+class TokenVerifier:
+    """Verifies Supabase JWTs locally and remembers the verified claims.
+
+    Entries live in a bounded LRU and expire at the token's own `exp`, so a
+    repeated request for the same token is a dict lookup. Since a local
+    signature check cannot see sign-outs, needs_remote_check() tells the
+    caller when a token is due for another round trip to Supabase Auth;
+    mark_revoked() makes every later lookup of that token fail. It also
+    passes the token's SHA-256 digest to `on_revoke`, if set, and
+    revoke_digest() applies such a digest from another worker.
+    """
+
+    def __init__(self, secret: str, max_entries: int = 10000, revocation_check_interval: float = 300):
+        self.secret = secret
+        self.max_entries = max_entries
+        self.revocation_check_interval = revocation_check_interval
+        self._cache = OrderedDict()
+        self._revoked = OrderedDict()
+        self._lock = threading.Lock()
+        self.on_revoke = None
+        self.stats = {"hits": 0, "misses": 0, "invalid": 0, "remote_checks": 0}
+
+    def _lookup(self, token: str, now: float):
+        with self._lock:
+            entry = self._cache.get(token)
+            if entry is None:
+                return None
+            if entry.exp <= now:
+                del self._cache[token]
+                return None
+            self._cache.move_to_end(token)
+            return entry
+
+    def _decode(self, token: str, now: float):
+        try:
+            claims = jwt.decode(
+                token,
+                self.secret,
+                algorithms=["HS256"],
+                options={"verify_aud": False}
+            )
+        except jwt.PyJWTError:
+            self.stats["invalid"] += 1
+            return None
+
+        # Token không có exp thì chỉ cache trong một chu kỳ kiểm tra thu hồi
+        exp = float(claims.get("exp") or now + self.revocation_check_interval)
+        entry = CachedToken(claims, exp, checked_at=0.0)
+        if self._revoked and token_digest(token) in self._revoked:
+            entry.revoked = True
+        with self._lock:
+            self._cache[token] = entry
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return entry
+
+    def _entry(self, token: str):
+        now = time.time()
+        entry = self._lookup(token, now)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        return self._decode(token, now)
+
+    def verify(self, token: str):
+        entry = self._entry(token)
+        if entry is None or entry.revoked:
+            return None
+        return entry.claims
+
+    def needs_remote_check(self, token: str) -> bool:
+        entry = self._entry(token)
+        if entry is None:
+            return False
+        return time.time() - entry.checked_at >= self.revocation_check_interval
+
+    def mark_checked(self, token: str):
+        self.stats["remote_checks"] += 1
+        entry = self._lookup(token, time.time())
+        if entry is not None:
+            entry.checked_at = time.time()
+
+    def mark_revoked(self, token: str):
+        self.stats["remote_checks"] += 1
+        entry = self._lookup(token, time.time())
+        if entry is not None:
+            entry.revoked = True
+        if self.on_revoke is not None:
+            self.on_revoke(token_digest(token))
+
+    def revoke_digest(self, digest: str):
+        # Worker khác đã thấy token bị thu hồi: đánh dấu bản cache (nếu có) và nhớ digest cho lần decode sau
+        with self._lock:
+            self._revoked[digest] = None
+            while len(self._revoked) > self.max_entries:
+                self._revoked.popitem(last=False)
+            for token, entry in self._cache.items():
+                if token_digest(token) == digest:
+                    entry.revoked = True
+
+    def __len__(self):
+        return len(self._cache)
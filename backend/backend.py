@@ -1,122 +1,679 @@
-from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException, Query, Header
+import time
+_import_started = time.perf_counter()
+
+from pydantic import BaseModel, Field
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi import Request
-from supabase import create_client, Client
 import unicodedata
-import httpx
-import paho.mqtt.publish as publish
-import pika
-import jwt
-import json
-import threading
+import asyncio
+import logging
 import os
-import uvicorn
-import requests
 import re
+from live_state import LiveStateStore, device_key, DEFAULT_DEVICE_ID
+from timeseries import SeriesStore
+from writebehind import WriteBehindBuffer
+from spool import Spool, SpoolFull
+from consumer import RabbitConsumer
+from broker import TelemetryBroker
+from heartbeat import HeartbeatTracker
+from mqtt_publisher import MqttPublisher, MqttPublishError
+from scheduler import IrrigationScheduler, IrrigationJob, PUMP_ID_PATTERN
+from rules import RulesEngine, AlertRule
+from status_writer import StatusWriter
+from shared_state import LeaderUnavailable
+from auth import TokenVerifier
+from http_clients import HttpClients
+from logging_setup import setup_logging
+from metrics import Registry, RateMeter, RequestMetricsMiddleware
+# Mọi JSONResponse trong file này đều encode bằng orjson (nếu có cài)
+from codec import (ReadingDecoder, FastJSONResponse as JSONResponse, EncodeStats, EncodeTimingMiddleware,
+                   dumps)
+from cache import AsyncTTLCache
+from repository import (QueryTimeout, is_rejected, Database, EntityCache, ProfileRepository, FarmRepository, SensorRepository,
+                        DashboardRepository, StatusRollupRepository)
+from settings import load_settings
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+import uuid
+
+
+settings = load_settings()
+
+SUPABASE_URL = settings.supabase_url
+SUPABASE_KEY = settings.supabase_key
+WEATHER_API_KEY = settings.weather_api_key
+TELEMETRY_TABLE = settings.telemetry_table
+STATUS_EVENTS_TABLE = settings.status_events_table
+LOCAL_TZ = ZoneInfo(settings.schedule_tz)
+
+# setup_logging() chạy trong lifespan: import module không khởi động thread ghi log
+logger = logging.getLogger("backend")
+# Log từng bản tin ở mức DEBUG, tắt theo mặc định; bật bằng LOG_LEVELS=backend.ingest=DEBUG,
+# khi đó LOG_SAMPLE mặc định chỉ giữ 1/100 bản ghi
+ingest_log = logging.getLogger("backend.ingest")
+
+metrics_registry = Registry()
+request_latency = metrics_registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route, method and status",
+    labels=("route", "method", "status"))
+supabase_latency = metrics_registry.histogram(
+    "supabase_query_duration_seconds", "Supabase (supabase-py) query latency", labels=("outcome",))
+upstream_latency = metrics_registry.histogram(
+    "upstream_request_duration_seconds", "Outbound HTTP latency by upstream and status",
+    labels=("upstream", "status"))
+mqtt_ack_latency = metrics_registry.histogram(
+    "mqtt_publish_ack_seconds", "Time from MQTT publish to broker acknowledgement")
+ingest_rate = RateMeter(window=10)
+
+def create_supabase_client():
+    # Import supabase (~0.25s) và tạo client ở lần query đầu tiên, không phải lúc import module
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise RuntimeError("SUPABASE_URL and SUPABASE_KEY must be set")
+    from supabase import create_client
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+db = Database(
+    create_supabase_client,
+    max_workers=settings.supabase_workers,
+    timeout=settings.supabase_query_timeout,
+    latency=supabase_latency
+)
+entity_cache = EntityCache(
+    ttl=settings.entity_cache_ttl,
+    max_entries=settings.entity_cache_size
+)
+profiles = ProfileRepository(db)
+farms_repo = FarmRepository(db, entity_cache)
+sensors_repo = SensorRepository(db, entity_cache)
+dashboard_repo = DashboardRepository(db)
+rollups = StatusRollupRepository(db)
+
+http_clients = HttpClients(latency=upstream_latency)
+http_clients.register(
+    "supabase", SUPABASE_URL or "",
+    timeout=settings.supabase_http_timeout,
+    max_concurrency=settings.supabase_http_concurrency
+)
+http_clients.register(
+    "weather", settings.weather_api_url,
+    timeout=settings.weather_http_timeout,
+    max_concurrency=settings.weather_http_concurrency
+)
+
+token_verifier = TokenVerifier(
+    settings.supabase_jwt_secret,
+    max_entries=settings.auth_cache_size,
+    revocation_check_interval=settings.auth_revocation_check_interval
+)
+
+# WEB_CONCURRENCY > 1: nhiều worker uvicorn, chỉ worker được bầu làm leader mới consume
+# RabbitMQ và ghi live state vào segment dùng chung; các worker còn lại đọc từ đó
+WORKERS = settings.web_concurrency
+SHARED_MODE = WORKERS > 1
+SHARED_POLL_INTERVAL = settings.shared_poll_interval
+SHARED_ELECTION_INTERVAL = settings.shared_election_interval
+SHARED_RESYNC_INTERVAL = settings.shared_resync_interval
+
+# Ở SHARED_MODE, open_shared_state() (gọi trong lifespan) thay các giá trị này bằng
+# segment dùng chung, file lock và socket; import module không mở file nào
+live_state = LiveStateStore(max_devices=settings.live_state_max_devices)
+election = None
+shared_events = None
+leader_rpc = None
+
+
+def open_shared_state():
+    global live_state, election, shared_events, leader_rpc
+    from shared_state import SharedLiveState, SharedEventLog, LeaderElection, LeaderRpc
+    live_state = SharedLiveState(
+        settings.live_state_shm,
+        max_devices=settings.live_state_max_devices,
+        slot_size=settings.live_state_slot_bytes
+    )
+    election = LeaderElection(settings.leader_lock)
+    # Ghi ở worker nào cũng báo cho các worker khác (bỏ cache, thêm/xóa lịch tưới và rule)
+    shared_events = SharedEventLog(settings.shared_events_shm, capacity=settings.shared_events_capacity)
+    entity_cache.on_change = lambda change: broadcast("cache", change)
+    token_verifier.on_revoke = lambda digest: broadcast("token_revoked", {"digest": digest})
+    # Dữ liệu chỉ leader có (chuỗi thời gian) được follower hỏi qua Unix socket
+    leader_rpc = LeaderRpc(settings.leader_socket)
+    leader_rpc.register("series", query_series)
+
+
+def close_shared_state():
+    election.release()
+    live_state.close()
+    shared_events.close()
+
+
+def broadcast(kind: str, data: dict):
+    if shared_events is None:
+        return
+    try:
+        shared_events.publish(kind, data)
+    except Exception as e:
+        logger.error("❌ Error broadcasting %s to other workers: %s", kind, e)
+
+
+series_store = SeriesStore(
+    capacity=settings.timeseries_capacity,
+    retention=settings.timeseries_retention_hours * 3600,
+    max_sensors=settings.timeseries_max_sensors
+)
+
+reading_decoder = ReadingDecoder(max_bytes=settings.ingest_max_message_bytes)
+encode_stats = EncodeStats()
+
+telemetry_broker = TelemetryBroker(queue_size=settings.stream_queue_size)
+STREAM_KEEPALIVE = settings.stream_keepalive
+
+
+# Ghi đệm xuống đĩa khi Supabase không với tới được, replay lại khi kết nối trở lại
+spool = Spool(
+    settings.spool_path,
+    max_bytes=settings.spool_max_mb * 1024 * 1024,
+    batch_size=settings.spool_replay_batch,
+    replay_rate=settings.spool_replay_rate,
+    backoff_max=settings.spool_backoff_max
+)
+
+def outage_errors() -> tuple:
+    # Lỗi mạng/timeout tới Supabase: ghi vào spool thay vì trả "Server error."
+    # httpx chỉ được import khi đã có lỗi cần bắt (lúc đó supabase-py đã nạp nó)
+    import httpx
+    return (httpx.TransportError, QueryTimeout, OSError)
+
+
+def http_error():
+    import httpx
+    return httpx.HTTPError
+
+
+def insert_readings(rows):
+    # Upsert bỏ qua trùng event_id để thử lại/replay không ghi hai lần
+    db.table(TELEMETRY_TABLE).upsert(rows, on_conflict="event_id", ignore_duplicates=True).execute()
+
+
+telemetry_writer = WriteBehindBuffer(
+    insert_readings,
+    batch_size=settings.telemetry_batch_size,
+    flush_interval=settings.telemetry_flush_interval,
+    max_queue=settings.telemetry_max_queue,
+    spool=spool,
+    spool_stream="readings"
+)
 
 
-load_dotenv(dotenv_path="./.env")
+def insert_status_events(rows):
+    db.table(STATUS_EVENTS_TABLE).upsert(rows, on_conflict="event_id", ignore_duplicates=True).execute()
 
-latest_data = {}
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
-WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+# Chuyển trạng thái sensor; trigger trong schema.sql cộng dồn vào farm_status_daily
+status_event_writer = WriteBehindBuffer(insert_status_events, batch_size=200, flush_interval=1.0,
+                                        spool=spool, spool_stream="status_events")
+
+
+def replay_rejected(stream: str, e: Exception):
+    # Supabase đã trả lời nhưng từ chối (ví dụ vi phạm ràng buộc): thử lại cũng vô ích
+    if not is_rejected(e):
+        raise e
+    logger.error("❌ Supabase rejected spooled %s, dropping: %s", stream, e)
+
+
+async def replay_readings(rows):
+    try:
+        await db.run(lambda: insert_readings(rows))
+    except Exception as e:
+        replay_rejected("readings", e)
+
+
+async def replay_status_events(rows):
+    try:
+        await db.run(lambda: insert_status_events(rows))
+    except Exception as e:
+        replay_rejected("status events", e)
+
+
+async def replay_sensor_updates(rows):
+    # Giữ đúng thứ tự: từng thay đổi được áp dụng lần lượt, ghi lại cùng giá trị là vô hại
+    for row in rows:
+        try:
+            await update_sensor_status(row["sensor_id"], row["changes"])
+        except Exception as e:
+            replay_rejected(f"update for sensor {row['sensor_id']}", e)
+
+
+async def replay_sensor_creates(rows):
+    try:
+        created = await sensors_repo.create_spooled(rows)
+    except Exception as e:
+        replay_rejected("sensor creates", e)
+        return
+    for row in created:
+        await record_status_change(row["sensor_id"], row.get("farm_id"), None, row.get("status"))
+
+
+spool.register("readings", replay_readings)
+spool.register("status_events", replay_status_events)
+spool.register("sensor_updates", replay_sensor_updates, key=lambda row: row["sensor_id"])
+spool.register("sensor_creates", replay_sensor_creates)
+
+
+async def update_sensor_or_spool(sensor_id: str, changes: dict):
+    """Updates a sensor, or spools the change when Supabase is unreachable.
+
+    Returns the updated rows, or None when the change was spooled. While
+    earlier changes to the same sensor are still waiting in the spool new
+    ones queue behind them, so they reach Supabase in the order they were
+    made; other sensors are written directly. Raises SpoolFull when the
+    change can be neither written nor spooled.
+    """
+    sensor_id = str(sensor_id)
+    if not await asyncio.to_thread(spool.has_pending, "sensor_updates", sensor_id):
+        try:
+            return await update_sensor_status(sensor_id, changes)
+        except outage_errors() as e:
+            logger.warning("⚠️ Supabase unreachable, spooling update for sensor %s: %s", sensor_id, e)
+    await asyncio.to_thread(spool.append, "sensor_updates", [{"sensor_id": sensor_id, "changes": changes}])
+    return None
+
+
+def queued_response(message: str, **extra):
+    return JSONResponse({"message": message, "queued": True, **extra}, status_code=202)
+
+
+def spool_full_response(e: SpoolFull):
+    # Supabase không với tới được và spool cũng đầy: báo client thử lại sau thay vì "Server error."
+    logger.error("❌ %s", e)
+    return JSONResponse({"error": "Service temporarily unavailable, try again later."}, status_code=503)
+
+
+async def record_status_change(sensor_id, farm_id, old_status, new_status):
+    if old_status == new_status or farm_id is None:
+        return
+    await status_event_writer.put_async({
+        "event_id": str(uuid.uuid4()),
+        "sensor_id": str(sensor_id),
+        "farm_id": str(farm_id),
+        "old_status": old_status,
+        "new_status": new_status,
+        "changed_at": datetime.now(timezone.utc).isoformat()
+    })
+
+
+async def update_sensor_status(sensor_id: str, changes: dict, attempts: int = 3):
+    """Updates a sensor and records the status transition actually applied.
+
+    When `changes` sets a status the write is a compare-and-set on the
+    status read just before it, so the old/new pair sent to the rollup is
+    the DB's own even if heartbeat, rules or another request touch the row
+    concurrently. Returns the updated rows, [] if the sensor does not exist.
+    """
+    if "status" not in changes:
+        return await sensors_repo.update(sensor_id, changes)
+
+    for attempt in range(attempts):
+        row = await sensors_repo.get(sensor_id, fresh=attempt > 0)
+        if row is None:
+            return []
+        old_status = row.get("status")
+        data = await sensors_repo.update_if_status(sensor_id, old_status, changes)
+        if data:
+            await record_status_change(sensor_id, data[0].get("farm_id"), old_status, data[0].get("status"))
+            return data
+    raise RuntimeError(f"Status of sensor {sensor_id} changed concurrently {attempts} times")
+
+
+async def apply_sensor_status(sensor_id: str, status: str, logs: str):
+    row = await sensors_repo.get(sensor_id)
+    if row is None or row.get("status") == status:
+        return
+    await update_sensor_status(sensor_id, {
+        "status": status,
+        "latest_updated": datetime.now(timezone.utc).isoformat(),
+        "logs": logs
+    })
+
+
+# Status đến từ bản tin ingest được ghi vào dòng sensor ở task nền, consumer không chờ Supabase
+status_writer = StatusWriter(apply_sensor_status)
+
+
+async def write_connectivity(sensor_ids, connectivity):
+    await sensors_repo.set_connectivity(sensor_ids, connectivity, datetime.now(timezone.utc).isoformat())
+
+
+# connectivity của sensor được suy ra từ luồng ingest, không cần client PATCH nữa
+heartbeat_tracker = HeartbeatTracker(
+    write_connectivity,
+    timeout=settings.heartbeat_timeout,
+    flush_interval=settings.heartbeat_flush_interval,
+    batch_size=settings.heartbeat_batch_size,
+    max_devices=settings.heartbeat_max_devices
+)
+
+
+async def load_heartbeats():
+    try:
+        online = await sensors_repo.list_ids_by_connectivity("online")
+    except Exception as e:
+        logger.error("❌ Error loading online sensors: %s", e)
+        return
+    heartbeat_tracker.seed(online)
+    logger.info("✅ Tracking %d online sensors", len(online))
+
+
+MQTT_TOPIC = settings.mqtt_topic
+# Topic riêng cho từng bơm, ví dụ "/esp32Relay/{pump_id}"
+MQTT_PUMP_TOPIC = settings.pump_topic
+
+mqtt_publisher = MqttPublisher(
+    host=settings.mqtt_host,
+    port=settings.mqtt_port,
+    username=settings.mqtt_user,
+    password=settings.mqtt_pass,
+    keepalive=settings.mqtt_keepalive,
+    qos=settings.mqtt_qos,
+    max_inflight=settings.mqtt_max_inflight,
+    ack_latency=mqtt_ack_latency
+)
 
 
 class PumpCommand(BaseModel):
     command: str = "PUMP_ON"
     duration: int = 5000  # millisecond
+    pump_id: Optional[str] = Field(None, pattern=PUMP_ID_PATTERN)
 
 
-def mq_consumer():
-    print("📡 RabbitMQ consumer starting...")
+class PumpBatch(BaseModel):
+    commands: List[PumpCommand]
 
-    try:
-        credentials = pika.PlainCredentials(
-            os.getenv("FARM_USER"),
-            os.getenv("FARM_PASS")
-        )
 
-        parameters = pika.ConnectionParameters(
-            host=os.getenv("FARM_HOST"),
-            port=int(os.getenv("FARM_PORT")),
-            virtual_host=os.getenv("FARM_VHOST"),
-            credentials=credentials
-        )
+class ScheduleRequest(BaseModel):
+    pump_id: Optional[str] = Field(None, pattern=PUMP_ID_PATTERN)
+    duration: int = 5000  # millisecond
+    kind: str = "once"  # once | interval | daily
+    run_at: Optional[datetime] = None
+    interval_seconds: Optional[int] = None
+    time_of_day: Optional[str] = None  # "HH:MM" theo SCHEDULE_TZ
 
-        connection = pika.BlockingConnection(parameters)
-        channel = connection.channel()
 
-        channel.exchange_declare(
-            exchange='smart_farm_data',
-            exchange_type='fanout',
-            durable=True
-        )
+class RuleRequest(BaseModel):
+    metric: str
+    op: str = ">"
+    threshold: float
+    kind: str = "threshold"  # threshold | rate (đơn vị/giây)
+    sensor_id: Optional[str] = None
+    farm_id: Optional[str] = None
+    clear_threshold: Optional[float] = None
+    for_seconds: float = 0
+    status: str = "warning"  # warning | error
+    pump_id: Optional[str] = Field(None, pattern=PUMP_ID_PATTERN)
+    pump_duration: Optional[int] = None  # millisecond
 
-        result = channel.queue_declare(queue='', exclusive=True)
-        queue_name = result.method.queue
 
-        channel.queue_bind(exchange='smart_farm_data', queue=queue_name)
+RULES_TABLE = settings.rules_table
+rules_engine = RulesEngine(max_states=settings.rules_max_states)
 
-        print(f'✅ Listening on exchange "smart_farm_data"...')
 
-        def on_message(ch, method, properties, body):
-            global latest_data
-            decoded = body.decode('utf-8', errors='replace')
-            print(f"[x] Received: {decoded}")
+def apply_rule_actions(actions):
+    for action in actions:
+        if action["type"] == "pump":
             try:
-                latest_data = json.loads(decoded)
+                send_pump_command(PumpCommand(pump_id=action["pump_id"], duration=action["duration"]))
             except Exception as e:
-                print(f"[!] JSON decode error: {e}")
-
-        channel.basic_consume(
-            queue=queue_name,
-            on_message_callback=on_message,
-            auto_ack=True
-        )
+                logger.error("❌ Rule %s could not start pump %s: %s", action["rule_id"], action["pump_id"], e)
+            continue
+
+        # Ghi status ở task nền: consumer không chờ round trip Supabase cho mỗi lần rule kích hoạt
+        status = action["status"]
+        status_writer.put(action["sensor_id"], status, f"Status set to {status} by alert rule.")
+
+
+async def ingest_message(body: bytes):
+    data = reading_decoder.decode(body)
+    ingest_rate.mark()
+    if ingest_log.isEnabledFor(logging.DEBUG):
+        ingest_log.debug("[x] Received", extra={"fields": {"bytes": len(body), "payload": data}})
+
+    status = data.get("status")
+    previous = live_state.get(device_key(data)[0]) if status is not None else None
+    state = live_state.update(data)
+    if state.sensor_id != DEFAULT_DEVICE_ID:
+        heartbeat_tracker.seen(state.sensor_id, state.ts)
+        # Chỉ xếp hàng khi thiết bị báo status khác lần trước; chuyển trạng thái được
+        # ghi nhận theo status cũ trong DB lúc áp dụng (xem update_sensor_status)
+        if status is not None and (previous is None or previous.value.get("status") != status):
+            status_writer.put(state.sensor_id, status, "Status reported by device.")
+    series_store.append(state.sensor_id, data, state.ts)
+    actions = rules_engine.evaluate(state.sensor_id, state.farm_id, data, state.ts)
+    if actions:
+        apply_rule_actions(actions)
+    if telemetry_broker.count:
+        telemetry_broker.publish(dumps(state.to_dict()), state.sensor_id, state.farm_id)
+    await telemetry_writer.put_async({
+        "event_id": str(uuid.uuid4()),
+        "sensor_id": state.sensor_id,
+        "farm_id": state.farm_id,
+        "data": data,
+        "recorded_at": datetime.fromtimestamp(state.ts, timezone.utc).isoformat()
+    })
+
+
+mq_consumer = RabbitConsumer(
+    ingest_message,
+    host=settings.farm_host,
+    port=settings.farm_port,
+    login=settings.farm_user,
+    password=settings.farm_pass,
+    virtualhost=settings.farm_vhost,
+    exchange="smart_farm_data",
+    queue_name=settings.rabbitmq_queue,
+    prefetch=settings.rabbitmq_prefetch,
+    ack_batch=settings.rabbitmq_ack_batch,
+    ack_interval=settings.rabbitmq_ack_interval,
+    backoff_max=settings.rabbitmq_backoff_max
+)
 
-        channel.start_consuming()
 
+def is_leader() -> bool:
+    return election is None or election.is_leader
+
+
+async def start_leader_services():
+    # Consumer, heartbeat, lịch tưới và replay spool chỉ chạy ở một worker để không consume/tưới/ghi trùng
+    if leader_rpc is not None:
+        await leader_rpc.serve()
+    mq_consumer.start()
+    spool.start()
+    await load_heartbeats()
+    heartbeat_tracker.start()
+    status_writer.start()
+    irrigation_scheduler.start()
+    logger.info("👑 Worker %d is the telemetry leader", os.getpid())
+
+
+async def stop_leader_services():
+    await irrigation_scheduler.stop()
+    await mq_consumer.stop()
+    await heartbeat_tracker.stop()
+    await status_writer.stop()
+    await spool.stop()
+    if leader_rpc is not None:
+        await leader_rpc.close()
+
+
+async def follow_shared_state():
+    # Worker follower: đẩy các slot vừa đổi sang SSE của worker này và chờ tới lượt làm leader
+    next_election = 0.0
+    while True:
+        try:
+            for state in live_state.changes(collect=telemetry_broker.count > 0):
+                telemetry_broker.publish(dumps(state.to_dict()), state.sensor_id, state.farm_id)
+            now = time.monotonic()
+            if now >= next_election:
+                next_election = now + SHARED_ELECTION_INTERVAL
+                if election.try_acquire():
+                    await start_leader_services()
+                    return
+        except Exception as e:
+            logger.error("❌ Error following shared live state: %s", e)
+        await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+
+def apply_shared_event(event: dict):
+    kind, data = event["kind"], event["data"]
+    if kind == "cache":
+        entity_cache.apply_remote(data)
+    elif kind == "token_revoked":
+        token_verifier.revoke_digest(data["digest"])
+    elif kind == "schedule_added":
+        if data["job_id"] not in irrigation_scheduler.job_ids() and data["job_id"] not in finished_jobs:
+            irrigation_scheduler.add(IrrigationJob.from_row(data))
+    elif kind == "schedule_removed":
+        # Xóa ngay trên leader, không chờ resync thấy vắng hai lần (job có thể sắp chạy)
+        irrigation_scheduler.remove(data["job_id"])
+        missing_jobs.discard(data["job_id"])
+    elif kind == "rule_added":
+        if data["rule_id"] not in rules_engine.rule_ids():
+            rules_engine.add(AlertRule.from_row(data))
+    elif kind == "rule_removed":
+        actions = []
+        rules_engine.remove(data["rule_id"], actions)
+        missing_rules.discard(data["rule_id"])
+        apply_rule_actions(actions)
+
+
+async def follow_shared_events():
+    while True:
+        try:
+            events, missed = shared_events.poll()
+            if missed:
+                # Bị ghi đè trước khi kịp đọc: bỏ toàn bộ cache và đọc lại lịch/rule từ DB
+                logger.warning("⚠️ Missed shared events, dropping caches and reloading schedule and rules")
+                entity_cache.clear()
+                await load_schedule()
+                await load_rules()
+            for event in events:
+                try:
+                    apply_shared_event(event)
+                except Exception as e:
+                    logger.error("❌ Error applying shared event %s: %s", event.get("kind"), e)
+        except Exception as e:
+            logger.error("❌ Error reading shared events: %s", e)
+        await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+
+async def resync_shared_config():
+    # Lưới an toàn cho thay đổi không đi qua API (sửa thẳng trong DB): đọc lại theo chu kỳ
+    while True:
+        await asyncio.sleep(SHARED_RESYNC_INTERVAL)
+        await load_schedule()
+        await load_rules()
+
+# Thời gian khởi động theo giai đoạn: import module, lifespan tới lúc nhận request, warm-up nền
+startup_seconds = {}
+
+
+async def warm_up(tasks: list):
+    # Chạy sau khi app đã nhận request: tạo Supabase client, nạp lịch/rule rồi mới consume
+    started = time.perf_counter()
+    # Mở sẵn pool HTTP (SSL context, h2 mất ~0.2s); request đến trước vẫn tự mở khi cần
+    await http_clients.start()
+    try:
+        await db.run(lambda: db.client)
     except Exception as e:
-        print(f"❌ Failed to connect to RabbitMQ: {e}")
+        logger.error("❌ Error creating Supabase client: %s", e)
+    await load_schedule()
+    await load_rules()
+    if election is None or election.try_acquire():
+        await start_leader_services()
+    if SHARED_MODE:
+        if not election.is_leader:
+            tasks.append(asyncio.create_task(follow_shared_state()))
+        tasks.append(asyncio.create_task(follow_shared_events()))
+        tasks.append(asyncio.create_task(resync_shared_config()))
+    startup_seconds["warmup"] = time.perf_counter() - started
+    logger.info("✅ Warm-up finished in %.0f ms", startup_seconds["warmup"] * 1000)
 
 # ✅ Tự động chạy consumer khi app khởi động
 
+def expose_components(app: FastAPI, **extra):
+    # Đọc giá trị module lúc chạy lifespan nên bản thay thế (bench/serve.py gán vào module) cũng có trên app.state
+    components = {
+        "settings": settings,
+        "db": db,
+        "entity_cache": entity_cache,
+        "token_verifier": token_verifier,
+        "http_clients": http_clients,
+        "live_state": live_state,
+        "series_store": series_store,
+        "spool": spool,
+        "status_writer": status_writer,
+        "mqtt_publisher": mqtt_publisher,
+        "mq_consumer": mq_consumer,
+        "election": election,
+        "shared_events": shared_events,
+        "leader_rpc": leader_rpc,
+    }
+    for name, component in {**components, **extra}.items():
+        setattr(app.state, name, component)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("🚀 FastAPI is starting up...")
-    threading.Thread(target=mq_consumer, daemon=True).start()
+    started = time.perf_counter()
+    log_handler = setup_logging(
+        level=settings.log_level,
+        levels=settings.log_levels,
+        sample=settings.log_sample,
+        fmt=settings.log_format
+    )
+    if SHARED_MODE:
+        open_shared_state()
+    expose_components(app, log_handler=log_handler)
+    logger.info("🚀 FastAPI is starting up...")
+    telemetry_writer.start()
+    status_event_writer.start()
+    mqtt_publisher.start()
+    tasks = []
+    tasks.append(asyncio.create_task(warm_up(tasks)))
+    startup_seconds["lifespan"] = time.perf_counter() - started
+    logger.info("🚀 Serving after %.0f ms (module import %.0f ms)",
+                startup_seconds["lifespan"] * 1000, startup_seconds.get("import", 0) * 1000)
     yield
-    print("🛑 FastAPI is shutting down...")
-
-app = FastAPI(lifespan=lifespan)
-
-app.add_middleware( 
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-@app.get("/")
+    logger.info("🛑 FastAPI is shutting down...")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if is_leader():
+        await stop_leader_services()
+    await asyncio.to_thread(telemetry_writer.stop)
+    await asyncio.to_thread(status_event_writer.stop)
+    await asyncio.to_thread(mqtt_publisher.stop)
+    await http_clients.close()
+    db.close()
+    spool.close()
+    if SHARED_MODE:
+        close_shared_state()
+    logger.info("🛑 Shutdown complete")
+    log_handler.close()
+
+# Route khai báo trên router; create_app() ở cuối file gắn vào app
+router = APIRouter()
+
+
+@router.get("/")
 def root():
     return {"message": "✅ Server is running!"}
 
 
-@app.post("/api/pump-on")
-def pump_on(payload: PumpCommand):
-    if payload.command != "PUMP_ON":
-        raise HTTPException(status_code=400, detail="Invalid command")
-
+def send_pump_command(payload: PumpCommand):
     now = datetime.utcnow()
     end_time = now + timedelta(milliseconds=payload.duration)
 
@@ -124,21 +681,12 @@ def pump_on(payload: PumpCommand):
         "command": payload.command,
         "duration": payload.duration
     }
+    topic = MQTT_TOPIC
+    if payload.pump_id:
+        mqtt_message["pump_id"] = payload.pump_id
+        topic = MQTT_PUMP_TOPIC.format(pump_id=payload.pump_id)
 
-    try:
-        publish.single(
-            topic=os.getenv("MQTT_TOPIC"),
-            payload=json.dumps(mqtt_message),
-            hostname=os.getenv("MQTT_HOST"),
-            port=int(os.getenv("MQTT_PORT")),
-            auth={
-                "username": os.getenv("MQTT_USER"),
-                "password": os.getenv("MQTT_PASS")
-            }
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500, detail=f"MQTT publish failed: {e}")
+    mqtt_publisher.publish(topic, dumps(mqtt_message))
 
     return {
         "status": "success",
@@ -148,12 +696,503 @@ def pump_on(payload: PumpCommand):
     }
 
 
-@app.get("/api/latest")
-def get_latest_data():
-    return latest_data
+@router.post("/api/pump-on")
+def pump_on(payload: PumpCommand):
+    if payload.command != "PUMP_ON":
+        raise HTTPException(status_code=400, detail="Invalid command")
+
+    try:
+        return send_pump_command(payload)
+    except MqttPublishError as e:
+        raise HTTPException(
+            status_code=500, detail=f"MQTT publish failed: {e}")
+
+
+@router.post("/api/pump-on/batch")
+def pump_on_batch(payload: PumpBatch):
+    if not payload.commands:
+        raise HTTPException(status_code=400, detail="No commands provided")
+
+    results = []
+    for command in payload.commands:
+        if command.command != "PUMP_ON":
+            results.append({"pump_id": command.pump_id, "status": "error", "error": "Invalid command"})
+            continue
+        try:
+            results.append({"pump_id": command.pump_id, **send_pump_command(command)})
+        except MqttPublishError as e:
+            results.append({"pump_id": command.pump_id, "status": "error", "error": f"MQTT publish failed: {e}"})
+        except Exception as e:
+            # Lỗi của một bơm không được làm hỏng cả batch: các bơm trước đó đã chạy
+            logger.error("❌ Error sending pump command to %s: %s", command.pump_id, e)
+            results.append({"pump_id": command.pump_id, "status": "error", "error": "Could not send pump command"})
+
+    sent = sum(1 for r in results if r["status"] == "success")
+    return {"sent": sent, "failed": len(results) - sent, "results": results}
+
+
+SCHEDULE_TABLE = settings.schedule_table
+
+
+def run_scheduled_irrigation(pump_id, duration):
+    send_pump_command(PumpCommand(pump_id=pump_id, duration=duration))
+
+
+def disable_schedule_row(job: IrrigationJob):
+    try:
+        db.table(SCHEDULE_TABLE).update({"enabled": False}).eq("job_id", job.job_id).execute()
+    except Exception as e:
+        logger.error("❌ Error disabling schedule: %s", e)
+
+
+# job đã chạy xong nhưng DB có thể chưa kịp tắt enabled: resync không được nạp lại
+finished_jobs = set()
+
+
+def on_schedule_finished(job: IrrigationJob):
+    if len(finished_jobs) >= 10000:
+        finished_jobs.clear()
+    finished_jobs.add(job.job_id)
+    broadcast("schedule_removed", {"job_id": job.job_id})
+    db.run_in_executor(disable_schedule_row, job)
+
+
+irrigation_scheduler = IrrigationScheduler(
+    run_scheduled_irrigation,
+    tz=LOCAL_TZ,
+    on_finished=on_schedule_finished
+)
+
+
+def stale_ids(known: set, current: set, pending: set) -> set:
+    # Chỉ bỏ id vắng mặt ở hai lần đọc liên tiếp, tránh xóa nhầm bản ghi vừa thêm mà chưa insert xong
+    missing = known - current
+    stale = missing & pending
+    pending.clear()
+    pending.update(missing - stale)
+    return stale
+
+
+missing_jobs = set()
+
+
+async def load_schedule():
+    known = irrigation_scheduler.job_ids()
+    try:
+        result = await db.run(
+            lambda: db.table(SCHEDULE_TABLE).select("*").eq("enabled", True).execute())
+    except Exception as e:
+        logger.error("❌ Error loading irrigation schedule: %s", e)
+        return
+
+    current = set()
+    added = 0
+    for row in result.data:
+        job_id = str(row.get("job_id"))
+        current.add(job_id)
+        if job_id in known or job_id in finished_jobs:
+            continue
+        try:
+            irrigation_scheduler.add(IrrigationJob.from_row(row))
+            added += 1
+        except (KeyError, ValueError) as e:
+            logger.warning("⚠️ Skipping invalid schedule %s: %s", row.get("job_id"), e)
+    removed = stale_ids(known, current, missing_jobs)
+    for job_id in removed:
+        irrigation_scheduler.remove(job_id)
+    if added or removed or not known:
+        logger.info("✅ Loaded %d irrigation jobs (+%d/-%d)", len(irrigation_scheduler), added, len(removed))
+
+
+async def owns_farm(user_id: str, farm_id) -> bool:
+    farm = await farms_repo.get(farm_id)
+    return farm is not None and str(farm.get("user_own")) == str(user_id)
+
+
+async def owns_sensor(user_id: str, sensor_id) -> bool:
+    sensor = await sensors_repo.get(sensor_id)
+    return sensor is not None and sensor.get("farm_id") is not None and await owns_farm(user_id, sensor["farm_id"])
+
+
+def owns_pump(user_id: str, pump_id) -> bool:
+    # Chưa có bảng bơm: bơm đã gắn vào lịch tưới/rule của user khác thì coi là của user đó
+    owners = irrigation_scheduler.pump_owners(pump_id) | rules_engine.pump_owners(pump_id)
+    return owners <= {str(user_id), None}
+
+
+@router.post("/api/schedule")
+async def create_schedule(payload: ScheduleRequest, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    if not owns_pump(user_id, payload.pump_id):
+        return JSONResponse({"error": "Pump belongs to another user"}, status_code=403)
+
+    run_at = payload.run_at
+    if run_at is not None and run_at.tzinfo is None:
+        run_at = run_at.replace(tzinfo=irrigation_scheduler.tz)
+
+    job = IrrigationJob(
+        uuid.uuid4(), payload.pump_id, payload.duration, payload.kind,
+        run_at=run_at.timestamp() if run_at else None,
+        interval_seconds=payload.interval_seconds,
+        time_of_day=payload.time_of_day,
+        user_own=user_id
+    )
+
+    try:
+        irrigation_scheduler.add(job)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    insert_data = {
+        "job_id": job.job_id,
+        "pump_id": job.pump_id,
+        "duration": job.duration,
+        "kind": job.kind,
+        "run_at": run_at.isoformat() if run_at else None,
+        "interval_seconds": job.interval_seconds,
+        "time_of_day": job.time_of_day,
+        "enabled": True,
+        "user_own": user_id,
+    }
+
+    try:
+        await db.run(lambda: db.table(SCHEDULE_TABLE).insert(insert_data).execute())
+    except Exception as e:
+        irrigation_scheduler.remove(job.job_id)
+        logger.error("❌ Error creating schedule: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+    broadcast("schedule_added", insert_data)
+
+    return JSONResponse({"message": "Schedule created successfully.", "data": job.to_dict()})
+
+
+@router.get("/api/schedule")
+async def get_schedule(pump_id: str = Query(None), limit: int = Query(50, ge=1, le=1000), authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    return JSONResponse({
+        "upcoming": irrigation_scheduler.upcoming(limit, pump_id, user_own=user_id),
+        "total_jobs": len(irrigation_scheduler.owned_by(user_id)),
+        "stats": irrigation_scheduler.stats
+    })
+
+
+@router.delete("/api/schedule/{job_id}")
+async def delete_schedule(job_id: str, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    # Chỉ xóa lịch của chính user: job của người khác trả về 404 như không tồn tại
+    job = irrigation_scheduler.get(job_id)
+    if job is not None and job.user_own != str(user_id):
+        return JSONResponse({"error": "Schedule not found"}, status_code=404)
+
+    try:
+        result = await db.run(
+            lambda: db.table(SCHEDULE_TABLE).delete().eq("job_id", job_id).eq("user_own", user_id).execute())
+    except Exception as e:
+        logger.error("❌ Error deleting schedule: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+    job = irrigation_scheduler.remove(job_id)
+    broadcast("schedule_removed", {"job_id": job_id})
+    if job is None and not result.data:
+        return JSONResponse({"error": "Schedule not found"}, status_code=404)
+
+    return JSONResponse({"message": "Schedule deleted successfully."})
+
+
+missing_rules = set()
+
+
+async def load_rules():
+    known = rules_engine.rule_ids()
+    try:
+        result = await db.run(
+            lambda: db.table(RULES_TABLE).select("*").eq("enabled", True).execute())
+    except Exception as e:
+        logger.error("❌ Error loading alert rules: %s", e)
+        return
+
+    current = set()
+    added = 0
+    for row in result.data:
+        rule_id = str(row.get("rule_id"))
+        current.add(rule_id)
+        if rule_id in known:
+            continue
+        try:
+            rules_engine.add(AlertRule.from_row(row))
+            added += 1
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning("⚠️ Skipping invalid rule %s: %s", row.get("rule_id"), e)
+    removed = stale_ids(known, current, missing_rules)
+    actions = []
+    for rule_id in removed:
+        rules_engine.remove(rule_id, actions)
+    apply_rule_actions(actions)
+    if added or removed or not known:
+        logger.info("✅ Loaded %d alert rules (+%d/-%d)", len(rules_engine), added, len(removed))
+
+
+@router.post("/api/rules")
+async def create_rule(payload: RuleRequest, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    # Rule đọc số đo của sensor/farm và có thể bật bơm: chỉ cho phép trên tài nguyên của chính user
+    if payload.sensor_id is None and payload.farm_id is None:
+        return JSONResponse({"error": "sensor_id or farm_id is required"}, status_code=400)
+    try:
+        if payload.sensor_id is not None and not await owns_sensor(user_id, payload.sensor_id):
+            return JSONResponse({"error": "Sensor not found"}, status_code=404)
+        if payload.farm_id is not None and not await owns_farm(user_id, payload.farm_id):
+            return JSONResponse({"error": "Farm not found"}, status_code=404)
+    except Exception as e:
+        logger.error("❌ Error checking rule ownership: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+    if payload.pump_id is not None and not owns_pump(user_id, payload.pump_id):
+        return JSONResponse({"error": "Pump belongs to another user"}, status_code=403)
+
+    rule = AlertRule(
+        uuid.uuid4(), payload.metric, payload.op, payload.threshold,
+        kind=payload.kind, sensor_id=payload.sensor_id, farm_id=payload.farm_id,
+        clear_threshold=payload.clear_threshold, for_seconds=payload.for_seconds,
+        status=payload.status, pump_id=payload.pump_id, pump_duration=payload.pump_duration,
+        user_own=user_id
+    )
+
+    try:
+        rules_engine.add(rule)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    insert_data = {**rule.to_dict(), "enabled": True, "user_own": user_id}
+
+    try:
+        await db.run(lambda: db.table(RULES_TABLE).insert(insert_data).execute())
+    except Exception as e:
+        rules_engine.remove(rule.rule_id)
+        logger.error("❌ Error creating rule: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+    broadcast("rule_added", rule.to_dict())
+
+    return JSONResponse({"message": "Rule created successfully.", "data": rule.to_dict()})
+
+
+@router.get("/api/rules")
+async def get_rules(sensor_id: str = Query(None), farm_id: str = Query(None), authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    return JSONResponse({
+        "rules": rules_engine.list(sensor_id, farm_id, user_own=user_id),
+        "total_rules": len(rules_engine.list(user_own=user_id)),
+        "stats": rules_engine.stats
+    })
+
 
+@router.delete("/api/rules/{rule_id}")
+async def delete_rule(rule_id: str, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    rule = rules_engine.get(rule_id)
+    if rule is not None and rule.user_own != str(user_id):
+        return JSONResponse({"error": "Rule not found"}, status_code=404)
+
+    try:
+        result = await db.run(
+            lambda: db.table(RULES_TABLE).delete().eq("rule_id", rule_id).eq("user_own", user_id).execute())
+    except Exception as e:
+        logger.error("❌ Error deleting rule: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+    actions = []
+    rule = rules_engine.remove(rule_id, actions)
+    apply_rule_actions(actions)
+    broadcast("rule_removed", {"rule_id": rule_id})
+    if rule is None and not result.data:
+        return JSONResponse({"error": "Rule not found"}, status_code=404)
+
+    return JSONResponse({"message": "Rule deleted successfully."})
+
+
+@router.get("/api/latest")
+def get_latest_data(sensor_id: str = Query(None), farm_id: str = Query(None)):
+    if sensor_id:
+        state = live_state.get(sensor_id)
+        if state is None:
+            return JSONResponse({"error": "Sensor not found"}, status_code=404)
+        return state.value
+
+    if farm_id:
+        return {
+            "farm_id": farm_id,
+            "sensors": [state.to_dict() for state in live_state.by_farm(farm_id)]
+        }
+
+    # Không lọc: giữ nguyên hành vi cũ, trả về bản tin mới nhất
+    state = live_state.latest()
+    return state.value if state else {}
+
+
+@router.get("/api/stream")
+async def stream_telemetry(request: Request, sensor_id: str = Query(None), farm_id: str = Query(None)):
+    sub = telemetry_broker.subscribe(sensor_id=sensor_id, farm_id=farm_id)
+
+    async def event_stream():
+        try:
+            # Gửi trạng thái hiện tại trước để client không phải gọi /api/latest
+            if sensor_id:
+                current = [live_state.get(sensor_id)]
+            elif farm_id:
+                current = live_state.by_farm(farm_id)
+            else:
+                current = [live_state.latest()]
+            for state in current:
+                if state is not None:
+                    yield f"data: {dumps(state.to_dict())}\n\n"
+
+            while not await request.is_disconnected():
+                try:
+                    event = await sub.get(timeout=STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {event}\n\n"
+        finally:
+            telemetry_broker.unsubscribe(sub)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/api/ingest/stats")
+async def get_ingest_stats(request: Request):
+    await spool.refresh()
+    return {
+        "consumer": {**mq_consumer.stats, "connected": mq_consumer.connected},
+        "writer": telemetry_writer.snapshot(),
+        "stream": {**telemetry_broker.stats, "subscribers": telemetry_broker.count},
+        "heartbeat": heartbeat_tracker.snapshot(),
+        "status_writer": status_writer.snapshot(),
+        "spool": spool.snapshot(),
+        "startup": startup_seconds,
+        "log_dropped": request.app.state.log_handler.dropped,
+        "worker": {"pid": os.getpid(), "leader": is_leader(), "devices": len(live_state),
+                   "shared": getattr(live_state, "stats", None),
+                   "events": shared_events.stats if shared_events is not None else None,
+                   "rpc": leader_rpc.stats if leader_rpc is not None else None}
+    }
 
-@app.post("/api/login")
+
+metrics_registry.counter("ingest_messages_total", "Telemetry messages decoded", lambda: ingest_rate.total)
+metrics_registry.gauge("ingest_messages_per_second", "Telemetry messages per second over the last 10s",
+                       ingest_rate.rate)
+metrics_registry.gauge("ingest_last_message_age_seconds", "Seconds since the last telemetry message",
+                       ingest_rate.age)
+metrics_registry.counter("ingest_decode_errors_total", "Telemetry messages rejected by the decoder",
+                         lambda: reading_decoder.stats["rejected"])
+metrics_registry.counter("ingest_consumer_events_total", "RabbitMQ consumer counters",
+                         lambda: {(k,): v for k, v in mq_consumer.stats.items()}, labels=("event",))
+metrics_registry.gauge("ingest_consumer_connected", "1 if the RabbitMQ consumer is connected",
+                       lambda: int(mq_consumer.connected))
+metrics_registry.gauge("write_behind_pending", "Rows waiting in a write-behind buffer",
+                       lambda: {("telemetry",): telemetry_writer.pending(),
+                                ("status_events",): status_event_writer.pending()}, labels=("buffer",))
+metrics_registry.counter("write_behind_rows_total", "Write-behind buffer row counters",
+                         lambda: {(name, k): v
+                                  for name, w in (("telemetry", telemetry_writer), ("status_events", status_event_writer))
+                                  for k, v in w.stats.items()}, labels=("buffer", "event"))
+metrics_registry.counter("mqtt_publish_events_total", "MQTT publisher counters",
+                         lambda: {(k,): v for k, v in mqtt_publisher.stats.items()}, labels=("event",))
+metrics_registry.gauge("stream_subscribers", "Open /api/stream connections", lambda: telemetry_broker.count)
+metrics_registry.gauge("sensors_online", "Sensors currently online per heartbeat tracker",
+                       lambda: heartbeat_tracker.snapshot()["online"])
+metrics_registry.gauge("spool_pending_rows", "Rows waiting in the local spool for replay",
+                       lambda: {(k,): v for k, v in spool.status["pending"].items()}, labels=("stream",))
+metrics_registry.gauge("spool_bytes", "Bytes used by the local spool file", lambda: spool.status["bytes"])
+metrics_registry.gauge("spool_oldest_age_seconds", "Age of the oldest spooled row",
+                       lambda: spool.status["oldest_age"])
+metrics_registry.counter("spool_events_total", "Spool counters",
+                         lambda: {(k,): v for k, v in spool.stats.items()}, labels=("event",))
+metrics_registry.gauge("app_startup_seconds", "Startup time by phase (import, lifespan, warmup)",
+                       lambda: {(k,): v for k, v in startup_seconds.items()}, labels=("phase",))
+metrics_registry.gauge("worker_is_leader", "1 if this worker consumes telemetry and runs the schedule",
+                       lambda: int(is_leader()))
+metrics_registry.gauge("live_state_devices", "Devices held in the live state store", lambda: len(live_state))
+metrics_registry.counter("cache_lookups_total", "Entity cache lookups by cache and result",
+                         lambda: {(name, k): snap[k]
+                                  for name, snap in entity_cache.snapshot().items()
+                                  for k in ("hits", "stale_hits", "misses")}, labels=("cache", "result"))
+
+
+@router.get("/metrics")
+async def get_metrics():
+    await spool.refresh()
+    text = await asyncio.to_thread(metrics_registry.render)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
+@router.get("/api/codec/stats")
+def get_codec_stats():
+    return {
+        "ingest": reading_decoder.snapshot(),
+        "responses": encode_stats.snapshot()
+    }
+
+
+@router.get("/api/cache/stats")
+def get_cache_stats():
+    return entity_cache.snapshot()
+
+
+@router.post("/api/login")
 async def login(request: Request):
     body = await request.json()
     email = body.get("email")
@@ -166,7 +1205,6 @@ async def login(request: Request):
         return JSONResponse({"error": "unknown error"}, status_code=500)
 
     try:
-        url = f"{SUPABASE_URL}/auth/v1/token?grant_type=password"
         headers = {
             "apikey": SUPABASE_KEY,
             "Content-Type": "application/json"
@@ -176,7 +1214,9 @@ async def login(request: Request):
             "password": password
         }
 
-        response = requests.post(url, json=payload, headers=headers)
+        response = await http_clients.post(
+            "supabase", "/auth/v1/token",
+            params={"grant_type": "password"}, json=payload, headers=headers)
         if response.status_code != 200:
             return JSONResponse({"error": response.json()}, status_code=401)
 
@@ -194,7 +1234,7 @@ async def login(request: Request):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
-@app.post("/api/forgot-password")
+@router.post("/api/forgot-password")
 async def forgot_password(request: Request):
     body = await request.json()
     email = body.get("email")
@@ -203,7 +1243,6 @@ async def forgot_password(request: Request):
         return JSONResponse({"error": "Please enter email"}, status_code=400)
 
     try:
-        url = f"{SUPABASE_URL}/auth/v1/recover"
         headers = {
             "apikey": SUPABASE_KEY,
             "Content-Type": "application/json"
@@ -213,7 +1252,7 @@ async def forgot_password(request: Request):
             # "redirectTo": "https://recover-password-de6c8.web.app/public/index.html"
         }
 
-        response = requests.post(url, json=payload, headers=headers)
+        response = await http_clients.post("supabase", "/auth/v1/recover", json=payload, headers=headers)
 
         if response.status_code == 200:
             return JSONResponse({"message": "📩 Password recovery email has been sent."})
@@ -225,21 +1264,28 @@ async def forgot_password(request: Request):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
-@app.get("/api/check-auth")
+@router.get("/api/check-auth")
 async def check_auth(request: Request):
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
     if not token:
         raise HTTPException(status_code=401, detail="Missing token")
 
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {token}",
-    }
-
-    res = requests.get(f"{SUPABASE_URL}/auth/v1/user", headers=headers)
-    if res.status_code != 200:
+    if not token_verifier.verify(token):
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    # Chữ ký hợp lệ; chỉ hỏi lại Supabase định kỳ để phát hiện token đã bị thu hồi
+    if token_verifier.needs_remote_check(token):
+        headers = {
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {token}",
+        }
+
+        res = await http_clients.get("supabase", "/auth/v1/user", headers=headers)
+        if res.status_code != 200:
+            token_verifier.mark_revoked(token)
+            raise HTTPException(status_code=401, detail="Invalid token")
+        token_verifier.mark_checked(token)
+
     return {"message": "Token is valid"}
 
 
@@ -255,50 +1301,53 @@ def normalize_city(city: str) -> str:
     return city.title()  # e.g., "ha noi" → "Ha Noi"
 
 
-@app.get("/api/weather")
-async def get_weather(city: str = Query(..., example="Hà Nội")):
-    city = normalize_city(city)
+class WeatherNotFound(Exception):
+    pass
+
 
-    url = "http://api.weatherapi.com/v1/current.json"
+weather_current_cache = AsyncTTLCache(
+    ttl=settings.weather_current_ttl,
+    stale_ttl=settings.weather_stale_ttl,
+    max_entries=settings.weather_cache_size
+)
+weather_forecast_cache = AsyncTTLCache(
+    ttl=settings.weather_forecast_ttl,
+    stale_ttl=settings.weather_stale_ttl,
+    max_entries=settings.weather_cache_size
+)
+
+
+async def fetch_current_weather(city: str):
     params = {
         "key": WEATHER_API_KEY,
         "q": city,
         "aqi": "no"
     }
 
-    try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-
-        if "error" in data:
-            return JSONResponse(status_code=404, content={"error": data["error"]["message"]})
+    resp = await http_clients.get("weather", "/v1/current.json", params=params)
+    resp.raise_for_status()
+    data = resp.json()
 
-        city_name = data["location"]["name"]
-        city_slug = remove_accents(city_name).lower().replace(" ", "-")
+    if "error" in data:
+        raise WeatherNotFound(data["error"]["message"])
 
-        return {
-            "city": city_name,
-            "city_slug": city_slug,
-            "country": data["location"]["country"],
-            "localtime": data["location"]["localtime"],
-            "temp_c": data["current"]["temp_c"],
-            "condition": data["current"]["condition"]["text"],
-            "icon": data["current"]["condition"]["icon"],
-            "humidity": data["current"]["humidity"],
-            "wind_kph": data["current"]["wind_kph"]
-        }
-
-    except httpx.HTTPError as e:
-        return JSONResponse(status_code=500, content={"error": str(e)})
+    city_name = data["location"]["name"]
+    city_slug = remove_accents(city_name).lower().replace(" ", "-")
 
+    return {
+        "city": city_name,
+        "city_slug": city_slug,
+        "country": data["location"]["country"],
+        "localtime": data["location"]["localtime"],
+        "temp_c": data["current"]["temp_c"],
+        "condition": data["current"]["condition"]["text"],
+        "icon": data["current"]["condition"]["icon"],
+        "humidity": data["current"]["humidity"],
+        "wind_kph": data["current"]["wind_kph"]
+    }
 
-@app.get("/api/weather/forecast")
-async def get_weather_forecast(city: str = Query(..., example="Hà Nội")):
-    city = normalize_city(city)
 
-    url = "http://api.weatherapi.com/v1/forecast.json"
+async def fetch_weather_forecast(city: str):
     params = {
         "key": WEATHER_API_KEY,
         "q": city,
@@ -306,52 +1355,73 @@ async def get_weather_forecast(city: str = Query(..., example="Hà Nội")):
         "aqi": "no"
     }
 
+    resp = await http_clients.get("weather", "/v1/forecast.json", params=params)
+    resp.raise_for_status()
+    data = resp.json()
+
+    if "error" in data:
+        raise WeatherNotFound(data["error"]["message"])
+
+    forecast = [
+        {
+            "date": item["date"],
+            "avg_temp_c": item["day"]["avgtemp_c"],
+            "condition": item["day"]["condition"]["text"],
+            "icon": item["day"]["condition"]["icon"]
+        }
+        for item in data["forecast"]["forecastday"]
+    ]
+
+    return {
+        "city": data["location"]["name"],
+        "city_slug": remove_accents(data["location"]["name"]).lower().replace(" ", "-"),
+        "country": data["location"]["country"],
+        "forecast": forecast
+    }
+
+
+@router.get("/api/weather")
+async def get_weather(city: str = Query(..., example="Hà Nội")):
+    city = normalize_city(city)
+
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(url, params=params)
-            resp.raise_for_status()
-            data = resp.json()
+        return await weather_current_cache.get(city, lambda: fetch_current_weather(city))
 
-        if "error" in data:
-            return JSONResponse(status_code=404, content={"error": data["error"]["message"]})
+    except WeatherNotFound as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    except http_error() as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
 
-        forecast = [
-            {
-                "date": item["date"],
-                "avg_temp_c": item["day"]["avgtemp_c"],
-                "condition": item["day"]["condition"]["text"],
-                "icon": item["day"]["condition"]["icon"]
-            }
-            for item in data["forecast"]["forecastday"]
-        ]
 
-        return {
-            "city": data["location"]["name"],
-            "city_slug": remove_accents(data["location"]["name"]).lower().replace(" ", "-"),
-            "country": data["location"]["country"],
-            "forecast": forecast
-        }
+@router.get("/api/weather/forecast")
+async def get_weather_forecast(city: str = Query(..., example="Hà Nội")):
+    city = normalize_city(city)
 
-    except httpx.HTTPError as e:
+    try:
+        return await weather_forecast_cache.get(city, lambda: fetch_weather_forecast(city))
+
+    except WeatherNotFound as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    except http_error() as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
+@router.get("/api/weather/stats")
+def get_weather_stats():
+    return {
+        "current": weather_current_cache.snapshot(),
+        "forecast": weather_forecast_cache.snapshot()
+    }
+
+
 def decode_token(token: str):
-    try:
-        payload = jwt.decode(
-            token,
-            SUPABASE_JWT_SECRET,
-            algorithms=["HS256"],
-            options={"verify_aud": False}
-        )
-        print("✅ Token payload:", payload)
-        return payload.get("sub")
-    except Exception as e:
-        print("❌ Token decode error:", e)
+    claims = token_verifier.verify(token)
+    if claims is None:
         return None
+    return claims.get("sub")
 
 
-@app.get("/api/me")
+@router.get("/api/me")
 async def get_current_user(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -364,22 +1434,18 @@ async def get_current_user(authorization: str = Header(None)):
 
     try:
         # Chỉ query user_profiles thôi, không cần đụng auth.users
-        result = supabase.table("user_profiles") \
-            .select("*") \
-            .eq("user_id", user_id) \
-            .limit(1) \
-            .execute()
+        profile = await profiles.get(user_id)
 
-        if not result.data:
+        if not profile:
             return JSONResponse({"error": "No user information yet"}, status_code=404)
-        return JSONResponse(result.data[0])
+        return JSONResponse(profile)
 
     except Exception as e:
-        print("❌ Lỗi lấy user:", e)
+        logger.error("❌ Lỗi lấy user: %s", e)
         return JSONResponse({"error": "Server error"}, status_code=500)
 
 
-@app.patch("/api/update-profile")
+@router.patch("/api/update-profile")
 async def update_profile(request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -401,19 +1467,16 @@ async def update_profile(request: Request, authorization: str = Header(None)):
         if not update_data:
             return JSONResponse({"error": "No data to update"}, status_code=400)
 
-        result = supabase.table("user_profiles") \
-            .update(update_data) \
-            .eq("user_id", user_id) \
-            .execute()
+        data = await profiles.update(user_id, update_data)
 
-        return JSONResponse({"message": "Updated successfully", "data": result.data})
+        return JSONResponse({"message": "Updated successfully", "data": data})
 
     except Exception as e:
-        print("❌ Lỗi cập nhật profile:", e)
+        logger.error("❌ Lỗi cập nhật profile: %s", e)
         return JSONResponse({"error": "Error server"}, status_code=500)
 
 
-@app.post("/api/create-profile")
+@router.post("/api/create-profile")
 async def create_profile(request: Request):
     try:
         body = await request.json()
@@ -427,18 +1490,41 @@ async def create_profile(request: Request):
             "role": "user"
         }
 
-        result = supabase.table("user_profiles").insert(insert_data).execute()
+        await profiles.create(insert_data)
 
         return JSONResponse({"message": "User profile created successfully."})
 
     except Exception as e:
-        print("❌ Error creating profile:", e)
+        logger.error("❌ Error creating profile: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
 #api for dashboard
-@app.get("/api/dashboard")
-def get_dashboard_data(authorization: str = Header(None)):
-    #Get all data from table "farm" and "sensor"
+DASHBOARD_PAGE_MAX = settings.dashboard_page_max
+
+
+def dashboard_columns(repo, fields: str):
+    if not fields:
+        return list(repo.columns)
+    columns = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [c for c in columns if c not in repo.columns]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    # Luôn cần cột khóa để tạo cursor cho trang sau
+    if repo.key not in columns:
+        columns.insert(0, repo.key)
+    return columns
+
+
+async def dashboard_page(repo, after: str, limit: int, columns):
+    # Lấy dư một dòng để biết còn trang sau hay không
+    rows = await repo.page(after, limit + 1, columns)
+    next_cursor = rows[limit - 1][repo.key] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+@router.get("/api/dashboard")
+async def get_dashboard_data(limit: int = Query(50, ge=1), authorization: str = Header(None)):
+    #Get first page of "farm", "sensor" and "user_profiles"
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
 
@@ -448,23 +1534,98 @@ def get_dashboard_data(authorization: str = Header(None)):
     if not user_id:
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
+    limit = min(limit, DASHBOARD_PAGE_MAX)
+
     try:
         # Fetch data from the necessary tables
-        farms = supabase.table("farm").select("*", count="exact").execute()
-        sensors = supabase.table("sensor").select("*", count="exact").execute()
-        users = supabase.table("user_profiles").select("*", count="exact").execute()
+        (farms, farms_next), (sensors, sensors_next), (users, users_next) = await asyncio.gather(
+            dashboard_page(farms_repo, None, limit, list(farms_repo.columns)),
+            dashboard_page(sensors_repo, None, limit, list(sensors_repo.columns)),
+            dashboard_page(profiles, None, limit, list(profiles.columns))
+        )
 
         return JSONResponse({
-            "farms": farms.data,
-            "sensors": sensors.data,
-            "users": users.data
+            "farms": farms,
+            "sensors": sensors,
+            "users": users,
+            "next": {
+                "farms": farms_next,
+                "sensors": sensors_next,
+                "users": users_next
+            }
         })
 
     except Exception as e:
-        print("❌ Error fetching dashboard data:", e)
+        logger.error("❌ Error fetching dashboard data: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+
+@router.get("/api/dashboard/summary")
+async def get_dashboard_summary(authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    try:
+        # dashboard_counters được trigger cập nhật dần (xem schema.sql), không quét toàn bảng
+        rows = await dashboard_repo.counters()
+
+        summary = {}
+        for row in rows:
+            summary.setdefault(row["dimension"], {})[row["bucket"]] = row["count"]
+
+        return JSONResponse({
+            "totals": summary.get("totals", {}),
+            "sensors_by_status": summary.get("sensor_status", {}),
+            "sensors_by_connectivity": summary.get("sensor_connectivity", {}),
+            "users_by_province": summary.get("user_province", {})
+        })
+
+    except Exception as e:
+        logger.error("❌ Error fetching dashboard summary: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+
+@router.get("/api/dashboard/{resource}")
+async def get_dashboard_list(
+    resource: str,
+    after: str = Query(None),
+    limit: int = Query(50, ge=1),
+    fields: str = Query(None),
+    authorization: str = Header(None)
+):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    repo = {"farms": farms_repo, "sensors": sensors_repo, "users": profiles}.get(resource)
+    if repo is None:
+        return JSONResponse({"error": "Unknown resource"}, status_code=404)
+
+    try:
+        columns = dashboard_columns(repo, fields)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        items, next_cursor = await dashboard_page(repo, after, min(limit, DASHBOARD_PAGE_MAX), columns)
+        return JSONResponse({"items": items, "next_cursor": next_cursor})
+
+    except Exception as e:
+        logger.error("❌ Error fetching dashboard list: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.post("/api/farm")
+@router.post("/api/farm")
 async def create_farm(request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -484,15 +1645,15 @@ async def create_farm(request: Request, authorization: str = Header(None)):
             "user_own": user_id,
         }
 
-        result = supabase.table("farm").insert(insert_data).execute()
+        data = await farms_repo.create(insert_data)
 
-        return JSONResponse({"message": "Farm created successfully.", "data": result.data})
+        return JSONResponse({"message": "Farm created successfully.", "data": data})
 
     except Exception as e:
-        print("❌ Error creating farm:", e)
+        logger.error("❌ Error creating farm: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
     
-@app.post("/api/sensor")
+@router.post("/api/sensor")
 async def create_sensor(request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -509,15 +1670,8 @@ async def create_sensor(request: Request, authorization: str = Header(None)):
         # Handle farm_id directly if provided, otherwise use farm_name
         farm_id = body.get("farm_id")
         if not farm_id and body.get("farm_name"):
-            farm_result = supabase.table("farm") \
-                .select("farm_id") \
-                .eq("farm_name", body.get("farm_name")) \
-                .limit(1) \
-                .execute()
-            
-            if farm_result.data:
-                farm_id = farm_result.data[0]['farm_id']
-            else:
+            farm_id = await farms_repo.find_id_by_name(body.get("farm_name"))
+            if not farm_id:
                 return JSONResponse({"error": "Farm not found"}, status_code=404)
 
         insert_data = {
@@ -532,15 +1686,370 @@ async def create_sensor(request: Request, authorization: str = Header(None)):
             "link": body.get("link", ""),
         }
 
-        result = supabase.table("sensor").insert(insert_data).execute()
+        try:
+            data = await sensors_repo.create(insert_data)
+        except outage_errors() as e:
+            # sensor_id do DB sinh nên trả về spool_ref để client đối chiếu sau khi replay
+            logger.warning("⚠️ Supabase unreachable, spooling new sensor: %s", e)
+            insert_data["spool_ref"] = str(uuid.uuid4())
+            try:
+                await asyncio.to_thread(spool.append, "sensor_creates", [insert_data])
+            except SpoolFull as e:
+                return spool_full_response(e)
+            return queued_response("Sensor creation queued.", spool_ref=insert_data["spool_ref"])
 
-        return JSONResponse({"message": "Sensor created successfully.", "data": result.data})
+        for row in data:
+            await record_status_change(row["sensor_id"], row.get("farm_id"), None, row.get("status"))
+
+        return JSONResponse({"message": "Sensor created successfully.", "data": data})
 
     except Exception as e:
-        print("❌ Error creating sensor:", e)
+        logger.error("❌ Error creating sensor: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.get("/api/sensor/{sensor_id}")
+SENSOR_BULK_CHUNK = settings.sensor_bulk_chunk
+SENSOR_BULK_MAX = settings.sensor_bulk_max
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def read_bulk_items(request: Request):
+    body = await request.json()
+    items = body.get("sensors") if isinstance(body, dict) else body
+    if not isinstance(items, list) or not items:
+        raise ValueError("sensors must be a non-empty list")
+    if len(items) > SENSOR_BULK_MAX:
+        raise ValueError(f"At most {SENSOR_BULK_MAX} sensors per request")
+    return items
+
+
+async def update_sensor_changes(items, build_changes):
+    # Một câu UPDATE mỗi chunk, chỉ gửi sensor_id và các cột thay đổi: không đọc-trộn-ghi đè cả dòng
+    # (mất cập nhật của heartbeat/rule chen giữa) và không tạo lại sensor vừa bị xóa
+    results = [None] * len(items)
+    current_time = datetime.now(timezone.utc).isoformat()
+
+    for start in range(0, len(items), SENSOR_BULK_CHUNK):
+        rows, owners, seen = [], {}, set()
+        for index, item in enumerate(items[start:start + SENSOR_BULK_CHUNK], start):
+            sensor_id = str(item.get("sensor_id")) if isinstance(item, dict) and item.get("sensor_id") is not None else None
+            if not sensor_id:
+                results[index] = {"index": index, "status": "error", "error": "sensor_id is required"}
+                continue
+            if sensor_id in seen:
+                results[index] = {"index": index, "sensor_id": sensor_id, "status": "error", "error": "Duplicate sensor_id in batch"}
+                continue
+            changes = build_changes(item)
+            if not changes:
+                results[index] = {"index": index, "sensor_id": sensor_id, "status": "error", "error": "No valid fields provided"}
+                continue
+            seen.add(sensor_id)
+            rows.append({"sensor_id": sensor_id, **changes, "latest_updated": current_time})
+            owners[sensor_id] = index
+
+        if not rows:
+            continue
+
+        # Như update_sensor_or_spool: sensor còn thay đổi nằm trong spool thì xếp sau chúng
+        try:
+            behind = await asyncio.to_thread(spool.pending_keys, "sensor_updates", list(owners))
+        except Exception as e:
+            logger.error("❌ Error reading spool: %s", e)
+            for sensor_id, index in owners.items():
+                results[index] = {"index": index, "sensor_id": sensor_id, "status": "error", "error": "Server error."}
+            continue
+        queued = [row for row in rows if row["sensor_id"] in behind]
+        rows = [row for row in rows if row["sensor_id"] not in behind]
+
+        saved = []
+        if rows:
+            try:
+                saved = await sensors_repo.update_many(rows)
+            except outage_errors() as e:
+                logger.warning("⚠️ Supabase unreachable, spooling %d sensor updates: %s", len(rows), e)
+                queued += rows
+            except Exception as e:
+                logger.error("❌ Error updating sensors: %s", e)
+                for row in rows:
+                    index = owners.pop(row["sensor_id"])
+                    results[index] = {"index": index, "sensor_id": row["sensor_id"], "status": "error", "error": "Server error."}
+
+        if queued:
+            spooled = [{"sensor_id": row["sensor_id"], "changes": {k: v for k, v in row.items() if k != "sensor_id"}}
+                       for row in queued]
+            try:
+                await asyncio.to_thread(spool.append, "sensor_updates", spooled)
+                outcome = {"status": "queued"}
+            except SpoolFull as e:
+                logger.error("❌ %s", e)
+                outcome = {"status": "error", "error": "Service temporarily unavailable, try again later."}
+            for row in queued:
+                index = owners.pop(row["sensor_id"])
+                results[index] = {"index": index, "sensor_id": row["sensor_id"], **outcome}
+
+        for row in saved:
+            old_status = row.pop("old_status", None)
+            sensor_id = str(row["sensor_id"])
+            index = owners.get(sensor_id)
+            if index is None:
+                continue
+            await record_status_change(sensor_id, row.get("farm_id"), old_status, row.get("status"))
+            results[index] = {"index": index, "sensor_id": sensor_id, "status": "success", "data": row}
+
+        for sensor_id, index in owners.items():
+            if results[index] is None:
+                results[index] = {"index": index, "sensor_id": sensor_id, "status": "error", "error": "Sensor not found"}
+
+    return results
+
+
+def bulk_response(results):
+    succeeded = sum(1 for r in results if r["status"] == "success")
+    queued = sum(1 for r in results if r["status"] == "queued")
+    return JSONResponse({"succeeded": succeeded, "queued": queued, "failed": len(results) - succeeded - queued,
+                         "results": results})
+
+
+def created_key(row: dict):
+    return (row.get("sensor_name"), row.get("sensor_type"), str(row.get("farm_id")), row.get("link"))
+
+
+@router.post("/api/sensor/bulk")
+async def create_sensors_bulk(request: Request, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    try:
+        items = await read_bulk_items(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        current_time = datetime.now(timezone.utc).isoformat()
+
+        # Một query duy nhất cho mọi farm_name trong batch
+        names = sorted({item["farm_name"] for item in items
+                        if isinstance(item, dict) and not item.get("farm_id") and item.get("farm_name")})
+        farm_ids = await farms_repo.find_ids_by_names(names)
+
+        results = [None] * len(items)
+        pending = []
+        for index, body in enumerate(items):
+            if not isinstance(body, dict) or not body.get("sensor_name") or not body.get("sensor_type") or not body.get("link"):
+                results[index] = {"index": index, "status": "error", "error": "Sensor name, sensor type, and link are required"}
+                continue
+
+            farm_id = body.get("farm_id")
+            if not farm_id and body.get("farm_name"):
+                farm_id = farm_ids.get(body["farm_name"])
+                if not farm_id:
+                    results[index] = {"index": index, "status": "error", "error": "Farm not found"}
+                    continue
+
+            pending.append((index, {
+                "sensor_name": body["sensor_name"],
+                "sensor_type": body["sensor_type"],
+                "farm_id": farm_id,
+                "location": body.get("location", ""),
+                "connectivity": body.get("connectivity", "offline"),
+                "status": body.get("status", "normal"),
+                "latest_updated": current_time,
+                "logs": "Sensor created successfully.",
+                "link": body.get("link", ""),
+            }))
+
+        for chunk in chunked(pending, SENSOR_BULK_CHUNK):
+            try:
+                data = await sensors_repo.create_many([row for _, row in chunk])
+            except outage_errors() as e:
+                # Giống tạo từng sensor: ghi vào spool, trả spool_ref để client đối chiếu sau khi replay
+                logger.warning("⚠️ Supabase unreachable, spooling %d new sensors: %s", len(chunk), e)
+                for _, row in chunk:
+                    row["spool_ref"] = str(uuid.uuid4())
+                try:
+                    await asyncio.to_thread(spool.append, "sensor_creates", [row for _, row in chunk])
+                except SpoolFull as full:
+                    logger.error("❌ %s", full)
+                    for index, _ in chunk:
+                        results[index] = {"index": index, "status": "error",
+                                          "error": "Service temporarily unavailable, try again later."}
+                    continue
+                for index, row in chunk:
+                    results[index] = {"index": index, "status": "queued", "spool_ref": row["spool_ref"]}
+                continue
+            except Exception as e:
+                logger.error("❌ Error creating sensors: %s", e)
+                for index, _ in chunk:
+                    results[index] = {"index": index, "status": "error", "error": "Server error."}
+                continue
+
+            # Ghép dòng trả về với mục gửi lên theo nội dung, không dựa vào số dòng/thứ tự của PostgREST
+            waiting = {}
+            for index, row in chunk:
+                waiting.setdefault(created_key(row), []).append(index)
+            for row in data:
+                indexes = waiting.get(created_key(row))
+                if not indexes:
+                    continue
+                index = indexes.pop(0)
+                await record_status_change(row["sensor_id"], row.get("farm_id"), None, row.get("status"))
+                results[index] = {"index": index, "sensor_id": row["sensor_id"], "status": "success", "data": row}
+            if len(data) != len(chunk):
+                logger.error("❌ Bulk sensor insert returned %d rows for %d sensors", len(data), len(chunk))
+            for index, _ in chunk:
+                if results[index] is None:
+                    results[index] = {"index": index, "status": "error", "error": "Sensor was not returned by the database"}
+
+        return bulk_response(results)
+
+    except Exception as e:
+        logger.error("❌ Error creating sensors: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+
+@router.patch("/api/sensor/bulk")
+async def update_sensors_info_bulk(request: Request, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    try:
+        items = await read_bulk_items(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    def build_changes(item):
+        changes = {f: item[f] for f in ["sensor_name", "sensor_type", "location", "link"] if item.get(f)}
+        if changes:
+            changes["logs"] = "Sensor info updated successfully."
+        return changes
+
+    try:
+        return bulk_response(await update_sensor_changes(items, build_changes))
+
+    except Exception as e:
+        logger.error("❌ Error updating sensors: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+
+@router.patch("/api/sensor/bulk/update-data")
+async def update_sensors_data_bulk(request: Request, authorization: str = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    try:
+        items = await read_bulk_items(request)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    def build_changes(item):
+        # Chỉ ghi các trường được gửi lên, không xóa trường còn lại
+        changes = {f: item[f] for f in ["connectivity", "status"] if item.get(f)}
+        if changes:
+            changes["logs"] = "Sensor data updated successfully."
+        return changes
+
+    try:
+        return bulk_response(await update_sensor_changes(items, build_changes))
+
+    except Exception as e:
+        logger.error("❌ Error updating sensors: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+
+def parse_time(value: str):
+    # Nhận cả epoch (giây) lẫn ISO 8601
+    try:
+        return float(value)
+    except ValueError:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+
+async def query_series(sensor_id: str, t0: float, t1: float, points: int, method: str, metric: str = None):
+    # Chuỗi thời gian chỉ nằm ở leader (worker consume telemetry); follower hỏi leader qua LeaderRpc
+    if not is_leader():
+        return await leader_rpc.call("series", sensor_id=sensor_id, t0=t0, t1=t1, points=points,
+                                     method=method, metric=metric)
+    if not series_store.has(sensor_id):
+        return None
+    return series_store.query(sensor_id, t0, t1, points, method, metric)
+
+
+
+@router.get("/api/sensor/{sensor_id}/series")
+async def get_sensor_series(
+    sensor_id: str,
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    points: int = Query(300, ge=2, le=5000),
+    method: str = Query("minmax", pattern="^(minmax|lttb)$"),
+    metric: str = Query(None),
+    authorization: str = Header(None)
+):
+    if not authorization or not authorization.startswith("Bearer "):
+        return JSONResponse({"error": "Missing tokens"}, status_code=401)
+
+    token = authorization.replace("Bearer ", "").strip()
+    user_id = decode_token(token)
+
+    if not user_id:
+        return JSONResponse({"error": "Invalid token"}, status_code=403)
+
+    try:
+        t1 = parse_time(to) if to else datetime.now(timezone.utc).timestamp()
+        t0 = parse_time(from_) if from_ else t1 - series_store.retention
+    except ValueError:
+        return JSONResponse({"error": "Invalid time range"}, status_code=400)
+
+    if t0 >= t1:
+        return JSONResponse({"error": "Invalid time range"}, status_code=400)
+
+    try:
+        series = await query_series(sensor_id, t0, t1, points, method, metric)
+    except LeaderUnavailable as e:
+        logger.warning("⚠️ Series for sensor %s unavailable: %s", sensor_id, e)
+        return JSONResponse({"error": "Telemetry leader unavailable, retry shortly."}, status_code=503)
+    except Exception as e:
+        logger.error("❌ Error fetching sensor series: %s", e)
+        return JSONResponse({"error": "Server error."}, status_code=500)
+
+    if series is None:
+        return JSONResponse({"error": "Sensor not found"}, status_code=404)
+
+    return {
+        "sensor_id": sensor_id,
+        "from": t0,
+        "to": t1,
+        "points": points,
+        "method": method,
+        "series": series
+    }
+
+
+@router.get("/api/sensor/{sensor_id}")
 async def get_sensor(sensor_id: str, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -552,17 +2061,17 @@ async def get_sensor(sensor_id: str, authorization: str = Header(None)):
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
     try:
-        sensor = supabase.table("sensor").select("*").eq("sensor_id", sensor_id).execute()
-        if not sensor.data:
+        sensor = await sensors_repo.get(sensor_id)
+        if not sensor:
             return JSONResponse({"error": "Sensor not found"}, status_code=404)
 
-        return JSONResponse({"sensor": sensor.data[0]})
+        return JSONResponse({"sensor": sensor})
 
     except Exception as e:
-        print("❌ Error fetching sensor:", e)
+        logger.error("❌ Error fetching sensor: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.get("/api/farm/{farm_id}")
+@router.get("/api/farm/{farm_id}")
 async def get_farm(farm_id: str, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -574,18 +2083,18 @@ async def get_farm(farm_id: str, authorization: str = Header(None)):
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
     try:
-        farm = supabase.table("farm").select("*").eq("farm_id", farm_id).execute()
-        if not farm.data:
+        farm = await farms_repo.get(farm_id)
+        if not farm:
             return JSONResponse({"error": "Farm not found"}, status_code=404)
 
-        return JSONResponse({"farm": farm.data[0]})
+        return JSONResponse({"farm": farm})
 
     except Exception as e:
-        print("❌ Error fetching farm:", e)
+        logger.error("❌ Error fetching farm: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
 
-@app.patch("/api/farm/{farm_id}")
+@router.patch("/api/farm/{farm_id}")
 async def update_farm(farm_id: str, request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -603,18 +2112,18 @@ async def update_farm(farm_id: str, request: Request, authorization: str = Heade
         if not update_data:
             return JSONResponse({"error": "No valid fields provided"}, status_code=400)
 
-        result = supabase.table("farm").update(update_data).eq("farm_id", farm_id).execute()
-        if not result.data:
+        data = await farms_repo.update(farm_id, update_data)
+        if not data:
             return JSONResponse({"error": "Farm not found"}, status_code=404)
 
-        return JSONResponse({"message": "Farm updated successfully.", "data": result.data})
+        return JSONResponse({"message": "Farm updated successfully.", "data": data})
 
     except Exception as e:
-        print("❌ Error updating farm:", e)
+        logger.error("❌ Error updating farm: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
 #Thay đổi thông tin cảm biến
-@app.patch("/api/sensor/{sensor_id}")
+@router.patch("/api/sensor/{sensor_id}")
 async def update_sensor_info(sensor_id: str, request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -649,18 +2158,23 @@ async def update_sensor_info(sensor_id: str, request: Request, authorization: st
         if not any(body.get(field) for field in ["sensor_name", "sensor_type", "location", "link"]):
             return JSONResponse({"error": "No valid fields provided"}, status_code=400)
 
-        result = supabase.table("sensor").update(update_info).eq("sensor_id", sensor_id).execute()
-        if not result.data:
+        try:
+            data = await update_sensor_or_spool(sensor_id, update_info)
+        except SpoolFull as e:
+            return spool_full_response(e)
+        if data is None:
+            return queued_response("Sensor info update queued.")
+        if not data:
             return JSONResponse({"error": "Sensor not found"}, status_code=404)
 
-        return JSONResponse({"message": "Sensor info updated successfully.", "data": result.data})
+        return JSONResponse({"message": "Sensor info updated successfully.", "data": data})
 
     except Exception as e:
-        print("❌ Error updating sensor:", e)
+        logger.error("❌ Error updating sensor: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
 #Thay đổi dữ liệu của cảm biến
-@app.patch("/api/sensor/update-data/{sensor_id}")
+@router.patch("/api/sensor/update-data/{sensor_id}")
 async def update_sensor_data(sensor_id: str, request: Request, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -679,24 +2193,27 @@ async def update_sensor_data(sensor_id: str, request: Request, authorization: st
         if not body.get("connectivity") and not body.get("status"):
             return JSONResponse({"error": "No valid fields provided"}, status_code=400)
         
-        update_data = {
-            "connectivity": body.get("connectivity"),
-            "status": body.get("status"),
-            "latest_updated": current_time,
-            "logs": "Sensor data updated successfully."
-        }
-
-        result = supabase.table("sensor").update(update_data).eq("sensor_id", sensor_id).execute()
-        if not result.data:
+        # Chỉ ghi các trường được gửi lên: status=None sẽ kéo sensor ra khỏi rollup theo trạng thái
+        update_data = {f: body[f] for f in ["connectivity", "status"] if body.get(f)}
+        update_data["latest_updated"] = current_time
+        update_data["logs"] = "Sensor data updated successfully."
+
+        try:
+            data = await update_sensor_or_spool(sensor_id, update_data)
+        except SpoolFull as e:
+            return spool_full_response(e)
+        if data is None:
+            return queued_response("Sensor data update queued.")
+        if not data:
             return JSONResponse({"error": "Sensor not found"}, status_code=404)
 
-        return JSONResponse({"message": "Sensor data updated successfully.", "data": result.data})
+        return JSONResponse({"message": "Sensor data updated successfully.", "data": data})
 
     except Exception as e:
-        print("❌ Error updating sensor:", e)
+        logger.error("❌ Error updating sensor: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.get("/api/info")
+@router.get("/api/info")
 async def get_info(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -708,25 +2225,22 @@ async def get_info(authorization: str = Header(None)):
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
     try:
-        farms = supabase.table("farm").select("*").eq("user_own", user_id).execute()
-        if not farms.data:
+        farms = await farms_repo.list_by_owner_with_sensors(user_id)
+        if not farms:
             return JSONResponse({"farm": [], "sensors": []})
 
         sensors = []
 
-        for farm in farms.data:
-            sensor = supabase.table("sensor") \
-                .select("*").eq("farm_id", farm['farm_id']).execute()
-            if sensor.data:
-                sensors.extend(sensor.data)
+        for farm in farms:
+            sensors.extend(farm.pop("sensor", None) or [])
 
-        return JSONResponse({"farms": farms.data, "sensors": sensors})
+        return JSONResponse({"farms": farms, "sensors": sensors})
 
     except Exception as e:
-        print("❌ Error fetching info:", e)
+        logger.error("❌ Error fetching info: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.delete("/api/farm/{farm_id}")
+@router.delete("/api/farm/{farm_id}")
 async def delete_farm(farm_id: str, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -738,17 +2252,17 @@ async def delete_farm(farm_id: str, authorization: str = Header(None)):
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
     try:
-        result = supabase.table("farm").delete().eq("farm_id", farm_id).execute()
-        if not result.data:
+        data = await farms_repo.delete(farm_id)
+        if not data:
             return JSONResponse({"error": "Farm not found"}, status_code=404)
 
         return JSONResponse({"message": "Farm deleted successfully."})
 
     except Exception as e:
-        print("❌ Error deleting farm:", e)
+        logger.error("❌ Error deleting farm: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.delete("/api/sensor/{sensor_id}")
+@router.delete("/api/sensor/{sensor_id}")
 async def delete_sensor(sensor_id: str, authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -760,17 +2274,20 @@ async def delete_sensor(sensor_id: str, authorization: str = Header(None)):
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
     try:
-        result = supabase.table("sensor").delete().eq("sensor_id", sensor_id).execute()
-        if not result.data:
+        data = await sensors_repo.delete(sensor_id)
+        if not data:
             return JSONResponse({"error": "Sensor not found"}, status_code=404)
 
+        for row in data:
+            await record_status_change(sensor_id, row.get("farm_id"), row.get("status"), None)
+
         return JSONResponse({"message": "Sensor deleted successfully."})
 
     except Exception as e:
-        print("❌ Error deleting sensor:", e)
+        logger.error("❌ Error deleting sensor: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
-@app.get("/api/analytics/{farm_id}")
+@router.get("/api/analytics/{farm_id}")
 async def get_farm_analytics(farm_id: str, period: str = Query("7d", regex="^(7d|30d|90d)$"), authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         return JSONResponse({"error": "Missing tokens"}, status_code=401)
@@ -782,54 +2299,62 @@ async def get_farm_analytics(farm_id: str, period: str = Query("7d", regex="^(7d
         return JSONResponse({"error": "Invalid token"}, status_code=403)
 
     try:
-        # Get sensors for the farm
-        sensors = supabase.table("sensor").select("*").eq("farm_id", farm_id).execute()
-        
-        if not sensors.data:
+        # Đọc các bucket theo ngày đã tổng hợp sẵn thay vì quét sensor
+        days = 7 if period == "7d" else 30 if period == "30d" else 90
+        today = datetime.now(LOCAL_TZ).date()
+        start = today - timedelta(days=days - 1)
+
+        rows, previous = await asyncio.gather(
+            rollups.window(farm_id, start.isoformat(), today.isoformat()),
+            rollups.before(farm_id, start.isoformat())
+        )
+
+        if not rows and not previous:
             return JSONResponse({"analytics": []})
 
-        # Calculate current status counts
-        current_error_count = sum(1 for s in sensors.data if s.get('status') == 'error')
-        current_normal_count = sum(1 for s in sensors.data if s.get('status') == 'normal')
-        current_warning_count = sum(1 for s in sensors.data if s.get('status') == 'warning')
-        
-        # Generate historical data with realistic variations
-        days = 7 if period == "7d" else 30 if period == "30d" else 90
-        analytics_data = []
-        
-        now = datetime.now()
-        for i in range(days - 1, -1, -1):
-            date = now - timedelta(days=i)
-            
-            # Add realistic variation (±20%)
-            import random
-            variation = random.uniform(0.8, 1.2)
-            
-            error_count = max(0, int(current_error_count * variation))
-            warning_count = max(0, int(current_warning_count * variation))
-            normal_count = max(1, len(sensors.data) - error_count - warning_count)
-            
-            analytics_data.append({
-                "date": date.strftime("%b %d"),
-                "fullDate": date.strftime("%Y-%m-%d"),
-                "error": error_count + warning_count,  # Combine errors and warnings
-                "normal": normal_count,
-                "total": len(sensors.data)
-            })
-        
+        # numpy chỉ cần cho analytics: import ở request đầu tiên
+        from analytics import analytics_payload
+        analytics_data, summary = analytics_payload(rows, previous, today, days)
+
         return JSONResponse({
             "analytics": analytics_data,
-            "summary": {
-                "total_sensors": len(sensors.data),
-                "normal_sensors": current_normal_count,
-                "error_sensors": current_error_count,
-                "warning_sensors": current_warning_count
-            }
+            "summary": summary
         })
 
     except Exception as e:
-        print("❌ Error fetching analytics:", e)
+        logger.error("❌ Error fetching analytics: %s", e)
         return JSONResponse({"error": "Server error."}, status_code=500)
 
+def create_app() -> FastAPI:
+    """Builds the FastAPI app.
+
+    Logging, shared-memory state and clients are started in lifespan, not
+    here or at import, and the live components are exposed on app.state.
+    """
+    app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
+    app.add_middleware(EncodeTimingMiddleware, stats=encode_stats)
+    # SSE giữ kết nối hàng giờ nên không đưa vào histogram độ trễ
+    app.add_middleware(RequestMetricsMiddleware, histogram=request_latency, exclude=("/api/stream", "/metrics"))
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.include_router(router)
+    return app
+
+
+app = create_app()
+startup_seconds["import"] = time.perf_counter() - _import_started
+
 if __name__ == '__main__':
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import uvicorn
+
+    if SHARED_MODE:
+        # Nhiều process cần import string để uvicorn tự nạp app trong từng worker
+        uvicorn.run("backend:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
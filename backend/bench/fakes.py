@@ -0,0 +1,367 @@
+import asyncio
+from collections import Counter
+import random
+import threading
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import jwt
+import uvicorn
+
+
+def parse_filter(expr: str):
+    op, _, value = expr.partition(".")
+    if op == "in":
+        items = value.strip("()")
+        return op, [v.strip('"') for v in items.split(",")] if items else []
+    return op, value
+
+
+def matches(row: dict, filters) -> bool:
+    for column, (op, value) in filters:
+        current = row.get(column)
+        text = "" if current is None else str(current)
+        if op == "eq" and text != value:
+            return False
+        if op == "neq" and text == value:
+            return False
+        if op == "in" and text not in value:
+            return False
+        if op in ("gt", "gte", "lt", "lte"):
+            if current is None:
+                return False
+            a, b = (float(text), float(value)) if _numeric(text, value) else (text, value)
+            if op == "gt" and not a > b or op == "gte" and not a >= b \
+                    or op == "lt" and not a < b or op == "lte" and not a <= b:
+                return False
+        if op == "is" and value == "null" and current is not None:
+            return False
+    return True
+
+
+def _numeric(*values) -> bool:
+    try:
+        for v in values:
+            float(v)
+        return True
+    except ValueError:
+        return False
+
+
+def project(row: dict, select: str, tables: dict) -> dict:
+    if not select or select == "*":
+        return dict(row)
+    out = {}
+    for part in split_select(select):
+        part = part.strip()
+        if part == "*":
+            out.update(row)
+        elif "(" in part:
+            # Nhúng bảng con theo khóa ngoại <bảng cha>_id, ví dụ farm -> sensor(*)
+            child, inner = part.split("(", 1)
+            inner = inner[:-1]
+            fk = "farm_id" if child == "sensor" else None
+            out[child] = [project(r, inner, tables) for r in tables.get(child, [])
+                          if fk and str(r.get(fk)) == str(row.get(fk))]
+        elif part in row:
+            out[part] = row[part]
+    return out
+
+
+def split_select(select: str):
+    parts, depth, current = [], 0, ""
+    for ch in select:
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += ch == "("
+        depth -= ch == ")"
+        current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+class FakeSupabase:
+    """In-memory PostgREST + GoTrue subset, enough for every backend.py query.
+
+    Each request sleeps `latency` seconds (plus up to `jitter`) before it is
+    answered, to stand in for the network round trip to Supabase. Tokens
+    are HS256 JWTs signed with the same secret the backend verifies with.
+    """
+
+    KEYS = {"farm": "farm_id", "sensor": "sensor_id", "user_profiles": "user_id",
+            "irrigation_schedule": "job_id", "sensor_rules": "rule_id"}
+    SENSOR_UPDATE_COLUMNS = ("sensor_name", "sensor_type", "location", "link", "connectivity", "status", "logs",
+                             "latest_updated")
+
+    def __init__(self, secret: str, latency: float = 0.02, jitter: float = 0.005):
+        self.secret = secret
+        self.latency = latency
+        self.jitter = jitter
+        self.tables = {}
+        self.users = {}
+        self.requests = 0
+        self.app = self._build()
+
+    def seed(self, users: int = 10, farms_per_user: int = 20, sensors_per_farm: int = 10):
+        farm, sensor, profiles = [], [], []
+        statuses = ("normal", "normal", "normal", "warning", "error")
+        for u in range(users):
+            user_id = str(uuid.UUID(int=u + 1))
+            email = f"user{u}@bench.local"
+            self.users[email] = user_id
+            profiles.append({"user_id": user_id, "full_name": f"User {u}", "email": email, "address": "",
+                             "province": "Ha Noi", "phone_number": "", "role": "user"})
+            for f in range(farms_per_user):
+                farm_id = len(farm) + 1
+                farm.append({"farm_id": farm_id, "farm_name": f"Farm {u}-{f}", "location": "Ha Noi",
+                             "user_own": user_id})
+                for s in range(sensors_per_farm):
+                    sensor.append({
+                        "sensor_id": len(sensor) + 1, "sensor_name": f"S{farm_id}-{s}",
+                        "sensor_type": "soil_moisture", "farm_id": farm_id, "location": "",
+                        "connectivity": "online", "status": statuses[len(sensor) % len(statuses)],
+                        "latest_updated": "2024-01-01T00:00:00+00:00", "logs": "", "link": ""
+                    })
+        self.tables.update(farm=farm, sensor=sensor, user_profiles=profiles)
+        # Cùng các chiều/bucket mà seed trong schema.sql tạo ra và get_dashboard_summary đọc
+        counters = Counter()
+        for row in sensor:
+            counters["sensor_status", row["status"] or "unknown"] += 1
+            counters["sensor_connectivity", row["connectivity"] or "unknown"] += 1
+        for row in profiles:
+            counters["user_province", row["province"] or "unknown"] += 1
+        counters["totals", "farms"] = len(farm)
+        counters["totals", "sensors"] = len(sensor)
+        counters["totals", "users"] = len(profiles)
+        self.tables["dashboard_counters"] = [{"dimension": dimension, "bucket": bucket, "count": count}
+                                             for (dimension, bucket), count in counters.items()]
+
+    def _rpc_update_sensors(self, params: dict):
+        # Như hàm update_sensors trong schema.sql: chỉ cập nhật các cột có trong từng item,
+        # trả về dòng sau khi sửa kèm old_status
+        rows = {str(r["sensor_id"]): r for r in self.tables.get("sensor", [])}
+        out = []
+        for item in params.get("p_rows") or []:
+            row = rows.get(str(item.get("sensor_id")))
+            if row is None:
+                continue
+            old_status = row.get("status")
+            row.update({k: v for k, v in item.items() if k in self.SENSOR_UPDATE_COLUMNS})
+            out.append({**row, "old_status": old_status})
+        return out
+
+    def token_for(self, email: str) -> str:
+        now = int(time.time())
+        return jwt.encode({"sub": self.users[email], "email": email, "exp": now + 3600, "iat": now},
+                          self.secret, algorithm="HS256")
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+    def _build(self):
+        app = FastAPI()
+
+        def query_parts(request: Request):
+            filters, select, order, limit = [], "*", None, None
+            for key, value in request.query_params.multi_items():
+                if key == "select":
+                    select = value
+                elif key == "order":
+                    column, _, direction = value.partition(".")
+                    order = (column, direction.startswith("desc"))
+                elif key == "limit":
+                    limit = int(value)
+                elif key in ("on_conflict", "columns", "offset"):
+                    continue
+                else:
+                    filters.append((key, parse_filter(value)))
+            return filters, select, order, limit
+
+        @app.post("/rest/v1/rpc/{function}")
+        async def call_rpc(function: str, request: Request):
+            await self._delay()
+            handler = getattr(self, f"_rpc_{function}", None)
+            if handler is None:
+                return JSONResponse({"message": f"function {function} not found"}, status_code=404)
+            return JSONResponse(handler(await request.json()))
+
+        @app.get("/rest/v1/{table}")
+        async def select_rows(table: str, request: Request):
+            await self._delay()
+            filters, select, order, limit = query_parts(request)
+            rows = [r for r in self.tables.get(table, []) if matches(r, filters)]
+            if order:
+                column, desc = order
+                rows.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+            if limit is not None:
+                rows = rows[:limit]
+            return JSONResponse([project(r, select, self.tables) for r in rows])
+
+        @app.post("/rest/v1/{table}")
+        async def insert_rows(table: str, request: Request):
+            await self._delay()
+            body = await request.json()
+            rows = body if isinstance(body, list) else [body]
+            key = self.KEYS.get(table)
+            stored = self.tables.setdefault(table, [])
+            out = []
+            for row in rows:
+                row = dict(row)
+                if key and row.get(key) is None:
+                    row[key] = len(stored) + 1
+                existing = next((r for r in stored if key and str(r.get(key)) == str(row[key])), None) \
+                    if "merge-duplicates" in request.headers.get("prefer", "") else None
+                if existing is not None:
+                    existing.update(row)
+                    out.append(existing)
+                else:
+                    stored.append(row)
+                    out.append(row)
+            return JSONResponse(out, status_code=201)
+
+        @app.patch("/rest/v1/{table}")
+        async def update_rows(table: str, request: Request):
+            await self._delay()
+            filters, _, _, _ = query_parts(request)
+            changes = await request.json()
+            out = []
+            for row in self.tables.get(table, []):
+                if matches(row, filters):
+                    row.update(changes)
+                    out.append(row)
+            return JSONResponse(out)
+
+        @app.delete("/rest/v1/{table}")
+        async def delete_rows(table: str, request: Request):
+            await self._delay()
+            filters, _, _, _ = query_parts(request)
+            rows = self.tables.get(table, [])
+            gone = [r for r in rows if matches(r, filters)]
+            self.tables[table] = [r for r in rows if not matches(r, filters)]
+            return JSONResponse(gone)
+
+        @app.post("/auth/v1/token")
+        async def token(request: Request):
+            await self._delay()
+            body = await request.json()
+            email = body.get("email")
+            if email not in self.users:
+                return JSONResponse({"error": "invalid_grant"}, status_code=400)
+            return JSONResponse({"access_token": self.token_for(email), "token_type": "bearer",
+                                 "user": {"id": self.users[email], "email": email}})
+
+        @app.get("/auth/v1/user")
+        async def user(request: Request):
+            await self._delay()
+            token = request.headers.get("authorization", "").replace("Bearer ", "")
+            try:
+                claims = jwt.decode(token, self.secret, algorithms=["HS256"], options={"verify_aud": False})
+            except jwt.PyJWTError:
+                return JSONResponse({"error": "invalid token"}, status_code=401)
+            return JSONResponse({"id": claims["sub"], "email": claims.get("email")})
+
+        @app.post("/auth/v1/recover")
+        async def recover():
+            await self._delay()
+            return JSONResponse({})
+
+        return app
+
+
+class FakeWeather:
+    """weatherapi.com stand-in for /v1/current.json and /v1/forecast.json."""
+
+    def __init__(self, latency: float = 0.08):
+        self.latency = latency
+        self.requests = 0
+        self.app = self._build()
+
+    def _build(self):
+        app = FastAPI()
+
+        def location(q):
+            return {"name": q, "country": "Vietnam", "localtime": "2024-01-01 12:00"}
+
+        @app.get("/v1/current.json")
+        async def current(q: str = "Ha Noi"):
+            self.requests += 1
+            await asyncio.sleep(self.latency)
+            return {"location": location(q), "current": {
+                "temp_c": 30.0, "humidity": 70, "wind_kph": 10.0,
+                "condition": {"text": "Sunny", "icon": "//cdn.weatherapi.com/sunny.png"}}}
+
+        @app.get("/v1/forecast.json")
+        async def forecast(q: str = "Ha Noi", days: int = 4):
+            self.requests += 1
+            await asyncio.sleep(self.latency)
+            day = {"maxtemp_c": 33.0, "mintemp_c": 25.0, "avgtemp_c": 29.0, "avghumidity": 70,
+                   "daily_chance_of_rain": 20, "condition": {"text": "Sunny", "icon": ""}}
+            return {"location": location(q), "forecast": {"forecastday": [
+                {"date": f"2024-01-0{i + 1}", "day": day, "hour": []} for i in range(days)]}}
+
+        return app
+
+
+class MemoryMqttSink:
+    """Drop-in for MqttPublisher that keeps published messages in memory."""
+
+    def __init__(self, max_messages: int = 10000):
+        self.max_messages = max_messages
+        self.messages = []
+        self.connected = True
+        self.stats = {"published": 0, "acked": 0, "failed": 0, "reconnects": 0}
+
+    def start(self):
+        pass
+
+    def stop(self, timeout: float = 5.0):
+        pass
+
+    def publish(self, topic: str, payload: str, qos: int = None):
+        self.stats["published"] += 1
+        self.stats["acked"] += 1
+        if len(self.messages) < self.max_messages:
+            self.messages.append((topic, payload))
+
+
+class IdleConsumer:
+    """Stands in for RabbitConsumer; telemetry is injected directly instead."""
+
+    connected = True
+
+    def __init__(self):
+        self.stats = {"consumed": 0, "acked": 0, "rejected": 0, "reconnects": 0}
+
+    def start(self):
+        pass
+
+    async def stop(self, timeout: float = 10.0):
+        pass
+
+
+class ServerThread:
+    """Runs an ASGI app under uvicorn on its own thread and event loop."""
+
+    def __init__(self, app, port: int, host: str = "127.0.0.1"):
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning",
+                                                    access_log=False))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 10.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("fake server did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(5)
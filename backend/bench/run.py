@@ -0,0 +1,256 @@
+"""HTTP benchmark for backend.py against local fakes.
+
+    cd backend
+    python -m bench.run --duration 10 --concurrency 32 --out bench.json
+    python -m bench.run --compare bench.json
+
+Each scenario drives a request mix for `--duration` seconds with
+`--concurrency` workers and reports requests/s plus p50/p95/p99 latency per
+route. The app's own startup timings (import, lifespan, warm-up) are
+recorded in the report's meta. Results are JSON and carry the git commit they were measured at,
+so two runs can be compared with --compare.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+
+from bench.fakes import FakeSupabase, FakeWeather, ServerThread
+
+
+JWT_SECRET = "bench-jwt-secret-not-for-production-use"
+
+
+def scenarios(fake: FakeSupabase, seeded_sensors: int):
+    emails = list(fake.users)
+    tokens = {email: fake.token_for(email) for email in emails}
+    busiest = max(emails, key=lambda e: sum(1 for f in fake.tables["farm"] if f["user_own"] == fake.users[e]))
+
+    def auth(email):
+        return {"Authorization": f"Bearer {tokens[email]}"}
+
+    def dashboard():
+        return "GET", "/api/dashboard", {"params": {"limit": 50}, "headers": auth(random.choice(emails))}
+
+    def dashboard_summary():
+        return "GET", "/api/dashboard/summary", {"headers": auth(random.choice(emails))}
+
+    def info():
+        return "GET", "/api/info", {"headers": auth(busiest)}
+
+    def latest():
+        return "GET", "/api/latest", {"params": {"sensor_id": random.randint(1, seeded_sensors)}}
+
+    def pump():
+        return "POST", "/api/pump-on", {"json": {"command": "PUMP_ON", "duration": 1000,
+                                                 "pump_id": f"pump-{random.randint(1, 20)}"}}
+
+    def login():
+        return "POST", "/api/login", {"json": {"email": random.choice(emails), "password": "bench"}}
+
+    def weather():
+        return "GET", "/api/weather", {"params": {"city": random.choice(["Ha Noi", "Hue", "Da Nang"])}}
+
+    return {
+        "dashboard": [(dashboard, 3), (dashboard_summary, 1)],
+        "info_many_farms": [(info, 1)],
+        "latest_storm": [(latest, 1)],
+        "pump_commands": [(pump, 1)],
+        "login_burst": [(login, 1)],
+        "weather": [(weather, 1)],
+        "mixed": [(latest, 10), (dashboard, 2), (info, 2), (dashboard_summary, 1), (pump, 1), (login, 1),
+                  (weather, 1)],
+    }
+
+
+async def drive(base_url: str, mix, duration: float, concurrency: int):
+    makers = [m for m, _ in mix]
+    weights = [w for _, w in mix]
+    samples = {}
+    errors = {}
+    stop_at = time.perf_counter() + duration
+
+    async def worker(client):
+        while time.perf_counter() < stop_at:
+            method, path, kwargs = random.choices(makers, weights)[0]()
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            samples.setdefault(path, []).append(time.perf_counter() - start)
+            if not ok:
+                errors[path] = errors.get(path, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    routes = {}
+    for path, values in samples.items():
+        ms = np.array(values) * 1000
+        routes[path] = {
+            "requests": len(values),
+            "errors": errors.get(path, 0),
+            "rps": len(values) / elapsed,
+            "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "max_ms": float(ms.max()),
+        }
+    total = sum(len(v) for v in samples.values())
+    return {"elapsed_s": elapsed, "requests": total, "rps": total / elapsed, "routes": routes}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def start_app(args, supabase_url: str, weather_url: str):
+    env = {
+        **os.environ,
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_KEY": "bench-anon-key",
+        "SUPABASE_JWT_SECRET": JWT_SECRET,
+        "WEATHER_API_URL": weather_url,
+        "WEATHER_API_KEY": "bench",
+        "MQTT_TOPIC": "bench/pump",
+        "LOG_LEVEL": "WARNING",
+        "BENCH_APP_PORT": str(args.app_port),
+        "BENCH_SEED_SENSORS": str(args.seed_sensors),
+    }
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen([sys.executable, "-m", "bench.serve"], cwd=backend_dir, env=env)
+
+
+async def wait_ready(base_url: str, proc, timeout: float = 30):
+    # Trả về thời gian khởi động do app tự đo (import, lifespan, warm-up)
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"backend exited with code {proc.returncode}")
+            try:
+                if (await client.get("/")).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.05)
+        else:
+            raise RuntimeError("backend did not become ready")
+        while time.monotonic() < deadline:
+            startup = (await client.get("/api/ingest/stats")).json().get("startup", {})
+            if "warmup" in startup:
+                return startup
+            await asyncio.sleep(0.05)
+    raise RuntimeError("backend did not finish warm-up")
+
+
+def compare(baseline: dict, current: dict):
+    print(f"{'scenario':<18}{'route':<26}{'rps':>18}{'p50 ms':>20}{'p99 ms':>20}")
+    for name, result in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        for path, stats in result["routes"].items():
+            old = base["routes"].get(path)
+            if old is None:
+                continue
+            cells = []
+            for key in ("rps", "p50_ms", "p99_ms"):
+                change = (stats[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+                cells.append(f"{old[key]:.1f}->{stats[key]:.1f} ({change:+.0f}%)")
+            print(f"{name:<18}{path:<26}{cells[0]:>18}{cells[1]:>20}{cells[2]:>20}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--scenarios", default="all", help="comma-separated names, or 'all'")
+    parser.add_argument("--supabase-latency-ms", type=float, default=20)
+    parser.add_argument("--supabase-jitter-ms", type=float, default=5)
+    parser.add_argument("--weather-latency-ms", type=float, default=80)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--farms-per-user", type=int, default=20)
+    parser.add_argument("--sensors-per-farm", type=int, default=10)
+    parser.add_argument("--seed-sensors", type=int, default=1000)
+    parser.add_argument("--app-port", type=int, default=8600)
+    parser.add_argument("--fake-port", type=int, default=8601)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write results JSON here (default: stdout)")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    fake = FakeSupabase(JWT_SECRET, latency=args.supabase_latency_ms / 1000, jitter=args.supabase_jitter_ms / 1000)
+    fake.seed(args.users, args.farms_per_user, args.sensors_per_farm)
+    weather = FakeWeather(latency=args.weather_latency_ms / 1000)
+
+    fake_server = ServerThread(fake.app, args.fake_port)
+    weather_server = ServerThread(weather.app, args.fake_port + 1)
+    fake_server.start()
+    weather_server.start()
+
+    base_url = f"http://127.0.0.1:{args.app_port}"
+    launched = time.perf_counter()
+    proc = start_app(args, f"http://127.0.0.1:{args.fake_port}", f"http://127.0.0.1:{args.fake_port + 1}")
+    try:
+        startup = asyncio.run(wait_ready(base_url, proc))
+        # Bao gồm cả khởi động interpreter và bước seed telemetry của bench.serve
+        startup["until_warm_s"] = time.perf_counter() - launched
+        mixes = scenarios(fake, args.seed_sensors)
+        names = list(mixes) if args.scenarios == "all" else args.scenarios.split(",")
+        results = {}
+        for name in names:
+            print(f"▶ {name}", file=sys.stderr)
+            results[name] = asyncio.run(drive(base_url, mixes[name], args.duration, args.concurrency))
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        fake_server.stop()
+        weather_server.stop()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "args": vars(args),
+            "startup": startup,
+            "supabase_requests": fake.requests,
+            "weather_requests": weather.requests,
+        },
+        "scenarios": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
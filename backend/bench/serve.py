@@ -0,0 +1,38 @@
+"""Runs backend.py for a benchmark, with MQTT and RabbitMQ swapped for in-process stand-ins.
+
+Started by bench/run.py in its own process so the load generator and the
+fake upstreams do not share a CPU core with the app under test. Supabase
+and weatherapi are reached over HTTP at the URLs passed in the environment.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+
+import backend
+from bench.fakes import IdleConsumer, MemoryMqttSink
+
+
+async def seed_telemetry(sensors: int):
+    # Đổ sẵn mỗi sensor một bản tin để /api/latest và /api/stream có dữ liệu
+    for sensor_id in range(1, sensors + 1):
+        body = json.dumps({"sensor_id": sensor_id, "farm_id": (sensor_id - 1) // 10 + 1,
+                           "moisture": random.uniform(20, 80), "temperature": random.uniform(20, 35)})
+        await backend.ingest_message(body.encode())
+
+
+def main():
+    backend.mqtt_publisher = MemoryMqttSink()
+    backend.mq_consumer = IdleConsumer()
+    asyncio.run(seed_telemetry(int(os.getenv("BENCH_SEED_SENSORS", "1000"))))
+    uvicorn.run(backend.app, host="127.0.0.1", port=int(os.getenv("BENCH_APP_PORT", "8600")),
+                log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
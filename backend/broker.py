@@ -0,0 +1,83 @@
+import asyncio
+
+
+class Subscription:
+    __slots__ = ("queue", "sensor_id", "farm_id", "dropped")
+
+    def __init__(self, maxsize: int, sensor_id: str = None, farm_id: str = None):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.sensor_id = sensor_id
+        self.farm_id = farm_id
+        self.dropped = 0
+
+    async def get(self, timeout: float = None):
+        if timeout is None:
+            return await self.queue.get()
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class TelemetryBroker:
+    """In-process fan-out from the ingest path to streaming clients.
+
+    Subscribers are indexed by sensor_id and farm_id, so publishing only
+    touches the subscriptions that asked for that device. Each subscription
+    has a bounded queue; when a client falls behind, its oldest pending
+    event is dropped to make room. Must be used from the event loop thread.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._all = set()
+        self._by_sensor = {}
+        self._by_farm = {}
+        self.count = 0
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self, sensor_id: str = None, farm_id: str = None) -> Subscription:
+        sub = Subscription(self.queue_size, sensor_id, farm_id)
+        if sensor_id:
+            self._by_sensor.setdefault(sensor_id, set()).add(sub)
+        elif farm_id:
+            self._by_farm.setdefault(farm_id, set()).add(sub)
+        else:
+            self._all.add(sub)
+        self.count += 1
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        if sub.sensor_id:
+            self._discard(self._by_sensor, sub.sensor_id, sub)
+        elif sub.farm_id:
+            self._discard(self._by_farm, sub.farm_id, sub)
+        else:
+            self._all.discard(sub)
+        self.count -= 1
+
+    @staticmethod
+    def _discard(index: dict, key: str, sub: Subscription):
+        subs = index.get(key)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            index.pop(key, None)
+
+    def publish(self, event: str, sensor_id: str, farm_id: str = None):
+        self.stats["published"] += 1
+        self._deliver(self._all, event)
+        self._deliver(self._by_sensor.get(sensor_id), event)
+        if farm_id is not None:
+            self._deliver(self._by_farm.get(farm_id), event)
+
+    def _deliver(self, subs, event: str):
+        if not subs:
+            return
+        for sub in subs:
+            q = sub.queue
+            if q.full():
+                # Client chậm: bỏ bản tin cũ nhất, giữ bản mới
+                q.get_nowait()
+                sub.dropped += 1
+                self.stats["dropped"] += 1
+            q.put_nowait(event)
+            self.stats["delivered"] += 1
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+import asyncio
+import time
+
+
+class CacheEntry:
+    __slots__ = ("value", "expires", "stale_until")
+
+    def __init__(self, value, expires: float, stale_until: float):
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
+
+
+class AsyncTTLCache:
+    """TTL cache for async loaders with single-flight and stale-while-revalidate.
+
+    Concurrent misses for the same key share one in-flight fetch. Once an
+    entry is past `ttl` but still inside `stale_ttl`, the old value is
+    returned immediately and a single background refresh is started.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float = 0, max_entries: int = 1024):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "invalidations": 0,
+            "upstream_calls": 0,
+            "upstream_seconds_total": 0.0,
+            "upstream_seconds_max": 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key, fetch):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now < entry.expires:
+                self.stats["hits"] += 1
+                self._entries.move_to_end(key)
+                return entry.value
+            if now < entry.stale_until:
+                self.stats["stale_hits"] += 1
+                if key not in self._inflight:
+                    task = self._start_fetch(key, fetch)
+                    # Lỗi khi làm mới nền chỉ được đếm, client vẫn nhận dữ liệu cũ
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                return entry.value
+
+        self.stats["misses"] += 1
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            task = self._start_fetch(key, fetch)
+        return await asyncio.shield(task)
+
+    def set(self, key, value):
+        # Ghi đè cả fetch đang bay để kết quả cũ của nó không đè lên giá trị mới
+        self._inflight.pop(key, None)
+        self._store(key, value)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+            self._inflight.clear()
+        else:
+            self._entries.pop(key, None)
+            self._inflight.pop(key, None)
+        self.stats["invalidations"] += 1
+
+    def snapshot(self) -> dict:
+        calls = self.stats["upstream_calls"]
+        lookups = self.stats["hits"] + self.stats["stale_hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "hit_rate": (self.stats["hits"] + self.stats["stale_hits"]) / lookups if lookups else 0.0,
+            "upstream_seconds_avg": self.stats["upstream_seconds_total"] / calls if calls else 0.0,
+        }
+
+    def _start_fetch(self, key, fetch):
+        task = asyncio.ensure_future(self._fetch(key, fetch))
+        self._inflight[key] = task
+        return task
+
+    async def _fetch(self, key, fetch):
+        task = asyncio.current_task()
+        start = time.perf_counter()
+        try:
+            value = await fetch()
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            # Bị invalidate trong lúc đang fetch thì không lưu kết quả (có thể đã cũ)
+            current = self._inflight.get(key) is task
+            if current:
+                del self._inflight[key]
+            elapsed = time.perf_counter() - start
+            self.stats["upstream_calls"] += 1
+            self.stats["upstream_seconds_total"] += elapsed
+            self.stats["upstream_seconds_max"] = max(self.stats["upstream_seconds_max"], elapsed)
+
+        if current:
+            self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        self._entries[key] = CacheEntry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,151 @@
+import contextvars
+import importlib.util
+import json
+import time
+
+from fastapi.responses import JSONResponse
+
+if importlib.util.find_spec("orjson") is not None:
+    import orjson
+else:
+    orjson = None
+
+
+ID_FIELDS = ("sensor_id", "device_id", "farm_id")
+SCALARS = (str, int, float, bool, type(None))
+
+
+class InvalidMessage(ValueError):
+    pass
+
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj)
+
+
+def dumpb(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+class ReadingDecoder:
+    """Parses and validates one telemetry message from the broker.
+
+    A reading must be a flat JSON object: the id fields are strings or
+    integers and every other value is a scalar. Anything else raises
+    InvalidMessage, which the consumer turns into a reject. Decode time and
+    rejects are counted so they can be compared against the encode side.
+    """
+
+    def __init__(self, max_bytes: int = 65536):
+        self.max_bytes = max_bytes
+        self.stats = {"decoded": 0, "rejected": 0, "decode_seconds_total": 0.0, "bytes_total": 0}
+
+    def decode(self, body: bytes) -> dict:
+        start = time.perf_counter()
+        try:
+            if len(body) > self.max_bytes:
+                raise InvalidMessage(f"Message of {len(body)} bytes exceeds {self.max_bytes}")
+            try:
+                data = loads(body)
+            except ValueError as e:
+                raise InvalidMessage(f"Malformed JSON: {e}")
+            if not isinstance(data, dict):
+                raise InvalidMessage(f"Unexpected payload type: {type(data).__name__}")
+            for name, value in data.items():
+                if not isinstance(value, SCALARS):
+                    raise InvalidMessage(f"Field {name!r} must be a scalar")
+            for name in ID_FIELDS:
+                value = data.get(name)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int))):
+                    raise InvalidMessage(f"Field {name!r} must be a string or integer")
+        except InvalidMessage:
+            self.stats["rejected"] += 1
+            raise
+        finally:
+            self.stats["decode_seconds_total"] += time.perf_counter() - start
+            self.stats["bytes_total"] += len(body)
+
+        self.stats["decoded"] += 1
+        return data
+
+    def snapshot(self) -> dict:
+        n = self.stats["decoded"] + self.stats["rejected"]
+        return {
+            **self.stats,
+            "backend": "orjson" if orjson is not None else "json",
+            "decode_seconds_avg": self.stats["decode_seconds_total"] / n if n else 0.0,
+        }
+
+
+# Gom thời gian encode của mọi response trong một request, middleware gán nó cho route
+_encode_timer = contextvars.ContextVar("encode_timer", default=None)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        if orjson is not None:
+            body = orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        else:
+            body = super().render(content)
+        timer = _encode_timer.get()
+        if timer is not None:
+            timer[0] += time.perf_counter() - start
+            timer[1] += len(body)
+        return body
+
+
+class EncodeStats:
+    def __init__(self):
+        self.routes = {}
+
+    def record(self, route: str, seconds: float, size: int):
+        entry = self.routes.get(route)
+        if entry is None:
+            entry = self.routes[route] = {"responses": 0, "encode_seconds_total": 0.0,
+                                          "encode_seconds_max": 0.0, "bytes_total": 0}
+        entry["responses"] += 1
+        entry["encode_seconds_total"] += seconds
+        entry["encode_seconds_max"] = max(entry["encode_seconds_max"], seconds)
+        entry["bytes_total"] += size
+
+    def snapshot(self) -> dict:
+        return {
+            route: {**entry, "encode_seconds_avg": entry["encode_seconds_total"] / entry["responses"]}
+            for route, entry in self.routes.items()
+        }
+
+
+class EncodeTimingMiddleware:
+    """Plain ASGI middleware (streaming responses pass through untouched)."""
+
+    def __init__(self, app, stats: EncodeStats):
+        self.app = app
+        self.stats = stats
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timer = [0.0, 0]
+        token = _encode_timer.set(timer)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _encode_timer.reset(token)
+            if timer[1]:
+                route = scope.get("route")
+                self.stats.record(getattr(route, "path", "<unmatched>"), timer[0], timer[1])
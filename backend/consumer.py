@@ -0,0 +1,174 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+# Mỗi bản tin lỗi một dòng log: tách logger riêng để có thể lấy mẫu
+reject_log = logging.getLogger(__name__ + ".rejects")
+
+
+class RabbitConsumer:
+    """Consumes a fanout exchange on the running event loop.
+
+    Messages are handled one at a time in delivery order and acknowledged
+    manually, either one by one or in batches (`ack_batch` messages or every
+    `ack_interval` seconds, whichever comes first). A lost connection is
+    retried with exponential backoff, and stop() stops new deliveries,
+    finishes whatever was already prefetched, then closes the connection.
+    """
+
+    def __init__(self, handler, *, host: str, port: int = 5672, login: str = "guest",
+                 password: str = "guest", virtualhost: str = "/", exchange: str = "smart_farm_data",
+                 queue_name: str = None, prefetch: int = 100, ack_batch: int = 1,
+                 ack_interval: float = 1.0, backoff_initial: float = 1.0, backoff_max: float = 60.0):
+        self.handler = handler
+        self.connect_kwargs = {
+            "host": host,
+            "port": port,
+            "login": login,
+            "password": password,
+            "virtualhost": virtualhost,
+        }
+        self.exchange = exchange
+        self.queue_name = queue_name
+        self.prefetch = prefetch
+        self.ack_batch = max(1, ack_batch)
+        self.ack_interval = ack_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self._task = None
+        self._stopping = asyncio.Event()
+        self._unacked = None
+        self._unacked_count = 0
+        self.connected = False
+        self.stats = {
+            "consumed": 0,
+            "acked": 0,
+            "rejected": 0,
+            "reconnects": 0,
+        }
+
+    def start(self):
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        if self._task is None:
+            return
+        self._stopping.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ RabbitMQ consumer did not drain in time, cancelling")
+            self._task.cancel()
+        self._task = None
+
+    async def _sleep(self, delay: float):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        # aio-pika chỉ cần khi consumer thật sự chạy (worker leader), không import lúc khởi động
+        import aio_pika
+
+        logger.info("📡 RabbitMQ consumer starting...")
+        delay = self.backoff_initial
+
+        while not self._stopping.is_set():
+            try:
+                connection = await aio_pika.connect(**self.connect_kwargs)
+            except Exception as e:
+                logger.error("❌ Failed to connect to RabbitMQ: %s (retry in %.0fs)", e, delay)
+                await self._sleep(delay)
+                delay = min(delay * 2, self.backoff_max)
+                continue
+
+            delay = self.backoff_initial
+            try:
+                await self._consume(connection)
+            except Exception as e:
+                logger.error("❌ RabbitMQ consumer error: %s", e)
+            finally:
+                self.connected = False
+                if not connection.is_closed:
+                    await connection.close()
+
+            if not self._stopping.is_set():
+                self.stats["reconnects"] += 1
+                logger.warning("🔁 RabbitMQ connection lost, reconnecting in %.0fs...", delay)
+                await self._sleep(delay)
+
+        logger.info("🛑 RabbitMQ consumer stopped")
+
+    async def _consume(self, connection):
+        self._unacked = None
+        self._unacked_count = 0
+
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch)
+
+        exchange = await channel.declare_exchange(
+            self.exchange, "fanout", durable=True)
+
+        # Có tên queue thì dùng queue bền để không mất tin khi mất kết nối
+        if self.queue_name:
+            queue = await channel.declare_queue(self.queue_name, durable=True)
+        else:
+            queue = await channel.declare_queue(exclusive=True)
+        await queue.bind(exchange)
+
+        inbox = asyncio.Queue()
+        consumer_tag = await queue.consume(inbox.put)
+        # connection.closed() trả về chính future nội bộ của aio-pika: bọc shield để
+        # cancel ở finally không đánh dấu kết nối là đã đóng (và bỏ qua connection.close())
+        closed = asyncio.shield(connection.closed())
+        self.connected = True
+        logger.info('✅ Listening on exchange "%s"...', self.exchange)
+
+        try:
+            while not closed.done() and not self._stopping.is_set():
+                try:
+                    message = await asyncio.wait_for(inbox.get(), self.ack_interval)
+                except asyncio.TimeoutError:
+                    await self._flush_acks()
+                    continue
+                await self._handle(message)
+
+            if closed.done():
+                return
+
+            # Graceful drain: ngừng nhận tin mới, xử lý nốt các tin đã prefetch
+            await queue.cancel(consumer_tag)
+            while not inbox.empty():
+                await self._handle(inbox.get_nowait())
+            await self._flush_acks()
+        finally:
+            closed.cancel()
+
+    async def _handle(self, message):
+        self.stats["consumed"] += 1
+        try:
+            await self.handler(message.body)
+        except Exception as e:
+            reject_log.warning("[!] Rejecting message: %s", e)
+            await self._flush_acks()
+            await message.reject(requeue=False)
+            self.stats["rejected"] += 1
+            return
+
+        self._unacked = message
+        self._unacked_count += 1
+        if self._unacked_count >= self.ack_batch:
+            await self._flush_acks()
+
+    async def _flush_acks(self):
+        if self._unacked is None:
+            return
+        await self._unacked.ack(multiple=self._unacked_count > 1)
+        self.stats["acked"] += self._unacked_count
+        self._unacked = None
+        self._unacked_count = 0
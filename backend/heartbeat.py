@@ -0,0 +1,140 @@
+import asyncio
+import heapq
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class HeartbeatTracker:
+    """Flips devices online/offline from the ingest stream alone.
+
+    seen() only stores the device's last-seen time; the heap holds at most
+    one deadline per online device. When a deadline surfaces the device is
+    either re-armed at last_seen + timeout (it kept sending) or marked
+    offline. Only real transitions are queued, and the queue is keyed by
+    device, so a device that flaps inside one flush window costs one write.
+    """
+
+    def __init__(self, flush_fn, timeout: float = 120, flush_interval: float = 5.0,
+                 batch_size: int = 200, max_devices: int = 100000):
+        self.flush_fn = flush_fn
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_devices = max_devices
+        self._last_seen = {}
+        self._online = set()
+        self._heap = []
+        self._pending = {}
+        self._task = None
+        self.stats = {
+            "online_transitions": 0,
+            "offline_transitions": 0,
+            "writes": 0,
+            "failed_writes": 0,
+            "ignored": 0,
+        }
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def seed(self, sensor_ids, now: float = None):
+        # Sensor đang "online" trong DB lúc khởi động: cho một chu kỳ timeout trước khi đánh offline
+        now = time.time() if now is None else now
+        for sensor_id in sensor_ids:
+            sensor_id = str(sensor_id)
+            if sensor_id in self._online:
+                continue
+            self._last_seen[sensor_id] = now
+            self._online.add(sensor_id)
+            heapq.heappush(self._heap, (now + self.timeout, sensor_id))
+
+    def seen(self, sensor_id: str, ts: float = None):
+        ts = time.time() if ts is None else ts
+        if sensor_id not in self._last_seen and len(self._last_seen) >= self.max_devices:
+            self.stats["ignored"] += 1
+            return
+        last = self._last_seen.get(sensor_id)
+        if last is None or ts > last:
+            self._last_seen[sensor_id] = ts
+        if sensor_id not in self._online:
+            self._online.add(sensor_id)
+            self._pending[sensor_id] = ONLINE
+            self.stats["online_transitions"] += 1
+            heapq.heappush(self._heap, (self._last_seen[sensor_id] + self.timeout, sensor_id))
+
+    def expire(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            _, sensor_id = heapq.heappop(self._heap)
+            deadline = self._last_seen.get(sensor_id, 0) + self.timeout
+            if deadline > now:
+                # Thiết bị vẫn gửi dữ liệu sau khi entry này được đặt: hẹn lại
+                heapq.heappush(self._heap, (deadline, sensor_id))
+                continue
+            self._online.discard(sensor_id)
+            self._pending[sensor_id] = OFFLINE
+            self.stats["offline_transitions"] += 1
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "tracked": len(self._last_seen),
+            "online": len(self._online),
+            "pending": len(self._pending),
+        }
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        by_state = {}
+        for sensor_id, state in pending.items():
+            by_state.setdefault(state, []).append(sensor_id)
+
+        for state, ids in by_state.items():
+            for i in range(0, len(ids), self.batch_size):
+                chunk = ids[i:i + self.batch_size]
+                try:
+                    await self.flush_fn(chunk, state)
+                    self.stats["writes"] += len(chunk)
+                except Exception as e:
+                    logger.error("❌ Heartbeat flush failed for %d sensors: %s", len(chunk), e)
+                    self.stats["failed_writes"] += len(chunk)
+                    # Đưa lại vào hàng chờ trừ khi đã có chuyển trạng thái mới hơn
+                    for sensor_id in chunk:
+                        self._pending.setdefault(sensor_id, state)
+
+    async def _run(self):
+        tick = min(1.0, self.flush_interval)
+        last_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(tick)
+            self.expire(time.time())
+            if time.monotonic() - last_flush >= self.flush_interval:
+                last_flush = time.monotonic()
+                await self.flush()
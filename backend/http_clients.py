@@ -0,0 +1,89 @@
+from typing import TYPE_CHECKING
+import asyncio
+import importlib.util
+import time
+
+if TYPE_CHECKING:
+    import httpx
+
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class Upstream:
+    __slots__ = ("name", "base_url", "timeout", "max_connections", "max_concurrency", "client", "semaphore")
+
+    def __init__(self, name, base_url, timeout, max_connections, max_concurrency):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.client = None
+        self.semaphore = None
+
+
+class HttpClients:
+    """One pooled httpx.AsyncClient per upstream service.
+
+    Each upstream has its own timeout, connection pool and concurrency cap,
+    so a slow weather API can only tie up its own slots, not the Supabase
+    ones. Clients are opened lazily on first use (or by start()) and closed
+    by close() during lifespan shutdown. `latency`, if given, is a histogram
+    observed per upstream and response status (or "error").
+    """
+
+    def __init__(self, latency=None):
+        self._upstreams = {}
+        self.latency = latency
+
+    def register(self, name: str, base_url: str, timeout: float = 10.0,
+                 max_connections: int = 50, max_concurrency: int = 50):
+        self._upstreams[name] = Upstream(name, base_url, timeout, max_connections, max_concurrency)
+
+    def _open(self, upstream: Upstream):
+        # Import httpx (~0.1s) khi mở client đầu tiên, không phải lúc import module
+        import httpx
+        upstream.client = httpx.AsyncClient(
+            base_url=upstream.base_url,
+            timeout=httpx.Timeout(upstream.timeout, connect=min(upstream.timeout, 5.0)),
+            limits=httpx.Limits(
+                max_connections=upstream.max_connections,
+                max_keepalive_connections=upstream.max_connections,
+                keepalive_expiry=60
+            ),
+            http2=HTTP2_AVAILABLE
+        )
+        upstream.semaphore = asyncio.Semaphore(upstream.max_concurrency)
+
+    async def start(self):
+        for upstream in self._upstreams.values():
+            if upstream.client is None:
+                self._open(upstream)
+
+    async def close(self):
+        for upstream in self._upstreams.values():
+            if upstream.client is not None:
+                await upstream.client.aclose()
+                upstream.client = None
+
+    async def request(self, name: str, method: str, url: str, **kwargs) -> "httpx.Response":
+        upstream = self._upstreams[name]
+        if upstream.client is None:
+            self._open(upstream)
+        async with upstream.semaphore:
+            start = time.perf_counter()
+            status = "error"
+            try:
+                response = await upstream.client.request(method, url, **kwargs)
+                status = str(response.status_code)
+                return response
+            finally:
+                if self.latency is not None:
+                    self.latency.observe(time.perf_counter() - start, name, status)
+
+    async def get(self, name: str, url: str, **kwargs) -> "httpx.Response":
+        return await self.request(name, "GET", url, **kwargs)
+
+    async def post(self, name: str, url: str, **kwargs) -> "httpx.Response":
+        return await self.request(name, "POST", url, **kwargs)
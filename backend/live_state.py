@@ -0,0 +1,92 @@
+from collections import OrderedDict
+import itertools
+import time
+
+
+DEFAULT_DEVICE_ID = "default"
+
+
+class DeviceState:
+    __slots__ = ("sensor_id", "farm_id", "value", "ts", "seq")
+
+    def __init__(self, sensor_id, farm_id, value, ts, seq):
+        self.sensor_id = sensor_id
+        self.farm_id = farm_id
+        self.value = value
+        self.ts = ts
+        self.seq = seq
+
+    def to_dict(self):
+        return {
+            "sensor_id": self.sensor_id,
+            "farm_id": self.farm_id,
+            "data": self.value,
+            "ts": self.ts,
+            "seq": self.seq,
+        }
+
+
+def device_key(payload: dict):
+    # Thiết bị có thể gửi sensor_id hoặc device_id, nếu không có thì gom vào "default"
+    sensor_id = payload.get("sensor_id") or payload.get("device_id") or DEFAULT_DEVICE_ID
+    farm_id = payload.get("farm_id")
+    return str(sensor_id), (str(farm_id) if farm_id is not None else None)
+
+
+class LiveStateStore:
+    """Last known reading per device, written by the consumer and read by the API.
+
+    Only one thread (the consumer) may call update(). Each update swaps in a
+    fresh DeviceState, so readers never see a half-written record and no lock
+    is needed on the read path.
+    """
+
+    def __init__(self, max_devices: int = 10000):
+        self.max_devices = max_devices
+        self._devices = OrderedDict()
+        self._farms = {}
+        self._seq = itertools.count(1)
+        self._last = None
+
+    def __len__(self):
+        return len(self._devices)
+
+    def update(self, payload: dict, ts: float = None) -> DeviceState:
+        sensor_id, farm_id = device_key(payload)
+        state = DeviceState(sensor_id, farm_id, payload, ts or time.time(), next(self._seq))
+
+        old = self._devices.get(sensor_id)
+        if old is not None and old.farm_id != farm_id:
+            self._unindex(old)
+
+        self._devices[sensor_id] = state
+        self._devices.move_to_end(sensor_id)
+        if farm_id is not None:
+            self._farms.setdefault(farm_id, {})[sensor_id] = state
+        self._last = state
+
+        while len(self._devices) > self.max_devices:
+            _, evicted = self._devices.popitem(last=False)
+            self._unindex(evicted)
+
+        return state
+
+    def _unindex(self, state: DeviceState):
+        farm = self._farms.get(state.farm_id)
+        if farm is None:
+            return
+        farm.pop(state.sensor_id, None)
+        if not farm:
+            self._farms.pop(state.farm_id, None)
+
+    def get(self, sensor_id: str):
+        return self._devices.get(str(sensor_id))
+
+    def by_farm(self, farm_id: str):
+        farm = self._farms.get(str(farm_id))
+        if not farm:
+            return []
+        return list(farm.values())
+
+    def latest(self):
+        return self._last
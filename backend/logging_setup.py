@@ -0,0 +1,136 @@
+from logging.handlers import QueueHandler, QueueListener
+import logging
+import queue
+import sys
+import time
+
+from codec import dumps
+
+
+SENSITIVE_FIELDS = ("token", "access_token", "refresh_token", "authorization", "password", "claims")
+REDACTED = "[redacted]"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps(entry)
+
+
+class PlainFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+class RedactFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = getattr(record, "fields", None)
+        if fields and any(k in fields for k in SENSITIVE_FIELDS):
+            record.fields = {k: (REDACTED if k in SENSITIVE_FIELDS else v) for k, v in fields.items()}
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Lets 1 in N records below ERROR through for the configured loggers."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self._counters = dict.fromkeys(rates, 0)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        rate = self.rates.get(record.name)
+        if not rate or rate <= 1:
+            return True
+        n = self._counters[record.name] = self._counters[record.name] + 1
+        return n % rate == 1
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Hàng đợi đầy thì bỏ bản ghi thay vì chặn request/consumer
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.listener = None
+
+    def prepare(self, record):
+        # Hàng đợi trong cùng process nên không cần pickle: để nguyên record (args, exc_info) cho
+        # listener format, request/consumer không tốn công format và JsonFormatter vẫn có "exc"
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Dừng listener sau khi ghi nốt hàng đợi; logging.shutdown() lúc thoát cũng gọi tới đây
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+        super().close()
+
+
+def parse_pairs(spec: str) -> dict:
+    pairs = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+def setup_logging(level: str = "INFO", levels: str = "", sample: str = "", fmt: str = "json",
+                  max_queue: int = 10000) -> DroppingQueueHandler:
+    """Route all logging through a bounded queue drained by one background thread.
+
+    `levels` and `sample` are "logger=value" lists, e.g.
+    "consumer=WARNING,backend.ingest=DEBUG" and "backend.ingest=100".
+    Sensitive keys in `extra={"fields": ...}` are redacted before queueing.
+    Callers only pay for the level check, filters and a put_nowait; the
+    formatting and the stdout write happen on the listener thread, which
+    runs until the returned handler is closed.
+    """
+    log_queue = queue.Queue(maxsize=max_queue)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(RedactFilter())
+    rates = {name: int(rate) for name, rate in parse_pairs(sample).items()}
+    if rates:
+        handler.addFilter(SampleFilter(rates))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else PlainFormatter())
+    listener = QueueListener(log_queue, output, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for old in root.handlers:
+        if isinstance(old, DroppingQueueHandler):
+            old.close()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+    for name, value in parse_pairs(levels).items():
+        logging.getLogger(name).setLevel(value.upper())
+
+    listener.start()
+    handler.listener = listener
+    return handler
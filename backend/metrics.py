@@ -0,0 +1,175 @@
+from bisect import bisect_left
+import math
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """Cumulative Prometheus histogram; observe() is a bisect and three adds."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self, lines: list):
+        with self._lock:
+            snapshot = [(k, list(v[0]), v[1], v[2]) for k, v in self._series.items()]
+        for label_values, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                labels = _labels(self.labels + ("le",), label_values + (_number(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+
+
+class FuncMetric:
+    """Gauge or counter read from existing stats at scrape time.
+
+    `fn` returns a number, or a dict of label-value tuples to numbers, so
+    the hot path keeps updating its plain stats dicts and pays nothing
+    extra for being exported.
+    """
+
+    def __init__(self, name: str, help: str, fn, kind: str = "gauge", labels=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+        self.labels = tuple(labels)
+
+    def render(self, lines: list):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}")
+
+
+class RateMeter:
+    """Events per second over a sliding window of one-second slots."""
+
+    def __init__(self, window: int = 10):
+        self.window = window
+        self._slots = [0] * (window + 1)
+        self._slot_second = [0] * (window + 1)
+        self.total = 0
+        self.last = None
+
+    def mark(self, n: int = 1):
+        now = time.time()
+        second = int(now)
+        i = second % len(self._slots)
+        if self._slot_second[i] != second:
+            self._slot_second[i] = second
+            self._slots[i] = 0
+        self._slots[i] += n
+        self.total += n
+        self.last = now
+
+    def rate(self) -> float:
+        # Bỏ giây hiện tại (chưa đủ) và chỉ cộng các ô còn nằm trong cửa sổ
+        current = int(time.time())
+        events = sum(n for n, s in zip(self._slots, self._slot_second) if current - self.window <= s < current)
+        return events / self.window
+
+    def age(self):
+        return time.time() - self.last if self.last is not None else None
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn, labels=()) -> FuncMetric:
+        return self.register(FuncMetric(name, help, fn, "gauge", labels))
+
+    def counter(self, name: str, help: str, fn, labels=()) -> FuncMetric:
+        return self.register(FuncMetric(name, help, fn, "counter", labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                metric.render(lines)
+            except Exception as e:
+                lines.append(f"# error collecting {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetricsMiddleware:
+    """Times each HTTP request by route template, method and status code."""
+
+    def __init__(self, app, histogram: Histogram, exclude=()):
+        self.app = app
+        self.histogram = histogram
+        self.exclude = frozenset(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            self.histogram.observe(time.perf_counter() - start, getattr(route, "path", "<unmatched>"),
+                                   scope["method"], str(status[0]))
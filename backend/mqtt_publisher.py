@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class MqttPublishError(Exception):
+    pass
+
+
+class MqttPublisher:
+    """One long-lived MQTT connection shared by every pump command.
+
+    The paho network loop runs in its own thread and takes care of
+    keep-alive and reconnects. publish() only enqueues the message, so API
+    handlers never wait on the broker; QoS 1 messages beyond `max_inflight`
+    are held in paho's queue until earlier ones are acknowledged. While the
+    broker is unreachable publish() fails instead of queueing, so a pump
+    command never starts a pump long after it was requested.
+    `ack_latency`, if given, is a histogram of publish-to-ack seconds.
+    The paho client is built in start(), so importing this module does not
+    import paho.
+    """
+
+    def __init__(self, host: str, port: int = 1883, username: str = None, password: str = None,
+                 keepalive: int = 30, qos: int = 1, max_inflight: int = 20, max_queued: int = 1000,
+                 client_id: str = "", ack_latency=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.client_id = client_id
+        self.client = None
+        self._mqtt = None
+        self._connected = threading.Event()
+        self.stats = {"published": 0, "acked": 0, "failed": 0, "reconnects": 0}
+        self.ack_latency = ack_latency
+        self._sent = {}
+        self._started = False
+        self._ever_connected = False
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def _build_client(self):
+        import paho.mqtt.client as mqtt
+
+        # paho-mqtt 2.x bắt buộc khai báo callback API version
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id)
+        else:
+            client = mqtt.Client(client_id=self.client_id)
+        if self.username:
+            client.username_pw_set(self.username, self.password)
+        client.max_inflight_messages_set(self.max_inflight)
+        client.max_queued_messages_set(self.max_queued)
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        self._mqtt = mqtt
+        self.client = client
+
+    def start(self):
+        if self._started:
+            return
+        if not self.host:
+            logger.warning("⚠️ MQTT host not configured, pump commands are disabled")
+            return
+        if self.client is None:
+            self._build_client()
+        self._started = True
+        logger.info("📡 MQTT publisher connecting to %s:%s...", self.host, self.port)
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def stop(self, timeout: float = 5.0):
+        if not self._started:
+            return
+        # Chờ các lệnh đang bay được broker xác nhận trước khi ngắt
+        deadline = time.monotonic() + timeout
+        while self.connected and self.stats["acked"] < self.stats["published"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.client.disconnect()
+        self.client.loop_stop()
+        self._started = False
+
+    def publish(self, topic: str, payload: str, qos: int = None):
+        qos = self.qos if qos is None else qos
+        if self.client is None:
+            self.stats["failed"] += 1
+            raise MqttPublishError("MQTT publisher is not started")
+        if not self.connected:
+            # Không để paho xếp hàng lệnh bơm chờ reconnect: tưới muộn còn tệ hơn báo lỗi
+            self.stats["failed"] += 1
+            raise MqttPublishError("MQTT broker is not connected")
+        mqtt = self._mqtt
+        start = time.monotonic()
+        info = self.client.publish(topic, payload, qos=qos)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.stats["published"] += 1
+            if self.ack_latency is not None and info.mid not in self._sent:
+                if len(self._sent) >= 10000:
+                    # Ack bị mất khi reconnect thì entry không bao giờ được lấy ra
+                    self._sent.clear()
+                self._sent[info.mid] = start
+            return info
+        self.stats["failed"] += 1
+        raise MqttPublishError(mqtt.error_string(info.rc))
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if reason_code == 0:
+            if self._ever_connected:
+                self.stats["reconnects"] += 1
+            self._ever_connected = True
+            self._connected.set()
+            logger.info("✅ MQTT publisher connected")
+        else:
+            logger.error("❌ MQTT connect refused: %s", reason_code)
+
+    def _on_disconnect(self, client, userdata, *args):
+        self._connected.clear()
+        logger.warning("⚠️ MQTT publisher disconnected")
+
+    def _on_publish(self, client, userdata, mid, *args):
+        self.stats["acked"] += 1
+        start = self._sent.pop(mid, None)
+        if start is not None:
+            self.ack_latency.observe(time.monotonic() - start)
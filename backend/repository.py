@@ -0,0 +1,378 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+import asyncio
+import threading
+import time
+
+from cache import AsyncTTLCache
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+
+Row = Dict[str, Any]
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def is_rejected(e: Exception) -> bool:
+    """True if PostgREST answered with an error, i.e. retrying the same request cannot help."""
+    # postgrest đã được import cùng supabase client trước khi có query nào lỗi
+    from postgrest.exceptions import APIError
+    return isinstance(e, APIError)
+
+
+class Database:
+    """Runs blocking supabase-py queries on a bounded worker pool.
+
+    Handlers await run() instead of calling .execute() inline, so a slow
+    PostgREST query only occupies one pool thread while the event loop keeps
+    serving other requests. Each query gets a timeout; when it fires the
+    handler gets QueryTimeout, although the worker thread itself finishes
+    the HTTP call in the background. `latency`, if given, is a histogram
+    observed with the outcome (ok, error or timeout) of every query.
+
+    `client` is either a supabase Client or a zero-argument factory for
+    one. A factory is only called on first use, so importing supabase-py
+    stays off the startup path.
+    """
+
+    def __init__(self, client, max_workers: int = 16, timeout: float = 10.0, latency=None):
+        if callable(client) and not hasattr(client, "table"):
+            self._factory, self._client = client, None
+        else:
+            self._factory, self._client = None, client
+        self._client_lock = threading.Lock()
+        self.timeout = timeout
+        self.latency = latency
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+
+    @property
+    def client(self) -> "Client":
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def table(self, name: str):
+        return self.client.table(name)
+
+    async def run(self, query: Callable[[], Any], timeout: Optional[float] = None):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._pool, query)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await asyncio.wait_for(future, timeout or self.timeout)
+            outcome = "ok"
+            return result
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise QueryTimeout(f"Supabase query timed out after {timeout or self.timeout}s")
+        finally:
+            if self.latency is not None:
+                self.latency.observe(time.perf_counter() - start, outcome)
+
+    def run_in_executor(self, fn: Callable, *args) -> asyncio.Future:
+        # Chạy fn trên pool query mà không chờ, không timeout (ví dụ việc dọn dẹp fire-and-forget)
+        return asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+async def keyset_page(db: Database, table: str, key: str, after: Optional[str],
+                      limit: int, columns: List[str]) -> List[Row]:
+    # Phân trang theo khóa (key > after) thay vì offset để trang sau không chậm dần
+    def query():
+        q = db.table(table).select(",".join(columns)).order(key).limit(limit)
+        if after is not None:
+            q = q.gt(key, after)
+        return q.execute()
+
+    result = await db.run(query)
+    return result.data
+
+
+class EntityCache:
+    """Read-through caches for farm and sensor rows and farm ids by name.
+
+    The repositories below fill these on reads and invalidate the affected
+    keys on every write, so a detail page reloaded many times costs one
+    Supabase query until the record changes or its TTL runs out. Every
+    invalidation is also passed to `on_change`, if set, as a small dict that
+    apply_remote() replays on another worker's cache.
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 10000):
+        self.farms = AsyncTTLCache(ttl, max_entries=max_entries)
+        self.sensors = AsyncTTLCache(ttl, max_entries=max_entries)
+        self.farm_ids_by_name = AsyncTTLCache(ttl, max_entries=max_entries)
+        self.on_change = None
+
+    def _changed(self, change: dict):
+        if self.on_change is not None:
+            self.on_change(change)
+
+    def forget_sensor(self, row: Row):
+        self.sensors.invalidate(str(row["sensor_id"]))
+        self._changed({"type": "sensor", "sensor_id": str(row["sensor_id"])})
+
+    def forget_farm_names(self):
+        self.farm_ids_by_name.invalidate()
+        self._changed({"type": "farm_names"})
+
+    def forget_farm(self, farm_id: str, cascade: bool = False):
+        self._forget_farm(str(farm_id), cascade)
+        self._changed({"type": "farm", "farm_id": str(farm_id), "cascade": cascade})
+
+    def _forget_farm(self, farm_id: str, cascade: bool):
+        self.farms.invalidate(farm_id)
+        self.farm_ids_by_name.invalidate()
+        if cascade:
+            # Farm bị xóa: các sensor thuộc farm (nếu đang cache) cũng bỏ luôn
+            for sensor_id in [k for k, e in self.sensors._entries.items()
+                              if e.value and str(e.value.get("farm_id")) == farm_id]:
+                self.sensors.invalidate(sensor_id)
+
+    def apply_remote(self, change: dict):
+        # Thay đổi do worker khác báo sang: chỉ bỏ cache, không phát lại
+        if change["type"] == "sensor":
+            self.sensors.invalidate(change["sensor_id"])
+        elif change["type"] == "farm":
+            self._forget_farm(change["farm_id"], change.get("cascade", False))
+        elif change["type"] == "farm_names":
+            self.farm_ids_by_name.invalidate()
+
+    def clear(self):
+        for cache in (self.farms, self.sensors, self.farm_ids_by_name):
+            cache.invalidate()
+
+    def snapshot(self) -> dict:
+        return {
+            "farms": self.farms.snapshot(),
+            "sensors": self.sensors.snapshot(),
+            "farm_ids_by_name": self.farm_ids_by_name.snapshot(),
+        }
+
+
+class ProfileRepository:
+    table = "user_profiles"
+    key = "user_id"
+    columns = ("user_id", "full_name", "email", "address", "province", "phone_number", "role")
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, user_id: str) -> Optional[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("*").eq("user_id", user_id).limit(1).execute())
+        return result.data[0] if result.data else None
+
+    async def page(self, after: Optional[str], limit: int, columns: List[str]) -> List[Row]:
+        return await keyset_page(self.db, self.table, self.key, after, limit, columns)
+
+    async def create(self, data: Row) -> List[Row]:
+        result = await self.db.run(lambda: self.db.table(self.table).insert(data).execute())
+        return result.data
+
+    async def update(self, user_id: str, data: Row) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).update(data).eq("user_id", user_id).execute())
+        return result.data
+
+
+class FarmRepository:
+    table = "farm"
+    key = "farm_id"
+    columns = ("farm_id", "farm_name", "location", "user_own")
+
+    def __init__(self, db: Database, cache: EntityCache):
+        self.db = db
+        self.cache = cache
+
+    async def get(self, farm_id: str) -> Optional[Row]:
+        return await self.cache.farms.get(str(farm_id), lambda: self._get(farm_id))
+
+    async def _get(self, farm_id: str) -> Optional[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("*").eq("farm_id", farm_id).execute())
+        return result.data[0] if result.data else None
+
+    async def page(self, after: Optional[str], limit: int, columns: List[str]) -> List[Row]:
+        return await keyset_page(self.db, self.table, self.key, after, limit, columns)
+
+    async def list_by_owner_with_sensors(self, user_id: str) -> List[Row]:
+        # Nhúng bảng sensor qua khóa ngoại sensor.farm_id: một round trip cho mọi farm
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("*, sensor(*)").eq("user_own", user_id).execute())
+        return result.data
+
+    async def find_id_by_name(self, farm_name: str) -> Optional[str]:
+        return await self.cache.farm_ids_by_name.get(farm_name, lambda: self._find_id_by_name(farm_name))
+
+    async def _find_id_by_name(self, farm_name: str) -> Optional[str]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("farm_id").eq("farm_name", farm_name).limit(1).execute())
+        return result.data[0]["farm_id"] if result.data else None
+
+    async def find_ids_by_names(self, farm_names: List[str]) -> Dict[str, Any]:
+        if not farm_names:
+            return {}
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("farm_id,farm_name").in_("farm_name", farm_names).execute())
+        ids = {}
+        for row in result.data:
+            # Trùng tên thì giữ farm đầu tiên, giống find_id_by_name
+            ids.setdefault(row["farm_name"], row["farm_id"])
+        return ids
+
+    async def create(self, data: Row) -> List[Row]:
+        result = await self.db.run(lambda: self.db.table(self.table).insert(data).execute())
+        self.cache.forget_farm_names()
+        return result.data
+
+    async def update(self, farm_id: str, data: Row) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).update(data).eq("farm_id", farm_id).execute())
+        self.cache.forget_farm(farm_id)
+        if result.data:
+            self.cache.farms.set(str(farm_id), result.data[0])
+        return result.data
+
+    async def delete(self, farm_id: str) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).delete().eq("farm_id", farm_id).execute())
+        self.cache.forget_farm(farm_id, cascade=True)
+        return result.data
+
+
+class SensorRepository:
+    table = "sensor"
+    key = "sensor_id"
+    columns = ("sensor_id", "sensor_name", "sensor_type", "farm_id", "location", "connectivity",
+               "status", "latest_updated", "logs", "link")
+
+    def __init__(self, db: Database, cache: EntityCache):
+        self.db = db
+        self.cache = cache
+
+    async def get(self, sensor_id: str, fresh: bool = False) -> Optional[Row]:
+        if fresh:
+            self.cache.sensors.invalidate(str(sensor_id))
+        return await self.cache.sensors.get(str(sensor_id), lambda: self._get(sensor_id))
+
+    async def _get(self, sensor_id: str) -> Optional[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("*").eq("sensor_id", sensor_id).execute())
+        return result.data[0] if result.data else None
+
+    async def page(self, after: Optional[str], limit: int, columns: List[str]) -> List[Row]:
+        return await keyset_page(self.db, self.table, self.key, after, limit, columns)
+
+    async def create(self, data: Row) -> List[Row]:
+        result = await self.db.run(lambda: self.db.table(self.table).insert(data).execute())
+        for row in result.data:
+            self.cache.forget_sensor(row)
+        return result.data
+
+    async def update(self, sensor_id: str, data: Row) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).update(data).eq("sensor_id", sensor_id).execute())
+        self._forget(sensor_id, result.data)
+        if result.data:
+            self.cache.sensors.set(str(sensor_id), result.data[0])
+        return result.data
+
+    async def update_if_status(self, sensor_id: str, old_status: Optional[str], data: Row) -> List[Row]:
+        # Compare-and-set: chỉ ghi khi status trong DB vẫn là old_status, trả về [] nếu đã bị đổi
+        def query():
+            q = self.db.table(self.table).update(data).eq("sensor_id", sensor_id)
+            q = q.is_("status", "null") if old_status is None else q.eq("status", old_status)
+            return q.execute()
+
+        result = await self.db.run(query)
+        self._forget(sensor_id, result.data)
+        if result.data:
+            self.cache.sensors.set(str(sensor_id), result.data[0])
+        return result.data
+
+    async def delete(self, sensor_id: str) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).delete().eq("sensor_id", sensor_id).execute())
+        self._forget(sensor_id, result.data)
+        return result.data
+
+    async def create_many(self, rows: List[Row]) -> List[Row]:
+        result = await self.db.run(lambda: self.db.table(self.table).insert(rows).execute())
+        for row in result.data:
+            self.cache.forget_sensor(row)
+        return result.data
+
+    async def update_many(self, rows: List[Row]) -> List[Row]:
+        # RPC update_sensors (schema.sql): UPDATE ... FROM, chỉ ghi các cột có trong từng dòng và không
+        # bao giờ insert; mỗi dòng trả về kèm old_status đọc dưới khóa dòng
+        result = await self.db.run(lambda: self.db.client.rpc("update_sensors", {"p_rows": rows}).execute())
+        for row in result.data:
+            self._forget(row["sensor_id"], [row])
+        return result.data
+
+    async def create_spooled(self, rows: List[Row]) -> List[Row]:
+        # Replay từ spool: spool_ref trùng nghĩa là lần gửi trước đã vào DB, bỏ qua
+        result = await self.db.run(
+            lambda: self.db.table(self.table).upsert(rows, on_conflict="spool_ref", ignore_duplicates=True).execute())
+        for row in result.data:
+            self.cache.forget_sensor(row)
+        return result.data
+
+    async def list_ids_by_connectivity(self, connectivity: str) -> List[str]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("sensor_id").eq("connectivity", connectivity).execute())
+        return [str(row["sensor_id"]) for row in result.data]
+
+    async def set_connectivity(self, sensor_ids: List[str], connectivity: str, latest_updated: str) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table)
+            .update({"connectivity": connectivity, "latest_updated": latest_updated})
+            .in_("sensor_id", sensor_ids).execute())
+        for row in result.data:
+            self._forget(row["sensor_id"], [row])
+        return result.data
+
+    def _forget(self, sensor_id: str, rows: List[Row]):
+        for row in rows or [{"sensor_id": sensor_id}]:
+            self.cache.forget_sensor(row)
+
+
+class DashboardRepository:
+    table = "dashboard_counters"
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def counters(self) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("dimension,bucket,count").execute())
+        return result.data
+
+
+class StatusRollupRepository:
+    table = "farm_status_daily"
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def window(self, farm_id: str, start: str, end: str) -> List[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("day,normal,warning,error")
+            .eq("farm_id", farm_id).gte("day", start).lte("day", end).order("day").execute())
+        return result.data
+
+    async def before(self, farm_id: str, start: str) -> Optional[Row]:
+        result = await self.db.run(
+            lambda: self.db.table(self.table).select("day,normal,warning,error")
+            .eq("farm_id", farm_id).lt("day", start).order("day", desc=True).limit(1).execute())
+        return result.data[0] if result.data else None
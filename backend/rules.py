@@ -0,0 +1,261 @@
+import operator
+import re
+
+from scheduler import PUMP_ID_PATTERN
+
+
+KINDS = ("threshold", "rate")
+OPS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+SEVERITY = {"normal": 0, "warning": 1, "error": 2}
+
+
+class AlertRule:
+    __slots__ = ("rule_id", "sensor_id", "farm_id", "metric", "kind", "op", "threshold",
+                 "clear_threshold", "for_seconds", "status", "pump_id", "pump_duration", "user_own",
+                 "_trip", "_clear")
+
+    def __init__(self, rule_id, metric, op, threshold, kind="threshold", sensor_id=None, farm_id=None,
+                 clear_threshold=None, for_seconds=0, status="warning", pump_id=None, pump_duration=None,
+                 user_own=None):
+        self.rule_id = str(rule_id)
+        self.sensor_id = str(sensor_id) if sensor_id is not None else None
+        self.farm_id = str(farm_id) if farm_id is not None else None
+        self.metric = metric
+        self.kind = kind
+        self.op = op
+        self.threshold = float(threshold)
+        # Hysteresis: mặc định nhả ở đúng ngưỡng kích hoạt
+        self.clear_threshold = float(clear_threshold) if clear_threshold is not None else self.threshold
+        self.for_seconds = float(for_seconds or 0)
+        self.status = status
+        self.pump_id = pump_id
+        self.pump_duration = int(pump_duration) if pump_duration else None
+        self.user_own = str(user_own) if user_own is not None else None
+        self._trip = None
+        self._clear = None
+
+    @classmethod
+    def from_row(cls, row: dict):
+        return cls(
+            row["rule_id"], row["metric"], row.get("op", ">"), row["threshold"],
+            kind=row.get("kind", "threshold"), sensor_id=row.get("sensor_id"), farm_id=row.get("farm_id"),
+            clear_threshold=row.get("clear_threshold"), for_seconds=row.get("for_seconds"),
+            status=row.get("status", "warning"), pump_id=row.get("pump_id"),
+            pump_duration=row.get("pump_duration"), user_own=row.get("user_own"),
+        )
+
+    def to_dict(self):
+        return {
+            "rule_id": self.rule_id,
+            "sensor_id": self.sensor_id,
+            "farm_id": self.farm_id,
+            "metric": self.metric,
+            "kind": self.kind,
+            "op": self.op,
+            "threshold": self.threshold,
+            "clear_threshold": self.clear_threshold,
+            "for_seconds": self.for_seconds,
+            "status": self.status,
+            "pump_id": self.pump_id,
+            "pump_duration": self.pump_duration,
+            "user_own": self.user_own,
+        }
+
+    def compile(self):
+        # Gắn sẵn hàm so sánh để lúc đánh giá không phải tra bảng/if theo op
+        trip = OPS[self.op]
+        threshold, clear_threshold = self.threshold, self.clear_threshold
+        self._trip = lambda v: trip(v, threshold)
+        if self.op in (">", ">="):
+            self._clear = lambda v: v < clear_threshold
+        else:
+            self._clear = lambda v: v > clear_threshold
+
+
+def validate_rule(rule: AlertRule):
+    if rule.kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    if rule.op not in OPS:
+        raise ValueError(f"op must be one of {', '.join(OPS)}")
+    if not rule.metric:
+        raise ValueError("metric is required")
+    if rule.status not in SEVERITY or rule.status == "normal":
+        raise ValueError("status must be warning or error")
+    if rule.for_seconds < 0:
+        raise ValueError("for_seconds must not be negative")
+    if rule.op in (">", ">=") and rule.clear_threshold > rule.threshold:
+        raise ValueError("clear_threshold must not be above threshold for > rules")
+    if rule.op in ("<", "<=") and rule.clear_threshold < rule.threshold:
+        raise ValueError("clear_threshold must not be below threshold for < rules")
+    if rule.pump_duration is not None and rule.pump_duration <= 0:
+        raise ValueError("pump_duration must be positive")
+    if rule.pump_id is not None and not re.match(PUMP_ID_PATTERN, rule.pump_id):
+        raise ValueError("pump_id may only contain letters, digits, '_' and '-'")
+
+
+class RuleState:
+    __slots__ = ("active", "pending_since", "last_value", "last_ts")
+
+    def __init__(self):
+        self.active = False
+        self.pending_since = None
+        self.last_value = None
+        self.last_ts = None
+
+
+class RulesEngine:
+    """Evaluates alert rules against each ingested reading.
+
+    Rules are indexed by sensor, by farm and globally, so a message is only
+    checked against the rules that can apply to its device. A rule trips
+    once its condition has held for `for_seconds` and clears only after the
+    value crosses `clear_threshold`. evaluate() returns actions for real
+    transitions only: a new sensor status (the most severe active rule, or
+    "normal") and a pump command when a rule with a pump trips. Removing a
+    rule that holds sensors in alert yields the same status actions, so
+    their status does not stay stuck at the removed rule's severity.
+    """
+
+    def __init__(self, max_states: int = 200000):
+        self.max_states = max_states
+        self._rules = {}
+        self._by_sensor = {}
+        self._by_farm = {}
+        self._global = ()
+        self._states = {}
+        self._active = {}
+        self._status = {}
+        self.stats = {"evaluated": 0, "tripped": 0, "cleared": 0, "actions": 0}
+
+    def __len__(self):
+        return len(self._rules)
+
+    def add(self, rule: AlertRule):
+        validate_rule(rule)
+        rule.compile()
+        self._rules[rule.rule_id] = rule
+        self._drop_states(rule.rule_id)
+        self._reindex()
+
+    def remove(self, rule_id: str, actions: list = None):
+        # actions (nếu có) nhận các status action cho sensor mà rule này đang giữ ở trạng thái cảnh báo
+        rule = self._rules.pop(str(rule_id), None)
+        if rule is not None:
+            released = self._drop_states(rule.rule_id)
+            self._reindex()
+            for sensor_id in released:
+                self._emit_status(sensor_id, None, actions if actions is not None else [])
+        return rule
+
+    def get(self, rule_id: str):
+        return self._rules.get(str(rule_id))
+
+    def rule_ids(self):
+        return set(self._rules)
+
+    def list(self, sensor_id: str = None, farm_id: str = None, user_own: str = None):
+        return [r.to_dict() for r in self._rules.values()
+                if (sensor_id is None or r.sensor_id == sensor_id) and (farm_id is None or r.farm_id == farm_id)
+                and (user_own is None or r.user_own == str(user_own))]
+
+    def pump_owners(self, pump_id: str) -> set:
+        return {r.user_own for r in self._rules.values() if r.pump_id == pump_id}
+
+    def _reindex(self):
+        by_sensor, by_farm, everywhere = {}, {}, []
+        for rule in self._rules.values():
+            if rule.sensor_id is not None:
+                by_sensor.setdefault(rule.sensor_id, []).append(rule)
+            elif rule.farm_id is not None:
+                by_farm.setdefault(rule.farm_id, []).append(rule)
+            else:
+                everywhere.append(rule)
+        self._by_sensor = {k: tuple(v) for k, v in by_sensor.items()}
+        self._by_farm = {k: tuple(v) for k, v in by_farm.items()}
+        self._global = tuple(everywhere)
+
+    def _drop_states(self, rule_id: str):
+        for key in [k for k in self._states if k[0] == rule_id]:
+            del self._states[key]
+        released = []
+        for sensor_id, active in list(self._active.items()):
+            if active.pop(rule_id, None) is not None:
+                released.append(sensor_id)
+                if not active:
+                    del self._active[sensor_id]
+        return released
+
+    def _emit_status(self, sensor_id: str, farm_id, actions: list):
+        active = self._active.get(sensor_id)
+        status = max(active.values(), key=SEVERITY.get) if active else "normal"
+        if status != self._status.get(sensor_id, "normal"):
+            if status == "normal":
+                del self._status[sensor_id]
+            else:
+                self._status[sensor_id] = status
+            actions.append({"type": "status", "sensor_id": sensor_id, "farm_id": farm_id, "status": status})
+
+    def evaluate(self, sensor_id: str, farm_id: str, payload: dict, ts: float):
+        actions = []
+        changed = False
+        for rules in (self._by_sensor.get(sensor_id, ()), self._by_farm.get(farm_id, ()), self._global):
+            for rule in rules:
+                value = payload.get(rule.metric)
+                if value is None or isinstance(value, bool):
+                    continue
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                if self._step(rule, sensor_id, value, ts, actions):
+                    changed = True
+
+        if changed:
+            self._emit_status(sensor_id, farm_id, actions)
+        self.stats["actions"] += len(actions)
+        return actions
+
+    def _step(self, rule: AlertRule, sensor_id: str, value: float, ts: float, actions: list) -> bool:
+        self.stats["evaluated"] += 1
+        key = (rule.rule_id, sensor_id)
+        state = self._states.get(key)
+        if state is None:
+            if len(self._states) >= self.max_states:
+                return False
+            state = self._states[key] = RuleState()
+
+        if rule.kind == "rate":
+            last_value, last_ts = state.last_value, state.last_ts
+            state.last_value, state.last_ts = value, ts
+            if last_ts is None or ts <= last_ts:
+                return False
+            value = (value - last_value) / (ts - last_ts)
+
+        if not state.active:
+            if not rule._trip(value):
+                state.pending_since = None
+                return False
+            if state.pending_since is None:
+                state.pending_since = ts
+            # Debounce: điều kiện phải giữ đủ for_seconds mới kích hoạt
+            if ts - state.pending_since < rule.for_seconds:
+                return False
+            state.active = True
+            state.pending_since = None
+            self._active.setdefault(sensor_id, {})[rule.rule_id] = rule.status
+            self.stats["tripped"] += 1
+            if rule.pump_id is not None and rule.pump_duration:
+                actions.append({"type": "pump", "pump_id": rule.pump_id, "duration": rule.pump_duration,
+                                "rule_id": rule.rule_id, "sensor_id": sensor_id})
+            return True
+
+        if rule._clear(value):
+            state.active = False
+            active = self._active.get(sensor_id)
+            if active is not None:
+                active.pop(rule.rule_id, None)
+                if not active:
+                    del self._active[sensor_id]
+            self.stats["cleared"] += 1
+            return True
+        return False
@@ -0,0 +1,253 @@
+from datetime import datetime, timedelta
+import asyncio
+import heapq
+import itertools
+import logging
+import re
+import time
+
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("once", "interval", "daily")
+# pump_id nằm trong topic MQTT: không cho "/", "+", "#" để không publish sang topic khác hay wildcard
+PUMP_ID_PATTERN = r"^[A-Za-z0-9_-]+$"
+
+
+class IrrigationJob:
+    __slots__ = ("job_id", "pump_id", "duration", "kind", "run_at", "interval_seconds",
+                 "time_of_day", "user_own", "next_run", "version")
+
+    def __init__(self, job_id, pump_id, duration, kind, run_at=None, interval_seconds=None, time_of_day=None,
+                 user_own=None):
+        self.job_id = str(job_id)
+        self.pump_id = pump_id
+        self.duration = int(duration)
+        self.kind = kind
+        self.run_at = run_at
+        self.interval_seconds = interval_seconds
+        self.time_of_day = time_of_day
+        self.user_own = str(user_own) if user_own is not None else None
+        self.next_run = None
+        self.version = 0
+
+    @classmethod
+    def from_row(cls, row: dict):
+        run_at = row.get("run_at")
+        if isinstance(run_at, str):
+            run_at = datetime.fromisoformat(run_at.replace("Z", "+00:00")).timestamp()
+        return cls(
+            row["job_id"], row.get("pump_id"), row.get("duration", 5000), row.get("kind", "once"),
+            run_at=run_at, interval_seconds=row.get("interval_seconds"), time_of_day=row.get("time_of_day"),
+            user_own=row.get("user_own"),
+        )
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "pump_id": self.pump_id,
+            "duration": self.duration,
+            "kind": self.kind,
+            "run_at": self.run_at,
+            "interval_seconds": self.interval_seconds,
+            "time_of_day": self.time_of_day,
+            "user_own": self.user_own,
+            "next_run": self.next_run,
+        }
+
+    def compute_next(self, now: float, tz):
+        if self.kind == "once":
+            return self.run_at if self.next_run is None else None
+        if self.kind == "interval":
+            start = self.run_at or now
+            if now < start:
+                return start
+            # Căn theo mốc run_at để lịch không bị trôi
+            steps = int((now - start) // self.interval_seconds) + 1
+            return start + steps * self.interval_seconds
+        if self.kind == "daily":
+            hour, minute = map(int, self.time_of_day.split(":"))
+            local_now = datetime.fromtimestamp(now, tz)
+            candidate = local_now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if candidate.timestamp() <= now:
+                candidate += timedelta(days=1)
+            return candidate.timestamp()
+        return None
+
+
+def validate_job(job: IrrigationJob):
+    if job.kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    if job.duration <= 0:
+        raise ValueError("duration must be positive")
+    if job.pump_id is not None and not re.match(PUMP_ID_PATTERN, job.pump_id):
+        raise ValueError("pump_id may only contain letters, digits, '_' and '-'")
+    if job.kind == "once" and job.run_at is None:
+        raise ValueError("run_at is required for one-shot jobs")
+    if job.kind == "interval" and (not job.interval_seconds or job.interval_seconds <= 0):
+        raise ValueError("interval_seconds must be positive")
+    if job.kind == "daily":
+        try:
+            hour, minute = map(int, (job.time_of_day or "").split(":"))
+        except ValueError:
+            raise ValueError("time_of_day must be HH:MM")
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError("time_of_day must be HH:MM")
+
+
+class IrrigationScheduler:
+    """Heap-ordered irrigation jobs fired through `fire_fn(pump_id, duration_ms)`.
+
+    Removing or replacing a job bumps its version instead of searching the
+    heap; stale heap entries are skipped when they surface. Jobs that come
+    due together for the same pump, or while that pump is still running from
+    an earlier command, are merged into one command that covers the latest
+    end time. A job whose command fails is retried every `retry_delay`
+    seconds until `misfire_grace` after its due time; only then is it
+    advanced (or, for a one-shot job, finished) without having run.
+    """
+
+    def __init__(self, fire_fn, tz, on_finished=None, misfire_grace: float = 300, retry_delay: float = 30):
+        self.fire_fn = fire_fn
+        self.tz = tz
+        self.misfire_grace = misfire_grace
+        self.retry_delay = retry_delay
+        self.on_finished = on_finished
+        self._jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._versions = itertools.count(1)
+        self._busy_until = {}
+        self._wake = asyncio.Event()
+        self._task = None
+        self.stats = {"fired": 0, "merged": 0, "failed": 0, "retried": 0, "missed": 0}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def add(self, job: IrrigationJob, now: float = None):
+        validate_job(job)
+        # Mỗi lần thêm/thay job đều có version mới, entry cũ trong heap sẽ bị bỏ qua
+        job.version = next(self._versions)
+        now = now or time.time()
+        if job.kind == "interval" and job.run_at is None:
+            job.run_at = now
+        job.next_run = job.compute_next(now, self.tz)
+        if job.kind == "once" and job.next_run < now - self.misfire_grace:
+            # Lệnh một lần đã lỡ quá lâu (ví dụ server tắt) thì bỏ, không tưới bù
+            job.next_run = None
+            if self.on_finished:
+                self.on_finished(job)
+            return job
+        self._jobs[job.job_id] = job
+        if job.next_run is not None:
+            heapq.heappush(self._heap, (job.next_run, next(self._seq), job.job_id, job.version))
+            self._wake.set()
+        return job
+
+    def remove(self, job_id: str):
+        job = self._jobs.pop(str(job_id), None)
+        self._wake.set()
+        return job
+
+    def get(self, job_id: str):
+        return self._jobs.get(str(job_id))
+
+    def job_ids(self):
+        return set(self._jobs)
+
+    def upcoming(self, limit: int = 50, pump_id: str = None, user_own: str = None):
+        jobs = [j for j in self.owned_by(user_own)
+                if j.next_run is not None and (pump_id is None or j.pump_id == pump_id)]
+        return [j.to_dict() for j in heapq.nsmallest(limit, jobs, key=lambda j: j.next_run)]
+
+    def owned_by(self, user_own: str = None):
+        return [j for j in self._jobs.values() if user_own is None or j.user_own == str(user_own)]
+
+    def pump_owners(self, pump_id: str) -> set:
+        return {j.user_own for j in self._jobs.values() if j.pump_id == pump_id}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.run_due(time.time())
+
+    def _pop_due(self, now: float):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, job_id, version = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or job.version != version:
+                continue
+            due.append(job)
+        return due
+
+    def run_due(self, now: float):
+        due = self._pop_due(now)
+
+        # Gom các job đến hạn cùng lúc theo bơm, lấy thời điểm kết thúc xa nhất
+        by_pump = {}
+        for job in due:
+            end = now + job.duration / 1000
+            if job.pump_id in by_pump:
+                self.stats["merged"] += 1
+            by_pump[job.pump_id] = max(by_pump.get(job.pump_id, 0), end)
+
+        failed = set()
+        for pump_id, end in by_pump.items():
+            if end <= self._busy_until.get(pump_id, 0):
+                # Bơm vẫn đang chạy đủ lâu từ lệnh trước
+                self.stats["merged"] += 1
+                continue
+            try:
+                self.fire_fn(pump_id, int((end - now) * 1000))
+                self._busy_until[pump_id] = end
+                self.stats["fired"] += 1
+            except Exception as e:
+                failed.add(pump_id)
+                self.stats["failed"] += 1
+                logger.error("❌ Scheduled irrigation failed for pump %s: %s", pump_id, e)
+
+        for job in due:
+            if job.pump_id in failed:
+                due_at = job.next_run
+                if now - due_at < self.misfire_grace:
+                    # Chưa tưới được (ví dụ mất kết nối broker): giữ nguyên next_run, thử lại trong thời gian ân hạn
+                    retry_at = min(now + self.retry_delay, due_at + self.misfire_grace)
+                    heapq.heappush(self._heap, (retry_at, next(self._seq), job.job_id, job.version))
+                    self.stats["retried"] += 1
+                    continue
+                self.stats["missed"] += 1
+                logger.error("❌ Giving up on irrigation job %s after %.0fs of failures", job.job_id, now - due_at)
+            job.next_run = job.compute_next(now, self.tz)
+            if job.next_run is None:
+                self._jobs.pop(job.job_id, None)
+                if self.on_finished:
+                    self.on_finished(job)
+            else:
+                heapq.heappush(self._heap, (job.next_run, next(self._seq), job.job_id, job.version))
+
+        # Dọn các bơm đã tắt để dict không phình ra
+        for pump_id in [p for p, end in self._busy_until.items() if end <= now]:
+            del self._busy_until[pump_id]
@@ -0,0 +1,244 @@
+-- Bảng lưu dữ liệu telemetry nhận từ RabbitMQ (ghi theo lô bởi write-behind buffer)
+create table if not exists sensor_readings (
+    id bigserial primary key,
+    sensor_id text not null,
+    farm_id text,
+    data jsonb not null,
+    recorded_at timestamptz not null default now()
+);
+
+create index if not exists sensor_readings_sensor_time_idx
+    on sensor_readings (sensor_id, recorded_at desc);
+
+-- Lịch tưới chạy phía server (xem scheduler.py)
+create table if not exists irrigation_schedule (
+    job_id uuid primary key,
+    pump_id text,
+    duration integer not null,
+    kind text not null check (kind in ('once', 'interval', 'daily')),
+    run_at timestamptz,
+    interval_seconds integer,
+    time_of_day text,
+    enabled boolean not null default true,
+    user_own uuid,
+    created_at timestamptz not null default now()
+);
+
+-- Bộ đếm cho /api/dashboard/summary, được trigger cập nhật theo từng dòng thay đổi
+create table if not exists dashboard_counters (
+    dimension text not null,
+    bucket text not null,
+    count bigint not null default 0,
+    primary key (dimension, bucket)
+);
+
+create or replace function bump_dashboard_counter(p_dimension text, p_bucket text, p_delta bigint)
+returns void language sql as $$
+    insert into dashboard_counters (dimension, bucket, count)
+    values (p_dimension, coalesce(p_bucket, 'unknown'), p_delta)
+    on conflict (dimension, bucket) do update set count = dashboard_counters.count + excluded.count;
+$$;
+
+create or replace function sensor_counters_trigger() returns trigger language plpgsql as $$
+begin
+    -- UPDATE chỉ chạm vào chiều thực sự đổi giá trị
+    if tg_op = 'DELETE' or (tg_op = 'UPDATE' and old.status is distinct from new.status) then
+        perform bump_dashboard_counter('sensor_status', old.status, -1);
+    end if;
+    if tg_op = 'DELETE' or (tg_op = 'UPDATE' and old.connectivity is distinct from new.connectivity) then
+        perform bump_dashboard_counter('sensor_connectivity', old.connectivity, -1);
+    end if;
+    if tg_op = 'INSERT' or (tg_op = 'UPDATE' and old.status is distinct from new.status) then
+        perform bump_dashboard_counter('sensor_status', new.status, 1);
+    end if;
+    if tg_op = 'INSERT' or (tg_op = 'UPDATE' and old.connectivity is distinct from new.connectivity) then
+        perform bump_dashboard_counter('sensor_connectivity', new.connectivity, 1);
+    end if;
+    if tg_op = 'INSERT' then
+        perform bump_dashboard_counter('totals', 'sensors', 1);
+    elsif tg_op = 'DELETE' then
+        perform bump_dashboard_counter('totals', 'sensors', -1);
+    end if;
+    return null;
+end;
+$$;
+
+create or replace function farm_counters_trigger() returns trigger language plpgsql as $$
+begin
+    perform bump_dashboard_counter('totals', 'farms', case when tg_op = 'INSERT' then 1 else -1 end);
+    return null;
+end;
+$$;
+
+create or replace function profile_counters_trigger() returns trigger language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        perform bump_dashboard_counter('user_province', old.province, -1);
+    end if;
+    if tg_op in ('INSERT', 'UPDATE') then
+        perform bump_dashboard_counter('user_province', new.province, 1);
+    end if;
+    if tg_op = 'INSERT' then
+        perform bump_dashboard_counter('totals', 'users', 1);
+    elsif tg_op = 'DELETE' then
+        perform bump_dashboard_counter('totals', 'users', -1);
+    end if;
+    return null;
+end;
+$$;
+
+-- Khởi tạo bộ đếm từ dữ liệu hiện có, chỉ khi bảng còn trống (lần apply đầu tiên);
+-- các lần apply sau giữ nguyên số đếm mà trigger đã duy trì
+insert into dashboard_counters (dimension, bucket, count)
+select dimension, bucket, count from (
+    select 'sensor_status' as dimension, coalesce(status, 'unknown') as bucket, count(*) as count from sensor group by 1, 2
+    union all
+    select 'sensor_connectivity', coalesce(connectivity, 'unknown'), count(*) from sensor group by 1, 2
+    union all
+    select 'user_province', coalesce(province, 'unknown'), count(*) from user_profiles group by 1, 2
+    union all
+    select 'totals', 'farms', count(*) from farm
+    union all
+    select 'totals', 'sensors', count(*) from sensor
+    union all
+    select 'totals', 'users', count(*) from user_profiles
+) seed
+where not exists (select 1 from dashboard_counters);
+
+-- UPDATE tách thành trigger riêng có WHEN: heartbeat ghi lại cùng connectivity/status
+-- không được tạo cặp -1/+1 trên các dòng counter nóng (WHEN với old/new chỉ dùng được cho UPDATE)
+drop trigger if exists sensor_counters on sensor;
+create trigger sensor_counters after insert or delete on sensor
+    for each row execute function sensor_counters_trigger();
+
+drop trigger if exists sensor_counters_update on sensor;
+create trigger sensor_counters_update after update of status, connectivity on sensor
+    for each row
+    when (old.status is distinct from new.status or old.connectivity is distinct from new.connectivity)
+    execute function sensor_counters_trigger();
+
+drop trigger if exists farm_counters on farm;
+create trigger farm_counters after insert or delete on farm
+    for each row execute function farm_counters_trigger();
+
+drop trigger if exists profile_counters on user_profiles;
+create trigger profile_counters after insert or delete on user_profiles
+    for each row execute function profile_counters_trigger();
+
+drop trigger if exists profile_counters_update on user_profiles;
+create trigger profile_counters_update after update of province on user_profiles
+    for each row
+    when (old.province is distinct from new.province)
+    execute function profile_counters_trigger();
+
+-- Lịch sử chuyển trạng thái sensor và bảng tổng hợp theo ngày cho /api/analytics
+create table if not exists sensor_status_events (
+    id bigserial primary key,
+    sensor_id text not null,
+    farm_id text not null,
+    old_status text,
+    new_status text,
+    changed_at timestamptz not null default now()
+);
+
+-- Số sensor ở mỗi trạng thái vào cuối ngày; ngày không có thay đổi thì không có dòng
+create table if not exists farm_status_daily (
+    farm_id text not null,
+    day date not null,
+    normal integer not null default 0,
+    warning integer not null default 0,
+    error integer not null default 0,
+    transitions integer not null default 0,
+    primary key (farm_id, day)
+);
+
+create or replace function apply_status_event() returns trigger language plpgsql as $$
+declare
+    d date := (new.changed_at at time zone 'Asia/Ho_Chi_Minh')::date;
+begin
+    -- Dòng đầu tiên của ngày được khởi tạo từ dòng gần nhất trước đó
+    insert into farm_status_daily (farm_id, day, normal, warning, error)
+    select new.farm_id, d, coalesce(p.normal, 0), coalesce(p.warning, 0), coalesce(p.error, 0)
+    from (select 1) x
+    left join lateral (
+        select normal, warning, error from farm_status_daily
+        where farm_id = new.farm_id and day < d
+        order by day desc limit 1
+    ) p on true
+    on conflict (farm_id, day) do nothing;
+
+    update farm_status_daily set
+        normal = normal + (coalesce(new.new_status, '') = 'normal')::int - (coalesce(new.old_status, '') = 'normal')::int,
+        warning = warning + (coalesce(new.new_status, '') = 'warning')::int - (coalesce(new.old_status, '') = 'warning')::int,
+        error = error + (coalesce(new.new_status, '') = 'error')::int - (coalesce(new.old_status, '') = 'error')::int,
+        transitions = transitions + 1
+    where farm_id = new.farm_id and day >= d;
+    return null;
+end;
+$$;
+
+drop trigger if exists sensor_status_rollup on sensor_status_events;
+create trigger sensor_status_rollup after insert on sensor_status_events
+    for each row execute function apply_status_event();
+
+-- Khởi tạo rollup hôm nay từ trạng thái hiện tại của sensor
+insert into farm_status_daily (farm_id, day, normal, warning, error)
+select farm_id::text, (now() at time zone 'Asia/Ho_Chi_Minh')::date,
+       count(*) filter (where status = 'normal'),
+       count(*) filter (where status = 'warning'),
+       count(*) filter (where status = 'error')
+from sensor where farm_id is not null group by farm_id
+on conflict (farm_id, day) do nothing;
+
+-- Luật cảnh báo đánh giá trên từng bản tin telemetry (xem rules.py)
+create table if not exists sensor_rules (
+    rule_id uuid primary key,
+    sensor_id text,
+    farm_id text,
+    metric text not null,
+    kind text not null default 'threshold' check (kind in ('threshold', 'rate')),
+    op text not null default '>' check (op in ('>', '>=', '<', '<=')),
+    threshold double precision not null,
+    clear_threshold double precision,
+    for_seconds double precision not null default 0,
+    status text not null default 'warning' check (status in ('warning', 'error')),
+    pump_id text,
+    pump_duration integer,
+    enabled boolean not null default true,
+    user_own uuid,
+    created_at timestamptz not null default now()
+);
+
+-- Cập nhật nhiều sensor trong một câu UPDATE cho các endpoint bulk. Mỗi phần tử của p_rows gồm
+-- sensor_id và chỉ các cột cần đổi; cột vắng mặt giữ nguyên giá trị hiện tại (jsonb_populate_record
+-- lấy dòng hiện tại làm nền). Sensor không tồn tại đơn giản là không được trả về, không bị tạo lại.
+create or replace function update_sensors(p_rows jsonb)
+returns setof jsonb language sql as $$
+    with changes as (
+        select item->>'sensor_id' as sensor_id, item from jsonb_array_elements(p_rows) as item
+    ), locked as (
+        select s.sensor_id, s.status from sensor s
+        join changes c on s.sensor_id::text = c.sensor_id
+        for update of s
+    )
+    update sensor s set
+        (sensor_name, sensor_type, location, link, connectivity, status, logs, latest_updated) = (
+            select p.sensor_name, p.sensor_type, p.location, p.link, p.connectivity, p.status, p.logs,
+                   p.latest_updated
+            from jsonb_populate_record(s, c.item) p
+        )
+    from changes c
+    join locked l on l.sensor_id::text = c.sensor_id
+    where s.sensor_id::text = c.sensor_id
+    returning to_jsonb(s) || jsonb_build_object('old_status', l.status);
+$$;
+
+-- Khóa do backend sinh để replay từ spool (xem spool.py) không ghi trùng
+alter table sensor_readings add column if not exists event_id uuid;
+create unique index if not exists sensor_readings_event_id_idx on sensor_readings (event_id);
+
+alter table sensor_status_events add column if not exists event_id uuid;
+create unique index if not exists sensor_status_events_event_id_idx on sensor_status_events (event_id);
+
+alter table sensor add column if not exists spool_ref uuid;
+create unique index if not exists sensor_spool_ref_idx on sensor (spool_ref);
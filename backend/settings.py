@@ -0,0 +1,139 @@
+import os
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class Settings(BaseModel):
+    """Backend configuration, one field per environment variable.
+
+    Field names are the lower-cased variable names, so SUPABASE_QUERY_TIMEOUT
+    is `supabase_query_timeout`. Values are validated and converted by
+    pydantic when the object is built; nothing here opens a connection, so
+    missing credentials only fail when the client that needs them is first
+    used.
+    """
+
+    # Supabase
+    supabase_url: Optional[str] = None
+    supabase_key: Optional[str] = None
+    supabase_jwt_secret: Optional[str] = None
+    supabase_workers: int = 16
+    supabase_query_timeout: float = 10
+    supabase_http_timeout: float = 10
+    supabase_http_concurrency: int = 50
+    telemetry_table: str = "sensor_readings"
+    status_events_table: str = "sensor_status_events"
+    schedule_table: str = "irrigation_schedule"
+    rules_table: str = "sensor_rules"
+    entity_cache_ttl: float = 300
+    entity_cache_size: int = 10000
+    auth_cache_size: int = 10000
+    auth_revocation_check_interval: float = 300
+
+    # Weather
+    weather_api_key: Optional[str] = None
+    weather_api_url: str = "http://api.weatherapi.com"
+    weather_http_timeout: float = 5
+    weather_http_concurrency: int = 20
+    weather_current_ttl: float = 300
+    weather_forecast_ttl: float = 1800
+    weather_stale_ttl: float = 600
+    weather_cache_size: int = 512
+
+    # Logging
+    log_level: str = "INFO"
+    log_levels: str = ""
+    log_sample: str = "backend.ingest=100,consumer.rejects=10"
+    log_format: str = "json"
+
+    # Worker / live state
+    web_concurrency: int = 1
+    shared_poll_interval: float = 0.1
+    shared_election_interval: float = 2
+    shared_resync_interval: float = 10
+    live_state_shm: str = "/dev/shm/smartfarm-live"
+    live_state_max_devices: int = 10000
+    live_state_slot_bytes: int = 1024
+    leader_lock: str = "/dev/shm/smartfarm-leader.lock"
+    leader_socket: str = "/dev/shm/smartfarm-leader.sock"
+    shared_events_shm: str = "/dev/shm/smartfarm-events"
+    shared_events_capacity: int = 4096
+
+    # Telemetry
+    timeseries_capacity: int = 20160
+    timeseries_retention_hours: float = 168
+    timeseries_max_sensors: int = 1000
+    ingest_max_message_bytes: int = 65536
+    stream_queue_size: int = 100
+    stream_keepalive: float = 15
+    telemetry_batch_size: int = 500
+    telemetry_flush_interval: float = 2
+    telemetry_max_queue: int = 50000
+    heartbeat_timeout: float = 120
+    heartbeat_flush_interval: float = 5
+    heartbeat_batch_size: int = 200
+    heartbeat_max_devices: int = 100000
+    rules_max_states: int = 200000
+    schedule_tz: str = "Asia/Ho_Chi_Minh"
+
+    # Spool
+    spool_path: str = "spool.db"
+    spool_max_mb: int = 512
+    spool_replay_batch: int = 500
+    spool_replay_rate: float = 2000
+    spool_backoff_max: float = 60
+
+    # MQTT
+    mqtt_host: Optional[str] = None
+    mqtt_port: int = 1883
+    mqtt_user: Optional[str] = None
+    mqtt_pass: Optional[str] = None
+    mqtt_topic: Optional[str] = None
+    mqtt_pump_topic: Optional[str] = None
+    mqtt_keepalive: int = 30
+    mqtt_qos: int = 1
+    mqtt_max_inflight: int = 20
+
+    # RabbitMQ
+    farm_host: Optional[str] = None
+    farm_port: int = 5672
+    farm_user: Optional[str] = None
+    farm_pass: Optional[str] = None
+    farm_vhost: str = "/"
+    rabbitmq_queue: Optional[str] = None
+    rabbitmq_prefetch: int = 100
+    rabbitmq_ack_batch: int = 20
+    rabbitmq_ack_interval: float = 1
+    rabbitmq_backoff_max: float = 60
+
+    # API
+    dashboard_page_max: int = 1000
+    sensor_bulk_chunk: int = 500
+    sensor_bulk_max: int = 5000
+
+    @property
+    def pump_topic(self) -> str:
+        # Mặc định mỗi bơm một topic con dưới MQTT_TOPIC
+        return self.mqtt_pump_topic or f"{self.mqtt_topic}/{{pump_id}}"
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        values = {}
+        for name, field in cls.model_fields.items():
+            value = environ.get(name.upper())
+            if value is None:
+                continue
+            # Biến số/tùy chọn khai báo nhưng để trống coi như không đặt; chuỗi rỗng vẫn hợp lệ cho str
+            if value == "" and field.annotation is not str:
+                continue
+            values[name] = value
+        return cls(**values)
+
+
+def load_settings(dotenv_path: str = "./.env") -> Settings:
+    if os.path.exists(dotenv_path):
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path=dotenv_path)
+    return Settings.from_env()
@@ -0,0 +1,509 @@
+from collections import OrderedDict
+import asyncio
+import itertools
+import logging
+import mmap
+import os
+import struct
+import time
+
+from codec import dumpb, loads
+from live_state import DeviceState, device_key
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ chạy được một worker
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SFLIVE01"
+HEADER = struct.Struct("<8sIIQQQ")  # magic, slot_count, slot_size, used, generation, last_slot + 1
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<QI")  # seqlock counter, payload length
+SLOT_DATA = 16
+U64 = struct.Struct("<Q")
+# _read() trả về EMPTY cho slot trống (độ dài 0), None cho slot đang ghi dở/hỏng
+EMPTY = object()
+
+
+class LeaderUnavailable(Exception):
+    pass
+
+
+SEGMENT_PREFIX = struct.Struct("<8sII")  # magic, slot_count, slot_size: đầu mọi header segment
+
+
+def map_segment(path: str, magic: bytes, slot_count: int, slot_size: int):
+    """Maps a segment of HEADER_SIZE bytes plus `slot_count` slots of `slot_size`.
+
+    Every worker keeps a shared flock on the file while it is mapped; the
+    segment is only (re)initialised, zeroed apart from its magic and layout,
+    by a process that can take the lock exclusively. A worker configured
+    with a different layout than a live segment adopts the segment's layout
+    instead of truncating it under the others. Returns (fd, mmap,
+    slot_count, slot_size); closing fd releases the lock.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        exclusive = True
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Worker khác đang map segment: chờ nó khởi tạo xong rồi dùng chung, không đụng tới kích thước
+                exclusive = False
+                fcntl.flock(fd, fcntl.LOCK_SH)
+        layout = segment_layout(fd, magic)
+        if exclusive and layout != (slot_count, slot_size):
+            # File mới, hỏng hoặc cấu hình khác mà không còn ai dùng: khởi tạo lại toàn bộ segment
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, HEADER_SIZE + slot_count * slot_size)
+            os.pwrite(fd, SEGMENT_PREFIX.pack(magic, slot_count, slot_size), 0)
+        elif layout is None:
+            raise RuntimeError(f"Shared segment {path} is in use but not initialised")
+        elif layout != (slot_count, slot_size):
+            logger.warning("⚠️ Shared segment %s has %d slots of %d bytes, ignoring the configured %d x %d",
+                           path, layout[0], layout[1], slot_count, slot_size)
+            slot_count, slot_size = layout
+        if fcntl is not None and exclusive:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        mm = mmap.mmap(fd, HEADER_SIZE + slot_count * slot_size)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd, mm, slot_count, slot_size
+
+
+def segment_layout(fd, magic: bytes):
+    prefix = os.pread(fd, SEGMENT_PREFIX.size, 0)
+    if len(prefix) != SEGMENT_PREFIX.size:
+        return None
+    found, slot_count, slot_size = SEGMENT_PREFIX.unpack(prefix)
+    if found != magic or os.fstat(fd).st_size < HEADER_SIZE + slot_count * slot_size:
+        return None
+    return slot_count, slot_size
+
+
+class SharedLiveState:
+    """LiveStateStore kept in a memory-mapped file that every worker maps.
+
+    One process (the elected leader) calls update(); each device owns a
+    fixed-size slot guarded by a seqlock, so readers in other processes
+    parse the payload straight out of the mapping and retry if the writer
+    was mid-update. Readers keep their own sensor and farm index and only
+    rebuild it when the header's generation changes, i.e. when a device is
+    added, evicted or moves to another farm.
+    """
+
+    def __init__(self, path: str, max_devices: int = 10000, slot_size: int = 1024):
+        self.path = path
+        self.max_devices = max_devices
+        self.slot_size = slot_size
+        self.stats = {"writes": 0, "oversized": 0, "torn_reads": 0, "index_rebuilds": 0, "reset_slots": 0}
+        self._fd = None
+        self._mm = self._open()
+        self._view = memoryview(self._mm)
+        # Phía ghi (leader)
+        self._owned = None
+        self._seq = None
+        self._free = []
+        # Phía đọc
+        self._generation = None
+        self._index = {}
+        self._farms = {}
+        self._seen = None
+
+    def _open(self):
+        self._fd, mm, self.max_devices, self.slot_size = map_segment(
+            self.path, MAGIC, self.max_devices, self.slot_size)
+        return mm
+
+    def _header(self):
+        return HEADER.unpack_from(self._mm, 0)
+
+    def _set_header(self, used: int, generation: int, last_slot: int):
+        HEADER.pack_into(self._mm, 0, MAGIC, self.max_devices, self.slot_size, used, generation, last_slot)
+
+    def __len__(self):
+        return self._header()[3]
+
+    # ---- ghi ----
+
+    def _adopt(self):
+        # Leader mới tiếp quản segment: dựng lại bảng slot từ dữ liệu đang có. Leader cũ chết giữa
+        # lúc ghi để lại bộ đếm lẻ (hoặc payload hỏng); đưa slot đó về chẵn, độ dài 0 để reader
+        # không chờ nó mãi và index dựng lại được, slot được dùng lại cho thiết bị mới
+        _, _, _, used, generation, last_slot = self._header()
+        states, free, reset = [], [], 0
+        for slot in range(used):
+            off = HEADER_SIZE + slot * self.slot_size
+            seq = U64.unpack_from(self._mm, off)[0]
+            state = self._read(slot, EMPTY) if not seq & 1 else None
+            if state is None:
+                SLOT_HEADER.pack_into(self._mm, off, seq + (1 if seq & 1 else 2), 0)
+                reset += 1
+            if state is None or state is EMPTY:
+                free.append(slot)
+            else:
+                states.append(state)
+        if reset:
+            self.stats["reset_slots"] += reset
+            self._set_header(used, generation + 1, last_slot)
+        self._sync(force=True)
+        states.sort(key=lambda s: s.seq)
+        self._owned = OrderedDict((s.sensor_id, (self._index[s.sensor_id], s.farm_id)) for s in states)
+        self._free = free
+        self._seq = itertools.count((states[-1].seq if states else 0) + 1)
+
+    def update(self, payload: dict, ts: float = None) -> DeviceState:
+        if self._owned is None:
+            self._adopt()
+        sensor_id, farm_id = device_key(payload)
+        state = DeviceState(sensor_id, farm_id, payload, ts or time.time(), next(self._seq))
+
+        _, _, _, used, generation, _ = self._header()
+        entry = self._owned.get(sensor_id)
+        if entry is None:
+            if self._free:
+                slot = self._free.pop()
+            elif used < self.max_devices:
+                slot = used
+                used += 1
+            else:
+                evicted, (slot, old_farm) = self._owned.popitem(last=False)
+                self._unindex(evicted, slot, old_farm)
+            self._index[sensor_id] = slot
+            self._index_farm(slot, farm_id)
+            generation += 1
+        else:
+            slot, old_farm = entry
+            self._owned.move_to_end(sensor_id)
+            if old_farm != farm_id:
+                self._unindex(None, slot, old_farm)
+                self._index_farm(slot, farm_id)
+                generation += 1
+        self._owned[sensor_id] = (slot, farm_id)
+
+        body = dumpb(state.to_dict())
+        if len(body) > self.slot_size - SLOT_DATA:
+            self.stats["oversized"] += 1
+            body = dumpb({**state.to_dict(), "data": {"truncated": True}})
+
+        off = HEADER_SIZE + slot * self.slot_size
+        seq = U64.unpack_from(self._mm, off)[0]
+        U64.pack_into(self._mm, off, seq + 1)
+        self._mm[off + SLOT_DATA:off + SLOT_DATA + len(body)] = body
+        SLOT_HEADER.pack_into(self._mm, off, seq + 2, len(body))
+        self._set_header(used, generation, slot + 1)
+        # Leader tự cập nhật index nên không phải dựng lại khi generation đổi
+        self._generation = generation
+        self.stats["writes"] += 1
+        return state
+
+    def _index_farm(self, slot: int, farm_id):
+        if farm_id is not None:
+            self._farms.setdefault(farm_id, {})[slot] = None
+
+    def _unindex(self, sensor_id, slot: int, farm_id):
+        if sensor_id is not None:
+            self._index.pop(sensor_id, None)
+        farm = self._farms.get(farm_id)
+        if farm is not None:
+            farm.pop(slot, None)
+            if not farm:
+                del self._farms[farm_id]
+
+    # ---- đọc ----
+
+    def _read(self, slot: int, empty=None):
+        off = HEADER_SIZE + slot * self.slot_size
+        for _ in range(100):
+            seq, length = SLOT_HEADER.unpack_from(self._mm, off)
+            if seq & 1:
+                continue
+            if length == 0:
+                return empty
+            try:
+                data = loads(self._view[off + SLOT_DATA:off + SLOT_DATA + length])
+            except ValueError:
+                data = None
+            if U64.unpack_from(self._mm, off)[0] == seq and data is not None:
+                return DeviceState(data["sensor_id"], data["farm_id"], data["data"], data["ts"], data["seq"])
+            self.stats["torn_reads"] += 1
+        return None
+
+    def _sync(self, force: bool = False):
+        generation = self._header()[4]
+        if not force and generation == self._generation:
+            return
+        index, farms, complete = {}, {}, True
+        for slot in range(len(self)):
+            state = self._read(slot, EMPTY)
+            if state is EMPTY:
+                continue
+            if state is None:
+                # Slot đang bị ghi dở quá lâu: lần gọi sau sẽ dựng lại index
+                complete = False
+                continue
+            index[state.sensor_id] = slot
+            if state.farm_id is not None:
+                farms.setdefault(state.farm_id, {})[slot] = None
+        self._index, self._farms = index, farms
+        self._generation = generation if complete else None
+        self.stats["index_rebuilds"] += 1
+
+    def get(self, sensor_id: str):
+        sensor_id = str(sensor_id)
+        for attempt in range(2):
+            self._sync(force=attempt > 0)
+            slot = self._index.get(sensor_id)
+            if slot is None:
+                return None
+            state = self._read(slot)
+            if state is not None and state.sensor_id == sensor_id:
+                return state
+        return None
+
+    def by_farm(self, farm_id: str):
+        farm_id = str(farm_id)
+        self._sync()
+        states = (self._read(slot) for slot in self._farms.get(farm_id, ()))
+        return [s for s in states if s is not None and s.farm_id == farm_id]
+
+    def latest(self):
+        last_slot = self._header()[5]
+        return self._read(last_slot - 1) if last_slot else None
+
+    def changes(self, collect: bool = True):
+        """States written since the previous call, found by diffing slot seqlock counters."""
+        import numpy as np
+        used = len(self)
+        if used == 0:
+            return []
+        if self._seen is None:
+            self._seen = np.zeros(0, dtype=np.uint64)
+        seqs = np.ndarray((used,), dtype=np.uint64, buffer=self._mm, offset=HEADER_SIZE,
+                          strides=(self.slot_size,))
+        if len(self._seen) < used:
+            self._seen = np.concatenate((self._seen, np.zeros(used - len(self._seen), dtype=np.uint64)))
+        changed = np.flatnonzero(seqs != self._seen[:used])
+        self._seen[:used] = seqs
+        del seqs
+        if not collect:
+            return []
+        return [s for s in (self._read(int(i)) for i in changed) if s is not None]
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+EVENTS_MAGIC = b"SFEVNT01"
+EVENTS_HEADER = struct.Struct("<8sIIQ")  # magic, slot_count, slot_size, số event đã publish
+
+
+class SharedEventLog:
+    """Small events broadcast between workers through a memory-mapped ring.
+
+    Any worker may publish(); writers take turns on a flock of `path`.lock
+    and stamp each slot's counter with the event's number, so poll() reads
+    without locking and can tell a slot that is still being written (try
+    again on the next poll) from one a lapping writer already reused (the
+    reader missed events and poll() reports overflow so the caller can drop
+    whatever it caches). Readers start after the events published before
+    they opened the log and skip events their own process published.
+    """
+
+    def __init__(self, path: str, capacity: int = 4096, slot_size: int = 512):
+        self.path = path
+        self._fd, self._mm, self.capacity, self.slot_size = map_segment(path, EVENTS_MAGIC, capacity, slot_size)
+        self._view = memoryview(self._mm)
+        self._lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+        self._next = self._published()
+        self.stats = {"published": 0, "received": 0, "overflows": 0}
+
+    def _published(self) -> int:
+        return EVENTS_HEADER.unpack_from(self._mm, 0)[3]
+
+    def publish(self, kind: str, data: dict):
+        body = dumpb({"kind": kind, "pid": self._pid, "data": data})
+        if len(body) > self.slot_size - SLOT_DATA:
+            raise ValueError(f"Event {kind} is {len(body)} bytes, slots hold {self.slot_size - SLOT_DATA}")
+        if fcntl is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            n = self._published()
+            off = HEADER_SIZE + (n % self.capacity) * self.slot_size
+            U64.pack_into(self._mm, off, 2 * n + 1)
+            self._mm[off + SLOT_DATA:off + SLOT_DATA + len(body)] = body
+            SLOT_HEADER.pack_into(self._mm, off, 2 * n + 2, len(body))
+            EVENTS_HEADER.pack_into(self._mm, 0, EVENTS_MAGIC, self.capacity, self.slot_size, n + 1)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self.stats["published"] += 1
+
+    def poll(self):
+        """Returns (events from other workers since the previous poll, whether some were missed)."""
+        published = self._published()
+        if published - self._next > self.capacity:
+            return self._overflow(published)
+        events = []
+        while self._next < published:
+            n = self._next
+            off = HEADER_SIZE + (n % self.capacity) * self.slot_size
+            seq, length = SLOT_HEADER.unpack_from(self._mm, off)
+            if seq < 2 * n + 2:
+                break
+            try:
+                event = loads(self._view[off + SLOT_DATA:off + SLOT_DATA + length])
+            except ValueError:
+                event = None
+            if seq > 2 * n + 2 or U64.unpack_from(self._mm, off)[0] != seq or event is None:
+                # Writer đã quay vòng đè lên slot trước khi kịp đọc
+                return self._overflow(self._published())
+            self._next += 1
+            if event["pid"] != self._pid:
+                events.append(event)
+        self.stats["received"] += len(events)
+        return events, False
+
+    def _overflow(self, published: int):
+        self._next = published
+        self.stats["overflows"] += 1
+        return [], True
+
+    def close(self):
+        self._view.release()
+        self._mm.close()
+        os.close(self._fd)
+        os.close(self._lock_fd)
+
+
+class LeaderRpc:
+    """Request/response calls from follower workers to the leader over a Unix socket.
+
+    The leader serve()s the handlers registered with register(); call()
+    opens one connection per request and exchanges one length-prefixed
+    codec payload each way. Raises LeaderUnavailable when no leader is
+    listening or it does not answer within `timeout`.
+    """
+
+    FRAME = struct.Struct("<I")
+
+    def __init__(self, path: str, timeout: float = 5.0, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._handlers = {}
+        self._server = None
+        self.stats = {"calls": 0, "served": 0, "errors": 0}
+
+    def register(self, name: str, fn):
+        self._handlers[name] = fn
+
+    async def serve(self):
+        # Socket của leader cũ (đã chết) còn nằm lại: gỡ đi rồi bind lại
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read(self, reader):
+        size = self.FRAME.unpack(await reader.readexactly(self.FRAME.size))[0]
+        if size > self.max_bytes:
+            raise ValueError(f"RPC frame of {size} bytes is too large")
+        return loads(await reader.readexactly(size))
+
+    async def _write(self, writer, obj):
+        body = dumpb(obj)
+        writer.write(self.FRAME.pack(len(body)) + body)
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await self._read(reader)
+            handler = self._handlers.get(request.get("method"))
+            if handler is None:
+                response = {"error": f"Unknown method {request.get('method')}"}
+            else:
+                try:
+                    response = {"result": await handler(**request.get("params", {}))}
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    response = {"error": str(e)}
+            await self._write(writer, response)
+            self.stats["served"] += 1
+        except Exception as e:
+            logger.warning("⚠️ Leader RPC request failed: %s", e)
+        finally:
+            writer.close()
+
+    async def call(self, name: str, /, **params):
+        self.stats["calls"] += 1
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.path), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise LeaderUnavailable(f"No leader listening on {self.path}: {e}")
+        try:
+            await self._write(writer, {"method": name, "params": params})
+            response = await asyncio.wait_for(self._read(reader), self.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            raise LeaderUnavailable(f"Leader did not answer {name}: {e}")
+        finally:
+            writer.close()
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+
+class LeaderElection:
+    """Elects one worker per host by holding an exclusive flock on `path`.
+
+    The kernel drops the lock when the holder exits, so a waiting worker
+    wins the next try_acquire() after the leader dies.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            self._fd = -1
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(os.getpid()).encode(), 0)
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        if self._fd >= 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        self._fd = None
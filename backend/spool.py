@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+from codec import dumpb, loads
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool:
+    """Append-only SQLite (WAL) spool for writes that could not reach Supabase.
+
+    Rows are appended per stream and replayed by an asyncio task in id
+    order, `batch_size` rows at a time, through the handler registered for
+    that stream. A batch is deleted only after its handler returns, so
+    handlers must be idempotent (upsert on a client-generated key). Replay
+    is limited to `replay_rate` rows per second so a long backlog does not
+    flood Supabase the moment it comes back; failures back off up to
+    `backoff_max` seconds per stream and are retried, never dropped; a
+    handler that knows a batch can never succeed should log and return.
+    Appends fail with SpoolFull once the file holds `max_bytes`.
+
+    A stream registered with `key` stores key(row) next to each row so
+    has_pending() can ask about a single key. SQLite calls block, so from
+    the event loop go through asyncio.to_thread; snapshot() only returns
+    the figures saved by the last refresh().
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, batch_size: int = 500,
+                 replay_rate: float = 2000.0, poll_interval: float = 1.0, backoff_max: float = 60.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.replay_rate = replay_rate
+        self.poll_interval = poll_interval
+        self.backoff_max = backoff_max
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._page_size = 4096
+        self._keys = {}
+        self._task = None
+        self._status = {"pending": {}, "bytes": 0, "oldest": None}
+        self.stats = {"appended": 0, "replayed": 0, "rejected": 0, "replay_batches": 0, "replay_failures": 0}
+
+    @property
+    def _conn(self):
+        # Mở file ở lần dùng đầu tiên (gọi khi đang giữ _lock), import module không tạo file
+        if self._db is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: commit không fsync từng lần, vẫn an toàn khi process chết
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, stream TEXT NOT NULL, payload BLOB NOT NULL,"
+                " created_at REAL NOT NULL, key TEXT)")
+            # File tạo từ bản cũ chưa có cột key: thêm cột và điền key cho các dòng đang chờ
+            if "key" not in [row[1] for row in conn.execute("PRAGMA table_info(spool)")]:
+                conn.execute("ALTER TABLE spool ADD COLUMN key TEXT")
+                for stream, key in self._keys.items():
+                    rows = conn.execute("SELECT id, payload FROM spool WHERE stream = ?", (stream,)).fetchall()
+                    conn.executemany("UPDATE spool SET key = ? WHERE id = ?",
+                                     [(str(key(loads(payload))), i) for i, payload in rows])
+            conn.execute("CREATE INDEX IF NOT EXISTS spool_stream_id ON spool (stream, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS spool_stream_key ON spool (stream, key)")
+            self._page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            self._db = conn
+        return self._db
+
+    def register(self, stream: str, replay_fn, key=None):
+        self._handlers[stream] = replay_fn
+        if key is not None:
+            self._keys[stream] = key
+
+    def append(self, stream: str, rows) -> int:
+        rows = list(rows)
+        if not rows:
+            return 0
+        now = time.time()
+        key = self._keys.get(stream)
+        values = [(stream, dumpb(row), now, str(key(row)) if key else None) for row in rows]
+        with self._lock:
+            if self._size_locked() >= self.max_bytes:
+                self.stats["rejected"] += len(rows)
+                raise SpoolFull(f"Spool {self.path} is full ({self.max_bytes} bytes)")
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("INSERT INTO spool (stream, payload, created_at, key) VALUES (?, ?, ?, ?)",
+                                       values)
+        self.stats["appended"] += len(rows)
+        return len(rows)
+
+    def has_pending(self, stream: str, key=None) -> bool:
+        with self._lock:
+            if key is None:
+                row = self._conn.execute("SELECT 1 FROM spool WHERE stream = ? LIMIT 1", (stream,)).fetchone()
+            else:
+                row = self._conn.execute("SELECT 1 FROM spool WHERE stream = ? AND key = ? LIMIT 1",
+                                         (stream, str(key))).fetchone()
+        return row is not None
+
+    def pending_keys(self, stream: str, keys) -> set:
+        """The subset of `keys` that still has rows waiting in `stream`."""
+        keys = [str(k) for k in keys]
+        found = set()
+        with self._lock:
+            # Giới hạn số tham số của SQLite: hỏi theo từng nhóm
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                marks = ",".join("?" * len(part))
+                found.update(k for k, in self._conn.execute(
+                    f"SELECT DISTINCT key FROM spool WHERE stream = ? AND key IN ({marks})", (stream, *part)))
+        return found
+
+    def pending(self) -> dict:
+        with self._lock:
+            return dict(self._conn.execute("SELECT stream, count(*) FROM spool GROUP BY stream").fetchall())
+
+    def oldest_age(self):
+        with self._lock:
+            oldest = self._conn.execute("SELECT min(created_at) FROM spool").fetchone()[0]
+        return time.time() - oldest if oldest is not None else None
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._size_locked()
+
+    def _size_locked(self) -> int:
+        pages = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * self._page_size
+
+    def _read_status(self):
+        with self._lock:
+            pending = dict(self._conn.execute("SELECT stream, count(*) FROM spool GROUP BY stream").fetchall())
+            oldest = self._conn.execute("SELECT min(created_at) FROM spool").fetchone()[0]
+            size = self._size_locked()
+        self._status = {"pending": pending, "bytes": size, "oldest": oldest}
+
+    async def refresh(self):
+        try:
+            await asyncio.to_thread(self._read_status)
+        except sqlite3.Error as e:
+            logger.warning("⚠️ Could not read spool status: %s", e)
+
+    @property
+    def status(self) -> dict:
+        # Số liệu của lần refresh() gần nhất, đọc không chạm tới SQLite
+        oldest = self._status["oldest"]
+        return {"pending": self._status["pending"], "bytes": self._status["bytes"],
+                "oldest_age": time.time() - oldest if oldest is not None else None}
+
+    def snapshot(self) -> dict:
+        return {**self.stats, **self.status}
+
+    def _peek(self, stream: str):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, payload FROM spool WHERE stream = ? ORDER BY id LIMIT ?",
+                                      (stream, self.batch_size)).fetchall()
+        return [i for i, _ in rows], [loads(payload) for _, payload in rows]
+
+    def _ack(self, stream: str, last_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM spool WHERE stream = ? AND id <= ?", (stream, last_id))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    async def _run(self):
+        retry_at = {}
+        delays = {}
+        while True:
+            replayed = 0
+            for stream, replay_fn in list(self._handlers.items()):
+                if time.monotonic() < retry_at.get(stream, 0):
+                    continue
+                ids, rows = await asyncio.to_thread(self._peek, stream)
+                if not rows:
+                    continue
+                try:
+                    await replay_fn(rows)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Supabase vẫn chưa lên: giữ nguyên stream này, thử lại chậm dần, stream khác vẫn chạy
+                    delay = delays.get(stream, self.poll_interval)
+                    delays[stream] = min(delay * 2, self.backoff_max)
+                    retry_at[stream] = time.monotonic() + delay
+                    self.stats["replay_failures"] += 1
+                    logger.warning("⚠️ Spool replay of %s failed, retrying in %.1fs: %s", stream, delay, e)
+                    continue
+                await asyncio.to_thread(self._ack, stream, ids[-1])
+                delays.pop(stream, None)
+                replayed += len(rows)
+                self.stats["replayed"] += len(rows)
+                self.stats["replay_batches"] += 1
+
+            await self.refresh()
+
+            if replayed:
+                await asyncio.sleep(replayed / self.replay_rate)
+            else:
+                await asyncio.sleep(self.poll_interval)
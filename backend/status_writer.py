@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class StatusWriter:
+    """Applies sensor status changes off the ingest path.
+
+    put() only records the newest wanted status per sensor and returns; a
+    background task hands pending changes to `apply_fn(sensor_id, status,
+    logs)` up to `concurrency` at a time. A sensor whose status changes
+    several times while a write is in flight costs one more write, of its
+    newest status. A failed write is queued again unless a newer status
+    arrived in the meantime.
+    """
+
+    def __init__(self, apply_fn, concurrency: int = 8, retry_delay: float = 5.0, max_pending: int = 100000):
+        self.apply_fn = apply_fn
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.max_pending = max_pending
+        self._pending = {}
+        self._wake = asyncio.Event()
+        self._task = None
+        self.stats = {"queued": 0, "applied": 0, "failed": 0, "dropped": 0}
+
+    def put(self, sensor_id: str, status: str, logs: str):
+        sensor_id = str(sensor_id)
+        if sensor_id not in self._pending and len(self._pending) >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+        self._pending[sensor_id] = (status, logs)
+        self.stats["queued"] += 1
+        self._wake.set()
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending": self.pending()}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Ghi nốt những gì còn chờ trước khi tắt
+        while self._pending and await self.flush():
+            pass
+
+    async def flush(self) -> bool:
+        """Applies one round of pending changes; returns False if any of them failed."""
+        if not self._pending:
+            return True
+        items = list(self._pending.items())[:self.concurrency]
+        for sensor_id, _ in items:
+            del self._pending[sensor_id]
+        results = await asyncio.gather(
+            *(self.apply_fn(sensor_id, status, logs) for sensor_id, (status, logs) in items),
+            return_exceptions=True)
+
+        ok = True
+        for (sensor_id, change), result in zip(items, results):
+            if isinstance(result, Exception):
+                ok = False
+                self.stats["failed"] += 1
+                logger.error("❌ Error applying status %s to sensor %s: %s", change[0], sensor_id, result)
+                self._pending.setdefault(sensor_id, change)
+            else:
+                self.stats["applied"] += 1
+        return ok
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._pending:
+                if not await self.flush():
+                    # Supabase lỗi: chờ rồi thử lại, không quay vòng liên tục
+                    await asyncio.sleep(self.retry_delay)
@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import threading
+
+# numpy (~0.1s) chỉ được import khi có bản tin hoặc truy vấn đầu tiên, không phải lúc import module
+
+
+# Các trường không phải số đo thì không lưu vào chuỗi thời gian
+SKIP_FIELDS = {"sensor_id", "device_id", "farm_id", "id"}
+
+
+class RingSeries:
+    """Fixed-capacity ring of (timestamp, value) pairs backed by NumPy arrays.
+
+    Arrays start small and double until they reach capacity, so idle or
+    short-lived sensors don't pay for a full retention window up front.
+    """
+
+    __slots__ = ("capacity", "ts", "values", "head", "size")
+
+    def __init__(self, capacity: int, initial: int = 1024):
+        import numpy as np
+        self.capacity = capacity
+        n = min(initial, capacity)
+        self.ts = np.empty(n, dtype=np.float64)
+        self.values = np.empty(n, dtype=np.float64)
+        self.head = 0
+        self.size = 0
+
+    def append(self, ts: float, value: float):
+        if self.size == len(self.ts) and self.size < self.capacity:
+            self._grow()
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % len(self.ts)
+        if self.size < len(self.ts):
+            self.size += 1
+
+    def _grow(self):
+        import numpy as np
+        # Chỉ gọi khi buffer đầy nên head luôn ở vị trí 0 (chưa quay vòng)
+        n = min(len(self.ts) * 2, self.capacity)
+        ts = np.empty(n, dtype=np.float64)
+        values = np.empty(n, dtype=np.float64)
+        ts[:self.size] = self.ts[:self.size]
+        values[:self.size] = self.values[:self.size]
+        self.ts, self.values = ts, values
+        self.head = self.size
+
+    def ordered(self):
+        import numpy as np
+        if self.size < len(self.ts):
+            return self.ts[:self.size].copy(), self.values[:self.size].copy()
+        h = self.head
+        return (np.concatenate((self.ts[h:], self.ts[:h])),
+                np.concatenate((self.values[h:], self.values[:h])))
+
+    def range(self, t0: float, t1: float):
+        import numpy as np
+        ts, values = self.ordered()
+        lo = np.searchsorted(ts, t0, side="left")
+        hi = np.searchsorted(ts, t1, side="right")
+        return ts[lo:hi], values[lo:hi]
+
+
+def downsample_minmax(ts, values, t0: float, t1: float, points: int):
+    import numpy as np
+    # Chia [t0, t1] thành `points` bucket đều nhau, bỏ bucket rỗng
+    if len(ts) == 0:
+        return {"t": [], "min": [], "max": [], "mean": [], "count": []}
+
+    edges = np.linspace(t0, t1, points + 1)
+    starts = np.searchsorted(ts, edges[:-1], side="left")
+    ends = np.append(starts[1:], len(ts))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+
+    counts = ends - starts
+    sums = np.add.reduceat(values, starts)
+    return {
+        "t": ((edges[:-1] + edges[1:]) / 2)[keep].tolist(),
+        "min": np.minimum.reduceat(values, starts).tolist(),
+        "max": np.maximum.reduceat(values, starts).tolist(),
+        "mean": (sums / counts).tolist(),
+        "count": counts.tolist(),
+    }
+
+
+def downsample_lttb(ts, values, points: int):
+    import numpy as np
+    # Largest-Triangle-Three-Buckets: giữ hình dạng đường đồ thị với ít điểm
+    n = len(ts)
+    if points >= n:
+        return {"t": ts.tolist(), "value": values.tolist()}
+    if points < 3:
+        # Không có bucket giữa: chỉ giữ điểm đầu và cuối
+        ends = [0, n - 1][:max(points, 1)]
+        return {"t": ts[ends].tolist(), "value": values[ends].tolist()}
+
+    bounds = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(points - 2):
+        start, end = bounds[i], bounds[i + 1]
+        next_end = bounds[i + 2] if i + 2 < len(bounds) else n
+        if next_end > end:
+            avg_t = ts[end:next_end].mean()
+            avg_v = values[end:next_end].mean()
+        else:
+            avg_t, avg_v = ts[n - 1], values[n - 1]
+
+        bt = ts[start:end]
+        bv = values[start:end]
+        area = np.abs((ts[a] - avg_t) * (bv - values[a]) - (ts[a] - bt) * (avg_v - values[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return {"t": ts[selected].tolist(), "value": values[selected].tolist()}
+
+
+class SeriesStore:
+    """Per-sensor, per-metric ring buffers with a bounded number of sensors."""
+
+    def __init__(self, capacity: int = 20160, retention: float = 7 * 24 * 3600, max_sensors: int = 1000):
+        self.capacity = capacity
+        self.retention = retention
+        self.max_sensors = max_sensors
+        self._sensors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def append(self, sensor_id: str, payload: dict, ts: float):
+        with self._lock:
+            metrics = self._sensors.get(sensor_id)
+            if metrics is None:
+                metrics = self._sensors[sensor_id] = {}
+                while len(self._sensors) > self.max_sensors:
+                    self._sensors.popitem(last=False)
+            else:
+                self._sensors.move_to_end(sensor_id)
+
+            for name, value in payload.items():
+                if name in SKIP_FIELDS or isinstance(value, bool):
+                    continue
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                series = metrics.get(name)
+                if series is None:
+                    series = metrics[name] = RingSeries(self.capacity)
+                series.append(ts, value)
+
+    def has(self, sensor_id: str) -> bool:
+        return sensor_id in self._sensors
+
+    def query(self, sensor_id: str, t0: float, t1: float, points: int, method: str = "minmax", metric: str = None):
+        t0 = max(t0, t1 - self.retention)
+        with self._lock:
+            metrics = self._sensors.get(sensor_id, {})
+            names = [metric] if metric else list(metrics)
+            raw = {name: metrics[name].range(t0, t1) for name in names if name in metrics}
+
+        result = {}
+        for name, (ts, values) in raw.items():
+            if method == "lttb":
+                result[name] = downsample_lttb(ts, values, points)
+            else:
+                result[name] = downsample_minmax(ts, values, t0, t1, points)
+        return result
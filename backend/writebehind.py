@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Bounded queue that hands rows to `flush_fn` in batches from a background thread.
+
+    A batch is flushed once it reaches `batch_size` rows or `flush_interval`
+    seconds after its first row arrived. When the queue is full, put() blocks
+    for up to `block_timeout` seconds so a slow database slows the producer
+    down; only after that is the row dropped.
+
+    With a `spool`, a batch that fails is appended to it under
+    `spool_stream` instead of being retried, and for the next
+    `spool_cooldown` seconds batches go straight to the spool so an outage
+    costs one timeout rather than one per batch.
+    """
+
+    def __init__(self, flush_fn, batch_size: int = 500, flush_interval: float = 2.0,
+                 max_queue: int = 50000, block_timeout: float = 1.0, max_retries: int = 3,
+                 spool=None, spool_stream: str = None, spool_cooldown: float = 5.0):
+        self.flush_fn = flush_fn
+        self.spool = spool
+        self.spool_stream = spool_stream
+        self.spool_cooldown = spool_cooldown
+        self._spool_until = 0.0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {
+            "buffered": 0,
+            "flushed": 0,
+            "dropped": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "spooled": 0,
+        }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, row: dict) -> bool:
+        if self._stop.is_set():
+            self.stats["dropped"] += 1
+            return False
+        try:
+            self._queue.put(row, timeout=self.block_timeout)
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["buffered"] += 1
+        return True
+
+    async def put_async(self, row: dict) -> bool:
+        # Giống put() nhưng chờ bằng asyncio.sleep để không chặn event loop
+        deadline = time.monotonic() + self.block_timeout
+        while not self._stop.is_set():
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                if time.monotonic() >= deadline:
+                    break
+                await asyncio.sleep(0.01)
+                continue
+            self.stats["buffered"] += 1
+            return True
+        self.stats["dropped"] += 1
+        return False
+
+    def stop(self, timeout: float = 10.0):
+        # Dừng nhận dữ liệu mới rồi đẩy nốt những gì còn trong hàng đợi
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "pending": self.pending()}
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+        # Drain khi shutdown
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                break
+            self._flush(batch)
+
+    def _collect(self):
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self, limit: int):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        if self.spool is not None:
+            self._flush_or_spool(batch)
+            return
+
+        delay = 0.5
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.flush_fn(batch)
+                self.stats["flushed"] += len(batch)
+                self.stats["batches"] += 1
+                return
+            except Exception as e:
+                logger.error("❌ Write-behind flush failed (%d/%d): %s", attempt + 1, self.max_retries + 1, e)
+                if attempt == self.max_retries:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 10.0)
+
+        self.stats["failed_batches"] += 1
+        self.stats["dropped"] += len(batch)
+
+    def _flush_or_spool(self, batch):
+        if time.monotonic() >= self._spool_until:
+            try:
+                self.flush_fn(batch)
+                self.stats["flushed"] += len(batch)
+                self.stats["batches"] += 1
+                return
+            except Exception as e:
+                logger.error("❌ Write-behind flush failed, spooling %d rows: %s", len(batch), e)
+                self.stats["failed_batches"] += 1
+                self._spool_until = time.monotonic() + self.spool_cooldown
+
+        try:
+            self.spool.append(self.spool_stream, batch)
+            self.stats["spooled"] += len(batch)
+        except Exception as e:
+            logger.error("❌ Spool append failed, dropping %d rows: %s", len(batch), e)
+            self.stats["dropped"] += len(batch)
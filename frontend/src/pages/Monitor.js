@@ -2,6 +2,7 @@ import { useEffect, useState } from "react";
 import { useNavigate } from "react-router-dom";
 import axios from "axios";
 import { API_BASE_URL } from "../config";
+import { getInfo } from "../data/data";
 import SensorCard from "../components/SensorCard";
 import DataChart from "../components/DataChart";
 import RainLevelChart from "../components/RainChart";
@@ -22,6 +23,7 @@ const Monitor = () => {
   const [soilPercent, setSoilPercent] = useState(null);
   const [lux, setLux] = useState(null);
   const [rainValue, setRainValue] = useState(null);
+  const [farmId, setFarmId] = useState(null);
 
   // Auth check
   useEffect(() => {
@@ -92,23 +94,30 @@ const Monitor = () => {
       .catch(console.error);
   }, [province]);
 
-  // Sensor data
+  // Farm của user: stream chỉ nhận bản tin của farm này, không nhận của mọi thiết bị
   useEffect(() => {
-    const fetchSensor = async () => {
-      const res = await fetch(`${API_BASE_URL}/api/latest`);
-      const data = await res.json();
+    getInfo()
+      .then((result) => setFarmId(result.farms?.[0]?.farm_id ?? null))
+      .catch(console.error);
+  }, []);
+
+  // Sensor data (server đẩy qua SSE, không cần polling)
+  useEffect(() => {
+    if (farmId === null) return;
+    const source = new EventSource(
+      `${API_BASE_URL}/api/stream?farm_id=${encodeURIComponent(farmId)}`
+    );
+    source.onmessage = (event) => {
+      const { data } = JSON.parse(event.data);
       setTemperature(parseFloat(data.temperature));
       setHumidity(parseFloat(data.humidity));
       setSoilPercent(parseFloat(data.soilPercent) );
       setLux(parseFloat(data.lux));
       setRainValue(parseFloat(data.rainValue));
       setWindKph(parseFloat(data.windKph));
-
     };
-    fetchSensor();
-    const interval = setInterval(fetchSensor, 5000);
-    return () => clearInterval(interval);
-  }, []);
+    return () => source.close();
+  }, [farmId]);
 
 return (
   <div className="min-h-screen bg-slate-50">
@@ -11,6 +11,7 @@ import {
   FiTrash2,
 } from "react-icons/fi";
 import { API_BASE_URL } from "../config";
+import { getInfo } from "../data/data";
 
 /* -------------------- Helpers -------------------- */
 const cx = (...s) => s.filter(Boolean).join(" ");
@@ -74,6 +75,7 @@ const ControlPump = () => {
   const [pumpOn, setPumpOn] = useState(null); // null while loading
   const [busy, setBusy] = useState(false);
   const [error, setError] = useState("");
+  const [farmId, setFarmId] = useState(null);
 
   // NEW: thời lượng bật bơm (giây) cho /api/pump-on
   const [durationSec, setDurationSec] = useState(10);
@@ -116,10 +118,24 @@ const ControlPump = () => {
 
   useEffect(() => {
     fetchPumpStatus();
-    const id = setInterval(fetchPumpStatus, 5000);
-    return () => clearInterval(id);
+    getInfo()
+      .then((result) => setFarmId(result.farms?.[0]?.farm_id ?? null))
+      .catch(console.error);
   }, []);
 
+  useEffect(() => {
+    if (farmId === null) return;
+    // Nhận trạng thái bơm qua SSE thay vì polling 5s, chỉ các bản tin của farm này
+    const source = new EventSource(
+      `${API_BASE_URL}/api/stream?farm_id=${encodeURIComponent(farmId)}`
+    );
+    source.onmessage = (event) => {
+      const { data } = JSON.parse(event.data);
+      if (typeof data.pump !== "undefined") setPumpOn(data.pump === 1);
+    };
+    return () => source.close();
+  }, [farmId]);
+
   //! Bật/tắt thủ công tức thời (gọi /api/pump với {status: "ON"|"OFF"}) Chưa có api
   const togglePump = async (next) => {
     if (pumpOn === null || busy || mode !== "manual") return;
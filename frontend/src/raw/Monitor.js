@@ -1,6 +1,7 @@
 import { useState, useEffect } from "react";
 import { useNavigate } from "react-router-dom";
 import { API_BASE_URL } from "../config";
+import { getInfo } from "../data/data";
 import image from "../assets/farm.webp";
 import axios from "axios";
 const Monitor = () => {
@@ -17,6 +18,7 @@ const Monitor = () => {
     const [lux, setLux] = useState(null);
     const [rainValue, setRainValue] = useState(null);
     const [selectedFeature, setSelectedFeature] = useState(null);
+    const [farmId, setFarmId] = useState(null);
 
     useEffect(() => {
         const checkLogin = async () => {
@@ -86,10 +88,18 @@ const Monitor = () => {
     }, [province]);
 
     useEffect(() => {
-        const fetchSensorData = async () => {
+        getInfo()
+        .then((result) => setFarmId(result.farms?.[0]?.farm_id ?? null))
+        .catch(console.error);
+    }, []);
+
+    useEffect(() => {
+        if (farmId === null) return;
+        const source = new EventSource(`${API_BASE_URL}/api/stream?farm_id=${encodeURIComponent(farmId)}`);
+
+        source.onmessage = (event) => {
         try {
-            const res = await fetch(`${API_BASE_URL}/api/latest`);
-            const data = await res.json();
+            const { data } = JSON.parse(event.data);
 
             setTemperature(parseFloat(data.temperature));
             setHumidity(parseFloat(data.humidity));
@@ -97,16 +107,12 @@ const Monitor = () => {
             setLux(parseFloat(data.lux));
             setRainValue(parseFloat(data.rainValue));
         } catch (error) {
-            console.error("Failed to fetch sensor data:", error);
+            console.error("Failed to parse sensor data:", error);
         }
         };
 
-        fetchSensorData();
-
-        const interval = setInterval(fetchSensorData, 5000);
-
-        return () => clearInterval(interval);
-    }, []);
+        return () => source.close();
+    }, [farmId]);
 
     return (
         <div className="flex flex-col gap-6 ">